@@ -11,7 +11,8 @@ from .cluster import (                              # NOQA
     start_cluster,
     add_manager_config,
     clear_data,
-    join_cluster
+    join_cluster,
+    promote_standby
 )
 from .maintenance import (                          # NOQA
     backup,
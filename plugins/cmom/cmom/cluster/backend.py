@@ -0,0 +1,456 @@
+"""
+Backends through which commands are run against the Tier 1 managers.
+
+`RestBackend` talks to a manager's REST service directly, using a single
+keep-alive client per manager. `CliBackend` runs the equivalent `cfy`
+commands in a CLI profile, and is kept as a fallback. Which one is used is
+decided by the `execution_backend` property of the cluster node.
+
+Both backends raise `CommandExecutionException` on failure, so callers can
+handle errors the same way regardless of the backend in use.
+"""
+
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import requests
+
+from cloudify import ctx
+from cloudify.exceptions import CommandExecutionException
+
+from cloudify_rest_client import CloudifyClient
+from cloudify_rest_client.client import HTTPClient
+from cloudify_rest_client.exceptions import CloudifyClientError
+
+from ..common import DEFAULT_TENANT
+from .utils import (
+    execute_and_log,
+    get_config,
+    cluster_property,
+    credentials_fingerprint,
+    invalidate_cached_master
+)
+
+REST_BACKEND = 'rest'
+CLI_BACKEND = 'cli'
+
+# Without a connect timeout, a request to a manager that went down mid-way
+# (e.g. during a failover) can hang indefinitely
+CONNECT_TIMEOUT = 10
+# The same goes for reading the response, when the manager went down after
+# accepting the connection (a half-open connection). Snapshot downloads are
+# allowed to stall for longer, as the manager might be busy serving them
+READ_TIMEOUT = 60
+DOWNLOAD_READ_TIMEOUT = 5 * 60
+
+# Clients are cached for the lifetime of the process, keyed by manager IP
+# and tenant, alongside the fingerprint of the credentials they were
+# created with
+_clients = {}
+_clients_lock = threading.Lock()
+
+# The CLI shows the display status of executions, which differs from their
+# actual status (returned by the REST service) for successful executions
+_CLI_EXECUTION_STATUSES = {'completed': 'terminated'}
+
+
+class _KeepAliveHTTPClient(HTTPClient):
+    """
+    An HTTP client that sends all of its requests over a single session,
+    instead of opening a new connection (and TLS handshake) for each one
+    """
+    def __init__(self, *args, **kwargs):
+        super(_KeepAliveHTTPClient, self).__init__(*args, **kwargs)
+        self._session = requests.Session()
+        self._local = threading.local()
+
+    @contextmanager
+    def read_timeout(self, timeout):
+        """
+        Use a different read timeout for the requests sent in this block
+        (in the current thread), for calls of the client that don't accept
+        a timeout. The connect timeout is never longer than it
+        """
+        previous = getattr(self._local, 'read_timeout', READ_TIMEOUT)
+        self._local.read_timeout = timeout or previous
+        try:
+            yield
+        finally:
+            self._local.read_timeout = previous
+
+    def _do_request(self, requests_method, *args, **kwargs):
+        session_method = getattr(self._session, requests_method.__name__)
+
+        def _request(*request_args, **request_kwargs):
+            if request_kwargs.get('timeout') is None:
+                read_timeout = getattr(
+                    self._local, 'read_timeout', READ_TIMEOUT
+                )
+                request_kwargs['timeout'] = (
+                    min(CONNECT_TIMEOUT, read_timeout), read_timeout
+                )
+            return session_method(*request_args, **request_kwargs)
+
+        return super(_KeepAliveHTTPClient, self)._do_request(
+            _request, *args, **kwargs
+        )
+
+
+class _KeepAliveClient(CloudifyClient):
+    client_class = _KeepAliveHTTPClient
+
+
+def get_backend(manager_ip, instance=None, tenant=DEFAULT_TENANT):
+    """
+    Return the backend that should be used to run commands on `manager_ip`
+    :param manager_ip: The public IP of the manager (as it appears in the
+    `managers` config)
+    :param instance: The cluster node instance holding the `managers` config
+    :param tenant: The tenant in the scope of which the commands are run
+    """
+    instance = instance or ctx.instance
+    if cluster_property('execution_backend', REST_BACKEND) == CLI_BACKEND:
+        return CliBackend(manager_ip, instance, tenant)
+    return RestBackend(manager_ip, instance, tenant)
+
+
+def _get_client(manager_ip, instance, tenant=DEFAULT_TENANT):
+    managers, ca_cert = get_config(instance.runtime_properties)
+    config = managers[manager_ip]
+    fingerprint = credentials_fingerprint(config, ca_cert)
+    key = (manager_ip, tenant)
+
+    with _clients_lock:
+        cached_fingerprint, client = _clients.get(key, (None, None))
+        if cached_fingerprint != fingerprint:
+            client = _KeepAliveClient(
+                host=config['public_ip'],
+                username=config['admin_username'],
+                password=config['admin_password'],
+                tenant=tenant,
+                protocol='https',
+                cert=ca_cert
+            )
+            _clients[key] = fingerprint, client
+        return client
+
+
+class RestBackend(object):
+    def __init__(self, manager_ip, instance, tenant=DEFAULT_TENANT):
+        self.manager_ip = manager_ip
+        self.client = _get_client(manager_ip, instance, tenant)
+
+    @contextmanager
+    def _request(self, description):
+        """
+        Translate REST/connection errors to `CommandExecutionException`s
+        """
+        try:
+            yield
+        except (CloudifyClientError,
+                requests.exceptions.RequestException) as e:
+            status_code = getattr(e, 'status_code', None)
+            # Only connection and server errors say something about the
+            # health of the manager (as opposed to e.g. a 409 on create)
+            if not status_code or status_code >= 500:
+                invalidate_cached_master(self.manager_ip)
+            raise CommandExecutionException(
+                command='{0} [{1}]'.format(description, self.manager_ip),
+                error=str(e),
+                output='',
+                code=status_code or -1
+            )
+
+    def cluster_status(self, timeout=None):
+        """
+        :param timeout: How long to wait for the manager to connect and
+            answer, in seconds (defaults to the client's timeouts)
+        """
+        with self._request('cluster status'), \
+                self.client._client.read_timeout(timeout):
+            status = self.client.cluster.status()
+        if not status.get('initialized'):
+            raise CommandExecutionException(
+                command='cluster status [{0}]'.format(self.manager_ip),
+                error='This manager is not part of a Cloudify Manager cluster',
+                output='',
+                code=-1
+            )
+        return status
+
+    def cluster_nodes(self):
+        with self._request('cluster nodes list'):
+            return [dict(node) for node in self.client.cluster.nodes.list()]
+
+    def remove_cluster_node(self, node_name):
+        with self._request('cluster nodes remove {0}'.format(node_name)):
+            self.client.cluster.nodes.delete(node_name)
+
+    def manager_status(self, timeout=None):
+        """
+        Return the status of the manager's services, in the same format as
+        `cfy status --json` does
+        :param timeout: How long to wait for the manager to connect and
+            answer, in seconds (defaults to the client's timeouts)
+        """
+        with self._request('status'), \
+                self.client._client.read_timeout(timeout):
+            status = self.client.manager.get_status()
+
+        services = []
+        for service in status['services']:
+            instances = service.get('instances')
+            services.append({
+                'service': service['display_name'],
+                'status': instances[0]['state'] if instances else 'unknown'
+            })
+        return services
+
+    def probe(self, timeout):
+        """
+        Check that the manager's REST service answers, giving up after
+        `timeout` seconds (e.g. while the manager is rebooting)
+        """
+        with self._request('status'):
+            self.client._client.get('/status', timeout=timeout)
+
+    def create_snapshot(self, snapshot_id, backup_params):
+        """
+        Start creating a snapshot, and return the ID of its execution
+        :param backup_params: The `cfy snapshots create` flags to apply
+        """
+        with self._request('snapshots create {0}'.format(snapshot_id)):
+            execution = self.client.snapshots.create(
+                snapshot_id,
+                include_metrics='--include-metrics' in backup_params,
+                include_credentials=(
+                    '--exclude-credentials' not in backup_params
+                ),
+                include_logs='--exclude-logs' not in backup_params,
+                include_events='--exclude-events' not in backup_params
+            )
+        return execution['id']
+
+    def restore_snapshot(self, snapshot_id, restore_params):
+        """
+        Start restoring a snapshot, and return the ID of its execution
+        :param restore_params: The `cfy snapshots restore` flags to apply
+        """
+        with self._request('snapshots restore {0}'.format(snapshot_id)):
+            execution = self.client.snapshots.restore(
+                snapshot_id,
+                recreate_deployments_envs=(
+                    '--without-deployment-envs' not in restore_params
+                ),
+                force='--force' in restore_params,
+                restore_certificates=(
+                    '--restore-certificates' in restore_params
+                ),
+                no_reboot='--no-reboot' in restore_params
+            )
+        return execution['id']
+
+    def get_execution(self, execution_id):
+        with self._request('executions get {0}'.format(execution_id)):
+            return dict(self.client.executions.get(execution_id))
+
+    def download_snapshot(self,
+                          snapshot_id,
+                          output_path,
+                          max_rate=None,
+                          concurrency=1,
+                          base=None):
+        """
+        Download a snapshot in segments, resuming any previous (partial)
+        download into `output_path`
+        :param max_rate: The maximum bandwidth to use, in bytes per second
+        :param concurrency: How many segments to download at the same time
+        :param base: A `StoredSnapshot` whose unchanged members are copied
+            instead of downloaded
+        """
+        # Imported here, as the download module uses the clients' settings
+        from .download import download_snapshot
+        with self._request('snapshots download {0}'.format(snapshot_id)):
+            download_snapshot(
+                self.client,
+                snapshot_id,
+                output_path,
+                max_rate,
+                concurrency,
+                base
+            )
+
+    def list_resources(self, kind):
+        """
+        :param kind: tenants/plugins/blueprints/secrets/deployments
+        """
+        with self._request('{0} list'.format(kind)):
+            resources = getattr(self.client, kind).list()
+        return [dict(resource) for resource in resources]
+
+    def create_tenant(self, tenant):
+        with self._request('tenants create {0}'.format(tenant)):
+            self.client.tenants.create(tenant)
+
+    def delete_plugin(self, plugin_id):
+        with self._request('plugins delete {0}'.format(plugin_id)):
+            self.client.plugins.delete(plugin_id)
+
+    def delete_blueprint(self, blueprint_id):
+        with self._request('blueprints delete {0}'.format(blueprint_id)):
+            self.client.blueprints.delete(blueprint_id)
+
+    def create_secret(self, key, value, visibility=None):
+        kwargs = {'visibility': visibility} if visibility else {}
+        with self._request('secrets create {0}'.format(key)):
+            self.client.secrets.create(
+                key,
+                value,
+                # `visibility` and `update_if_exists` are mutually exclusive
+                update_if_exists=not visibility,
+                **kwargs
+            )
+
+    def update_secret(self, key, value):
+        with self._request('secrets update {0}'.format(key)):
+            self.client.secrets.update(key, value)
+
+
+def _execution_id(output):
+    """
+    Parse the ID of the execution the CLI started from its output
+    """
+    return output.split("The execution's id is")[1].strip().split()[0]
+
+
+@contextmanager
+def _secret_file(value):
+    """
+    Pass the value of a secret to the CLI through a file only readable by
+    the current user, as the command line (which is visible to all users,
+    and logged) must not contain it
+    """
+    # `mkstemp` creates the file with 0600 permissions
+    fd, secret_path = tempfile.mkstemp(prefix='secret-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(value)
+        yield secret_path
+    finally:
+        os.remove(secret_path)
+
+
+class CliBackend(object):
+    def __init__(self, manager_ip, instance, tenant=DEFAULT_TENANT):
+        self.manager_ip = manager_ip
+        self.instance = instance
+        self.tenant = tenant
+
+    @contextmanager
+    def _profile(self):
+        # Imported here, as the profile module uses the backends itself
+        from .profile import profile
+        with profile(self.manager_ip, self.instance, self.tenant):
+            yield
+
+    def cluster_status(self, timeout=None):
+        with self._profile():
+            execute_and_log(
+                ['cfy', 'cluster', 'status'], no_log=True, timeout=timeout
+            )
+
+    def cluster_nodes(self):
+        with self._profile():
+            return execute_and_log(
+                ['cfy', 'cluster', 'nodes', 'list'], is_json=True
+            )
+
+    def remove_cluster_node(self, node_name):
+        with self._profile():
+            execute_and_log(
+                ['cfy', 'cluster', 'nodes', 'remove', node_name], no_log=True
+            )
+
+    def manager_status(self, timeout=None):
+        with self._profile():
+            return execute_and_log(
+                ['cfy', 'status'], is_json=True, timeout=timeout
+            )
+
+    def probe(self, timeout):
+        with self._profile():
+            execute_and_log(['cfy', 'status'], no_log=True, timeout=timeout)
+
+    def create_snapshot(self, snapshot_id, backup_params):
+        with self._profile():
+            output = execute_and_log(
+                ['cfy', 'snapshots', 'create', snapshot_id] + backup_params
+            )
+        return _execution_id(output)
+
+    def restore_snapshot(self, snapshot_id, restore_params):
+        with self._profile():
+            output = execute_and_log(
+                ['cfy', 'snapshots', 'restore', snapshot_id] + restore_params
+            )
+        return _execution_id(output)
+
+    def get_execution(self, execution_id):
+        with self._profile():
+            execution = execute_and_log(
+                ['cfy', 'executions', 'get', execution_id], is_json=True
+            )
+        status = execution['status']
+        execution['status'] = _CLI_EXECUTION_STATUSES.get(status, status)
+        return execution
+
+    def download_snapshot(self,
+                          snapshot_id,
+                          output_path,
+                          max_rate=None,
+                          concurrency=1,
+                          base=None):
+        # The CLI can't resume downloads, limit their bandwidth or download
+        # them incrementally
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        with self._profile():
+            execute_and_log([
+                'cfy', 'snapshots', 'download', snapshot_id,
+                '-o', output_path
+            ])
+
+    def list_resources(self, kind):
+        with self._profile():
+            return execute_and_log(['cfy', kind, 'list'], is_json=True)
+
+    def create_tenant(self, tenant):
+        with self._profile():
+            execute_and_log(['cfy', 'tenants', 'create', tenant])
+
+    def delete_plugin(self, plugin_id):
+        with self._profile():
+            execute_and_log(['cfy', 'plugins', 'delete', plugin_id])
+
+    def delete_blueprint(self, blueprint_id):
+        with self._profile():
+            execute_and_log(['cfy', 'blueprints', 'delete', blueprint_id])
+
+    def create_secret(self, key, value, visibility=None):
+        with _secret_file(value) as secret_path:
+            cmd = ['cfy', 'secrets', 'create', key, '-f', secret_path]
+            # `visibility` and `--update-if-exists` are mutually exclusive
+            if visibility:
+                cmd += ['-l', visibility]
+            else:
+                cmd.append('--update-if-exists')
+            with self._profile():
+                execute_and_log(cmd)
+
+    def update_secret(self, key, value):
+        with _secret_file(value) as secret_path, self._profile():
+            execute_and_log(
+                ['cfy', 'secrets', 'update', key, '-f', secret_path]
+            )
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
+import time
+import random
 import shutil
-from time import sleep
 
 from cloudify import ctx
 from cloudify.decorators import operation
@@ -14,9 +15,46 @@ from cloudify.exceptions import (
 
 from ..common import workdir
 
-from .utils import execute_and_log
+from .utils import (
+    execute_and_log,
+    cluster_property,
+    run_concurrently,
+    invalidate_cached_master
+)
+from .backend import get_backend
 from .maintenance import restore, UpgradeConfig
 from .profile import profile, get_current_master, get_config
+from .standby import (
+    fill_pool,
+    pop_standby,
+    add_standby,
+    get_standbys,
+    is_rebuilding,
+    remove_standby,
+    set_rebuilding
+)
+
+# Waiting for a manager to become responsive: the number of successive
+# successful probes required, and for how long (in seconds) to keep trying
+DEFAULT_READINESS_SUCCESSES = 3
+DEFAULT_READINESS_TIMEOUT = 300
+# How long a single probe may take, and the intervals between the probes:
+# successes are spaced by MIN_PROBE_INTERVAL, while the interval after a
+# failure doubles (with jitter) up to MAX_PROBE_INTERVAL
+PROBE_TIMEOUT = 10
+MIN_PROBE_INTERVAL = 1
+MAX_PROBE_INTERVAL = 15
+
+# How many slaves join the cluster at the same time
+DEFAULT_JOIN_CONCURRENCY = 3
+
+# The runtime properties recording the stages of `start_cluster` that
+# were completed
+RESTORED = 'restored'
+CLUSTER_STARTED = 'cluster_started'
+
+# How many of the managers are kept as warm standbys, outside of the cluster
+DEFAULT_STANDBY_MANAGERS = 0
 
 
 def _get_master_config():
@@ -32,9 +70,7 @@ def _get_master_config():
     )
 
 
-def _start_cluster():
-    master_ip, master_config = _get_master_config()
-
+def _start_cluster(master_ip, master_config):
     ctx.logger.info('Starting cluster on master: {0}'.format(master_ip))
     with profile(master_ip):
         try:
@@ -51,15 +87,18 @@ def _start_cluster():
             raise
 
 
-def _remove_node_before_join(slave_ip):
+def _remove_node_before_join(master_ip, slave_ip, instance):
     ctx.logger.debug(
         'Trying to remove the slave from the cluster, in case this '
         'is a healing workflow'
     )
     # Ignoring the errors, because maybe the node was already removed
-    execute_and_log([
-        'cfy', 'cluster', 'nodes', 'remove', slave_ip
-    ], no_log=True, ignore_errors=True)
+    try:
+        get_backend(master_ip, instance).remove_cluster_node(slave_ip)
+    except CommandExecutionException as e:
+        ctx.logger.debug(
+            'Failed removing {0} from the cluster: {1}'.format(slave_ip, e)
+        )
 
 
 def _update_cluster_profile():
@@ -76,31 +115,143 @@ def _run_join_command(master_profile, slave_config):
     ])
 
 
-def _join_cluster(master_ip, slave_config):
+def _join_slave(master_ip, master_profile, slave_config, instance):
+    """
+    Join a single slave to the cluster. The master's profile should already
+    be updated with the current cluster nodes
+    """
     slave_ip = slave_config['public_ip']
     ctx.logger.info('Slave {0} is joining the cluster'.format(slave_ip))
+    _remove_node_before_join(master_ip, slave_ip, instance)
+
+    with profile(slave_ip, instance):
+        try:
+            _run_join_command(master_profile, slave_config)
+        except CommandExecutionException as e:
+            # This is a somewhat expected bug when joining a cluster
+            if "Node joined the cluster" in e.error and \
+                    "'NoneType' object has " \
+                    "no attribute 'append'" in e.error:
+                return
+            raise
+    ctx.logger.info('Slave {0} joined the cluster'.format(slave_ip))
+
+
+def _set_joined(instance, manager_ips, joined=True):
+    """
+    Keep track of the managers that are part of the cluster, so that the
+    `join_cluster` relationship operations can skip them
+    """
+    joined_managers = set(
+        instance.runtime_properties.get('joined_managers', [])
+    )
+    if joined:
+        joined_managers.update(manager_ips)
+    else:
+        joined_managers.difference_update(manager_ips)
+    instance.runtime_properties['joined_managers'] = sorted(joined_managers)
+
+
+def _join_cluster(master_ip, slave_config):
+    """
+    Join a single slave to the cluster (e.g. when healing it)
+    """
+    instance = ctx.source.instance
+    _wait_for_cluster(master_ip, instance)
 
-    with profile(master_ip, ctx.source.instance) as master_profile:
-        _remove_node_before_join(slave_ip)
+    with profile(master_ip, instance) as master_profile:
         _update_cluster_profile()
+        try:
+            _join_slave(master_ip, master_profile, slave_config, instance)
+        except CommandExecutionException as e:
+            ctx.logger.debug(
+                'Caught the following error during join: {0}'.format(e)
+            )
+            return ctx.operation.retry(
+                'Could not join the cluster. Retrying...',
+                retry_after=5
+            )
+    _set_joined(instance, [slave_config['public_ip']])
+    instance.update()
+
 
-        with profile(slave_ip, ctx.source.instance):
+def _join_slaves(master_ip):
+    """
+    Join all the slaves that weren't joined yet to the cluster, with up to
+    `join_concurrency` of them joining at the same time. Managers needed to
+    fill the pool of `standby_managers` are kept out of the cluster
+    """
+    managers, _ = get_config(ctx.instance.runtime_properties)
+    joined_managers = ctx.instance.runtime_properties.get(
+        'joined_managers', []
+    )
+    candidates = [
+        manager_ip for manager_ip in sorted(managers)
+        if manager_ip != master_ip and manager_ip not in joined_managers and
+        manager_ip not in get_standbys(ctx.instance)
+    ]
+    standbys = fill_pool(
+        ctx.instance,
+        candidates,
+        cluster_property('standby_managers', DEFAULT_STANDBY_MANAGERS)
+    )
+    if standbys:
+        ctx.logger.info(
+            'Keeping {0} as standby managers'.format(', '.join(standbys))
+        )
+        ctx.instance.update()
+
+    slaves = [
+        managers[manager_ip] for manager_ip in candidates
+        if manager_ip not in standbys
+    ]
+    if not slaves:
+        return
+
+    concurrency = cluster_property(
+        'join_concurrency', DEFAULT_JOIN_CONCURRENCY
+    )
+    ctx.logger.info(
+        'Joining {0} slaves to the cluster ({1} at a time)...'.format(
+            len(slaves), concurrency
+        )
+    )
+    _wait_for_cluster(master_ip, ctx.instance)
+
+    with profile(master_ip) as master_profile:
+        # The profile is updated once, for all the slaves
+        _update_cluster_profile()
+
+        def _join(slave_config):
             try:
-                _run_join_command(master_profile, slave_config)
-            except CommandExecutionException as e:
-                # This is a somewhat expected bug when joining a cluster
-                if "Node joined the cluster" in e.error and \
-                        "'NoneType' object has " \
-                        "no attribute 'append'" in e.error:
-                    return
-                ctx.logger.debug(
-                    'Caught the following error during join: {0}'.format(e)
+                _join_slave(
+                    master_ip, master_profile, slave_config, ctx.instance
                 )
-                return ctx.operation.retry(
-                    'Could not join the cluster. Often this means that '
-                    'the cluster is not yet ready. Retrying...',
-                    retry_after=5
+            except CommandExecutionException as e:
+                return e
+
+        errors = run_concurrently(_join, slaves, concurrency)
+
+    failed = dict(
+        (config['public_ip'], error)
+        for config, error in zip(slaves, errors) if error
+    )
+    _set_joined(ctx.instance, [
+        config['public_ip'] for config in slaves
+        if config['public_ip'] not in failed
+    ])
+    ctx.instance.update()
+    if failed:
+        for slave_ip, error in failed.items():
+            ctx.logger.warning(
+                'Slave {0} failed joining the cluster: {1}'.format(
+                    slave_ip, error
                 )
+            )
+        # Only the slaves that failed will be joined on the retry
+        raise RecoverableError(
+            'Could not join the cluster: {0}'.format(', '.join(failed))
+        )
 
 
 def _get_small_config(manager_config):
@@ -113,35 +264,79 @@ def _get_small_config(manager_config):
     }
 
 
-def _wait_for_manager(master_ip):
+def _wait_until_ready(check, description, required_successes):
     """
-    We're waiting until 3 successive successful attempt to connect to the
-    manager has been made, to make sure that the manager has finished
-    rebooting (in a restore-certificates scenario), etc.
+    Call `check` (with the timeout of a single attempt) until it succeeds
+    `required_successes` times in a row. Failed attempts are retried with
+    an exponential (jittered) backoff, for up to `readiness_timeout` seconds.
+    Return the number of seconds it took
     """
-    ctx.logger.info('Waiting for the manager to become responsive...')
-
+    timeout = cluster_property('readiness_timeout', DEFAULT_READINESS_TIMEOUT)
+    started = time.time()
+    deadline = started + timeout
     successes = 0
-    retries = 0
-    retry_delay = 1
+    attempts = 0
+    interval = MIN_PROBE_INTERVAL
 
-    while successes < 3:
-        retries += 1
+    while True:
+        attempts += 1
         try:
-            with profile(master_ip):
-                execute_and_log(['cfy', 'status'], no_log=True)
-                successes += 1
+            check(max(min(PROBE_TIMEOUT, deadline - time.time()), 1))
+            successes += 1
+            interval = MIN_PROBE_INTERVAL
+            delay = interval
         except CommandExecutionException as e:
-            ctx.logger.debug('cfy status/use failed with: {0}'.format(e))
+            ctx.logger.debug('{0} check failed with: {1}'.format(
+                description, e
+            ))
             successes = 0
-        sleep(retry_delay)
+            interval = min(interval * 2, MAX_PROBE_INTERVAL)
+            delay = random.uniform(interval / 2.0, interval)
 
-        if retries == 30:
+        if successes >= required_successes:
+            break
+        if time.time() + delay >= deadline:
             raise NonRecoverableError(
-                'Manager on IP {0} is not responsive'.format(master_ip)
+                '{0} is not responsive after {1} seconds ({2} '
+                'attempts)'.format(description, timeout, attempts)
             )
+        time.sleep(delay)
+
+    ready_after = time.time() - started
+    ctx.logger.info(
+        '{0} is up and running after {1:.1f} seconds ({2} '
+        'attempts)'.format(description, ready_after, attempts)
+    )
+    return ready_after
+
+
+def _wait_for_manager(master_ip):
+    """
+    We're waiting until `readiness_successes` successive successful attempts
+    to connect to the manager have been made, to make sure that the manager
+    has finished rebooting (in a restore-certificates scenario), etc.
+    """
+    ctx.logger.info('Waiting for the manager to become responsive...')
+    backend = get_backend(master_ip)
+    return _wait_until_ready(
+        backend.probe,
+        'Manager on IP {0}'.format(master_ip),
+        cluster_property('readiness_successes', DEFAULT_READINESS_SUCCESSES)
+    )
 
-    ctx.logger.info('Manager is up and running after restore')
+
+def _wait_for_cluster(master_ip, instance):
+    """
+    Wait for the cluster to be running on the leader before joining slaves
+    to it, instead of retrying the joins until it is
+    """
+    ctx.logger.info('Waiting for the cluster leader to become ready...')
+    backend = get_backend(master_ip, instance)
+    return _wait_until_ready(
+        lambda _: backend.cluster_status(),
+        'Cluster leader {0}'.format(master_ip),
+        1
+    )
 
 
 @operation
@@ -151,29 +346,46 @@ def start_cluster(**_):
     1. Create the CLI profiles for each of the Tier 1 managers
     2. Start the cluster on the master node (the first manager in the list)
     3. Perform upgrade from a previous deployment, if relevant
+    4. Join all the other managers to the cluster, as slaves
 
     This runs in the `start` operation of the default lifecycle of the
-    `cloudify_cluster` node
+    `cloudify_cluster` node. The stages that were completed are recorded in
+    the runtime properties, so that when the operation is retried (e.g. as
+    a slave failed joining), they aren't run again
     """
     config = UpgradeConfig()
     config.validate()
 
-    ctx.instance.runtime_properties['ca_cert'] = inputs['ca_cert']
+    runtime_props = ctx.instance.runtime_properties
+    runtime_props['ca_cert'] = inputs['ca_cert']
     ctx.instance.update()
 
-    if config.restore:
-        master_ip, _ = _get_master_config()
+    master_ip, master_config = _get_master_config()
+    if config.restore and not runtime_props.get(RESTORED):
         restore(master_ip, config)
         _wait_for_manager(master_ip)
+        runtime_props[RESTORED] = True
+        ctx.instance.update()
 
-    _start_cluster()
+    if runtime_props.get(CLUSTER_STARTED):
+        ctx.logger.info(
+            'The cluster was already started on {0}, only joining the '
+            'remaining slaves'.format(master_ip)
+        )
+    else:
+        _start_cluster(master_ip, master_config)
+        _set_joined(ctx.instance, [master_ip])
+        runtime_props[CLUSTER_STARTED] = True
+        ctx.instance.update()
+    _join_slaves(master_ip)
 
 
 @operation
 def join_cluster(**_):
     """
     Join the cluster created in the `start_cluster` if you're a slave.
-    If you're the master, do nothing
+    If you're the master, or were already joined by `start_cluster`, do
+    nothing (so this only joins managers that are being healed)
 
     This runs in a relationship where CloudifyManager is the target and
     CloudifyCluster the source
@@ -181,6 +393,26 @@ def join_cluster(**_):
     manager_runtime_props = ctx.target.instance.runtime_properties
     manager_ip = manager_runtime_props['manager_ip']
 
+    if is_rebuilding(ctx.source.instance, manager_ip):
+        set_rebuilding(ctx.source.instance, manager_ip, rebuilding=False)
+        add_standby(ctx.source.instance, manager_ip)
+        ctx.source.instance.update()
+        ctx.logger.info(
+            'Manager {0} was replaced in the cluster by a standby manager, '
+            'and is now a standby manager itself'.format(manager_ip)
+        )
+        return
+
+    joined_managers = ctx.source.instance.runtime_properties.get(
+        'joined_managers', []
+    )
+    if manager_ip in joined_managers:
+        ctx.logger.info(
+            'Manager {0} is already part of the cluster, '
+            'nothing to do'.format(manager_ip)
+        )
+        return
+
     try:
         current_master = get_current_master(ctx.source.instance)
     except RecoverableError as e:
@@ -209,6 +441,87 @@ def join_cluster(**_):
         return _join_cluster(current_master, manager_config)
 
 
+def _get_manager_ip(node_instance_id):
+    managers, _ = get_config(ctx.instance.runtime_properties)
+    for manager_ip, manager_config in managers.items():
+        if manager_config.get('node_instance_id') == node_instance_id:
+            return manager_ip
+
+
+@operation
+def promote_standby(**_):
+    """
+    Replace a failed manager in the cluster with a manager from the standby
+    pool (if there is one), so that the cluster doesn't have to wait for the
+    failed manager to be rebuilt. The failed manager is then rebuilt by the
+    rest of the heal workflow, and becomes a standby itself
+
+    This runs at the beginning of the `heal_tier1_manager` workflow
+    """
+    failed_instance_id = inputs['failed_instance_id']
+    failed_ip = _get_manager_ip(failed_instance_id)
+    if not failed_ip:
+        # Managers that were added before standbys were supported
+        ctx.logger.warning(
+            'Could not find the manager of node instance {0}, not using a '
+            'standby manager'.format(failed_instance_id)
+        )
+        return
+
+    if remove_standby(ctx.instance, failed_ip):
+        ctx.logger.info(
+            'The failed manager {0} is a standby manager, it will return '
+            'to the standby pool once it is rebuilt'.format(failed_ip)
+        )
+        set_rebuilding(ctx.instance, failed_ip)
+        ctx.instance.update()
+        return
+
+    standby_ip = pop_standby(ctx.instance)
+    if not standby_ip:
+        ctx.logger.info(
+            'There are no standby managers, the failed manager {0} will '
+            'rejoin the cluster once it is rebuilt'.format(failed_ip)
+        )
+        return
+
+    ctx.logger.info(
+        'Replacing the failed manager {0} with the standby manager '
+        '{1}'.format(failed_ip, standby_ip)
+    )
+    managers, _ = get_config(ctx.instance.runtime_properties)
+    # The cached leader is often the manager that just failed
+    invalidate_cached_master(failed_ip)
+    try:
+        master_ip = get_current_master()
+        _wait_for_cluster(master_ip, ctx.instance)
+        with profile(master_ip) as master_profile:
+            _remove_node_before_join(master_ip, failed_ip, ctx.instance)
+            _update_cluster_profile()
+            _join_slave(
+                master_ip, master_profile, managers[standby_ip], ctx.instance
+            )
+    except (CommandExecutionException,
+            RecoverableError,
+            NonRecoverableError) as e:
+        # E.g. the cluster is still failing over from the failed manager.
+        # The failed manager will rejoin the cluster once it is rebuilt,
+        # as if there was no standby
+        ctx.logger.warning(
+            'Standby manager {0} failed joining the cluster: {1}'.format(
+                standby_ip, e
+            )
+        )
+        add_standby(ctx.instance, standby_ip)
+        ctx.instance.update()
+        return
+
+    _set_joined(ctx.instance, [standby_ip])
+    _set_joined(ctx.instance, [failed_ip], joined=False)
+    set_rebuilding(ctx.instance, failed_ip)
+    ctx.instance.update()
+
+
 @operation
 def add_manager_config(**_):
     """
@@ -222,6 +535,7 @@ def add_manager_config(**_):
 
     full_config = ctx.target.instance.runtime_properties['config']
     config = _get_small_config(full_config)
+    config['node_instance_id'] = ctx.target.instance.id
     manager_ip = config['public_ip']
 
     ctx.logger.info('Adding new manager config: `{0}`'.format(manager_ip))
@@ -235,6 +549,8 @@ def add_manager_config(**_):
 
     managers[manager_ip] = config
     ctx.source.instance.runtime_properties['managers'] = managers
+    # A (re)installed manager needs to join the cluster
+    _set_joined(ctx.source.instance, [manager_ip], joined=False)
     ctx.source.instance.update()
     ctx.logger.debug('Full list of managers:\n{0}'.format(managers))
 
@@ -258,4 +574,9 @@ def clear_data(**_):
 
     # Clear the configuration from the cluster's runtime properties
     ctx.instance.runtime_properties.pop('managers', None)
+    ctx.instance.runtime_properties.pop('joined_managers', None)
+    ctx.instance.runtime_properties.pop('standby_managers', None)
+    ctx.instance.runtime_properties.pop('rebuilding_managers', None)
+    ctx.instance.runtime_properties.pop(RESTORED, None)
+    ctx.instance.runtime_properties.pop(CLUSTER_STARTED, None)
     ctx.instance.update()
@@ -0,0 +1,401 @@
+"""
+Resumable download of snapshot archives from a Tier 1 manager.
+
+The archive is downloaded in fixed size segments (using HTTP range requests)
+into a `.part` file, and the segments that were already written are recorded
+in a state file next to it. If the download is interrupted, the next attempt
+only downloads the missing segments. Segments can be downloaded in parallel,
+and the total bandwidth used by all of them can be capped.
+
+When a previous snapshot of the deployment is in the store, the download is
+incremental: the central directory of the new archive is downloaded first,
+and the members that did not change since the previous snapshot are copied
+from the store, so only the changed members are downloaded.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+import zipfile
+
+import requests
+
+from cloudify import ctx
+from cloudify.exceptions import NonRecoverableError
+
+from ..common import run_concurrently
+from .backend import CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT
+from .snapshot_store import member_key
+
+PART_SUFFIX = '.part'
+STATE_SUFFIX = '.state'
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+SEGMENT_RETRIES = 3
+
+# The end of central directory record is in the last TAIL_SIZE bytes of
+# the archive (including the longest possible comment)
+TAIL_SIZE = zipfile.sizeEndCentDir + 0xffff
+# Members smaller than that are downloaded rather than copied from the
+# store, to avoid fragmenting the download into many small requests
+MIN_REUSE_SIZE = 1024 * 1024
+
+# Report the progress every PROGRESS_STEP percent
+PROGRESS_STEP = 10
+
+
+class RateLimiter(object):
+    """
+    A token bucket shared by all the threads of a download, so that their
+    combined rate does not exceed `max_rate` bytes per second
+    """
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self._allowance = max_rate
+        self._last_check = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        if not self.max_rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._allowance = min(
+                self.max_rate,
+                self._allowance + (now - self._last_check) * self.max_rate
+            )
+            self._last_check = now
+            self._allowance -= size
+            delay = -self._allowance / self.max_rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _split(ranges):
+    """
+    Split the (start, end) ranges into segments of up to SEGMENT_SIZE
+    """
+    segments = []
+    for start, end in ranges:
+        segments += [
+            (segment_start, min(segment_start + SEGMENT_SIZE, end))
+            for segment_start in range(start, end, SEGMENT_SIZE)
+        ]
+    return segments
+
+
+class _Download(object):
+    def __init__(self, client, uri, part_path, size, max_rate, ranges=None):
+        """
+        :param ranges: The (start, end) ranges of the archive to download.
+            Defaults to all of it
+        """
+        self.client = client
+        self.uri = uri
+        self.part_path = part_path
+        self.state_path = part_path + STATE_SUFFIX
+        self.size = size
+        if ranges is None:
+            ranges = [(0, size)]
+        self.segments = dict(_split(ranges))
+        self.total = sum(end - start for start, end in self.segments.items())
+        self.rate_limiter = RateLimiter(max_rate)
+        self.done = self._load_state()
+        self.downloaded = sum(self._segment_size(start) for start in self.done)
+        self._reported = 0
+        self._lock = threading.Lock()
+
+    def _segment_size(self, start):
+        return self.segments[start] - start
+
+    def _load_state(self):
+        if not os.path.isfile(self.part_path) or \
+                not os.path.isfile(self.state_path):
+            return set()
+        with open(self.state_path) as f:
+            state = json.load(f)
+        if state['size'] != self.size or \
+                dict(state.get('segments', [])) != self.segments:
+            # A different archive was downloaded into the same path
+            return set()
+        return set(state['done'])
+
+    def _save_state(self):
+        temp_path = '{0}.{1}'.format(self.state_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump({
+                'size': self.size,
+                'segments': sorted(self.segments.items()),
+                'done': sorted(self.done)
+            }, f)
+        os.rename(temp_path, self.state_path)
+
+    def _report_progress(self, size):
+        with self._lock:
+            self.downloaded += size
+            percent = 100 * self.downloaded // self.total
+            if percent - self._reported < PROGRESS_STEP:
+                return
+            self._reported = percent
+        ctx.logger.info('Downloaded {0}% of {1} MB'.format(
+            percent, self.total // (1024 * 1024)
+        ))
+
+    def _download_segment(self, start):
+        written = [0]
+
+        def progress(size):
+            written[0] += size
+            self._report_progress(size)
+
+        try:
+            _download_range(
+                self.client,
+                self.uri,
+                self.part_path,
+                start,
+                self.segments[start],
+                rate_limiter=self.rate_limiter,
+                progress=progress
+            )
+        except Exception:
+            # The segment will be downloaded again from its start
+            self._report_progress(-written[0])
+            raise
+
+    def download_segment(self, start):
+        for retry in range(1, SEGMENT_RETRIES + 1):
+            try:
+                self._download_segment(start)
+                break
+            except requests.exceptions.RequestException as e:
+                ctx.logger.warning(
+                    'Failed downloading segment at {0} [retry {1}/{2}]: '
+                    '{3}'.format(start, retry, SEGMENT_RETRIES, e)
+                )
+                if retry == SEGMENT_RETRIES:
+                    raise
+        with self._lock:
+            self.done.add(start)
+            self._save_state()
+
+    def run(self, concurrency):
+        _create_part_file(self.part_path, self.size)
+        missing = sorted(
+            start for start in self.segments if start not in self.done
+        )
+        if len(missing) < len(self.segments):
+            ctx.logger.info('Resuming the download: {0}/{1} segments '
+                            'left'.format(len(missing), len(self.segments)))
+        run_concurrently(self.download_segment, missing, concurrency)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+
+def _create_part_file(part_path, size):
+    """
+    Create the (sparse) partial file, unless a previous download of the
+    same size is already in it
+    """
+    if not os.path.isfile(part_path) or \
+            os.path.getsize(part_path) != size:
+        with open(part_path, 'wb') as f:
+            f.truncate(size)
+
+
+def _download_range(client,
+                    uri,
+                    part_path,
+                    start,
+                    end,
+                    rate_limiter=None,
+                    progress=None):
+    """
+    Download the bytes in [start, end) of the archive into the same offset
+    of the partial file
+    """
+    response = client._client.get(
+        uri,
+        headers={'Range': 'bytes={0}-{1}'.format(start, end - 1)},
+        expected_status_code=206,
+        stream=True,
+        # A stalled segment should fail (and be retried), not hang
+        timeout=(CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)
+    )
+    written = 0
+    try:
+        with open(part_path, 'r+b') as f:
+            f.seek(start)
+            for chunk in response.bytes_stream(CHUNK_SIZE):
+                if rate_limiter:
+                    rate_limiter.consume(len(chunk))
+                f.write(chunk)
+                written += len(chunk)
+                if progress:
+                    progress(len(chunk))
+        if written != end - start:
+            raise requests.exceptions.ConnectionError(
+                'Segment {0}-{1} ended prematurely'.format(start, end - 1)
+            )
+    finally:
+        response.close()
+
+
+def _archive_size(client, uri):
+    """
+    Return the size of the archive, or None if the server does not support
+    range requests
+    """
+    http_client = client._client
+    headers = http_client.headers.copy()
+    headers['Range'] = 'bytes=0-0'
+    # The request is sent through the session directly, as the client
+    # would read the whole archive into memory on an unexpected status code
+    response = http_client._session.get(
+        http_client.url + uri,
+        headers=headers,
+        verify=http_client.get_request_verify(),
+        stream=True,
+        timeout=(CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)
+    )
+    response.close()
+    if response.status_code == 200:
+        return None
+    elif response.status_code != 206:
+        http_client._raise_client_error(response, uri)
+    return int(response.headers['Content-Range'].rsplit('/', 1)[1])
+
+
+def _gaps(ranges, size):
+    """
+    Return the ranges of [0, size) that are not covered by `ranges`
+    """
+    gaps = []
+    position = 0
+    for start, end in sorted(ranges):
+        if start > position:
+            gaps.append((position, start))
+        position = max(position, end)
+    if position < size:
+        gaps.append((position, size))
+    return gaps
+
+
+def _reuse_members(client, uri, part_path, size, base):
+    """
+    Download the central directory of the archive, copy the members that
+    did not change since the `base` snapshot from the store, and return the
+    ranges of the archive that are left to download
+    :param base: The `StoredSnapshot` to take the members from
+    """
+    _create_part_file(part_path, size)
+    tail_start = max(size - TAIL_SIZE, 0)
+    _download_range(client, uri, part_path, tail_start, size)
+    with open(part_path, 'rb') as f:
+        end_record = zipfile._EndRecData(f)
+    if not end_record:
+        raise zipfile.BadZipfile('End of central directory not found')
+    directory_start = end_record[zipfile._ECD_OFFSET]
+    if directory_start < tail_start:
+        _download_range(client, uri, part_path, directory_start, tail_start)
+    fetched = [(min(directory_start, tail_start), size)]
+
+    with zipfile.ZipFile(part_path) as archive:
+        infos = sorted(archive.infolist(), key=lambda i: i.header_offset)
+    boundaries = [info.header_offset for info in infos[1:]] + \
+        [directory_start]
+    reused_size = 0
+    with open(part_path, 'r+b') as f:
+        for info, boundary in zip(infos, boundaries):
+            member = base.members.get(info.filename)
+            if not member or member['key'] != member_key(info):
+                continue
+            length = member['end'] - member['start']
+            if length < MIN_REUSE_SIZE or \
+                    info.header_offset + length > boundary:
+                continue
+            f.seek(info.header_offset)
+            base.copy_range(member['start'], member['end'], f)
+            fetched.append((info.header_offset, info.header_offset + length))
+            reused_size += length
+
+    ctx.logger.info(
+        'Reusing {0} MB out of {1} MB from snapshot {2}'.format(
+            reused_size // (1024 * 1024),
+            size // (1024 * 1024),
+            base.snapshot_id
+        )
+    )
+    return _gaps(fetched, size)
+
+
+def download_snapshot(client,
+                      snapshot_id,
+                      part_path,
+                      max_rate=None,
+                      concurrency=1,
+                      base=None):
+    """
+    Download the archive of a snapshot into `part_path`, resuming a previous
+    download into the same path if there was one
+    :param client: A `CloudifyClient`
+    :param max_rate: The maximum bandwidth to use, in bytes per second
+    :param concurrency: How many segments to download at the same time
+    :param base: A `StoredSnapshot` to download the archive incrementally
+        against
+    """
+    uri = '/snapshots/{0}/archive'.format(snapshot_id)
+    size = _archive_size(client, uri)
+    if size is None:
+        ctx.logger.warning(
+            'The manager does not support range requests, so the download '
+            'of snapshot {0} cannot be resumed'.format(snapshot_id)
+        )
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        with client._client.read_timeout(DOWNLOAD_READ_TIMEOUT):
+            client.snapshots.download(snapshot_id, part_path)
+        return
+    ranges = None
+    if base and base.members:
+        try:
+            ranges = _reuse_members(client, uri, part_path, size, base)
+        except (IOError, OSError, zipfile.BadZipfile) as e:
+            ctx.logger.warning(
+                'Could not download snapshot {0} incrementally, downloading '
+                'all of it: {1}'.format(snapshot_id, e)
+            )
+    _Download(
+        client, uri, part_path, size, max_rate, ranges=ranges
+    ).run(concurrency)
+
+
+def verify_archive(path):
+    """
+    Check the CRC of every member of the downloaded zip archive, and return
+    its SHA256 checksum
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            bad_member = archive.testzip()
+    except zipfile.BadZipfile as e:
+        raise NonRecoverableError(
+            'Downloaded snapshot {0} is corrupted: {1}'.format(path, e)
+        )
+    if bad_member:
+        raise NonRecoverableError(
+            'Downloaded snapshot {0} is corrupted: bad CRC for '
+            '{1}'.format(path, bad_member)
+        )
+    return file_checksum(path)
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,79 @@
+"""
+Run the same call against all the managers of a Tier 1 cluster at once.
+"""
+
+import time
+
+from cloudify import ctx
+
+from ..common import submit, CommandTimeoutException, KILL_GRACE_PERIOD
+from .utils import get_config
+from .backend import get_backend
+
+DEFAULT_FAN_OUT_TIMEOUT = 30
+
+
+def _call_on_manager(func, description, manager_ip, instance, timeout,
+                     deadline):
+    backend = get_backend(manager_ip, instance)
+    # The call is given whatever is left until the deadline, so that it
+    # gives up (or its command is killed) when the deadline expires, and
+    # isn't just abandoned
+    time_left = deadline - time.time()
+    if time_left <= 0:
+        raise CommandTimeoutException(description, timeout, '')
+    return func(backend, time_left)
+
+
+def fan_out(func, description, instance=None, timeout=None):
+    """
+    Call `func(backend, timeout)` with the backend of each of the managers
+    in the `managers` config concurrently, and gather the results.
+    Return a tuple of two dicts, mapping the IPs of the managers to the
+    results of the calls, and to the errors they failed with
+    :param description: What the call does, for the logs and errors
+    :param instance: The cluster node instance holding the `managers` config
+    :param timeout: How long (in seconds) to wait for each of the managers.
+        `func` is passed the time left until then, to pass on to the backend
+    """
+    instance = instance or ctx.instance
+    managers, _ = get_config(instance.runtime_properties)
+    timeout = timeout or DEFAULT_FAN_OUT_TIMEOUT
+    # All the managers are started at the same time, so they all share
+    # the same deadline
+    deadline = time.time() + timeout
+
+    futures = dict(
+        (manager_ip, submit(
+            _call_on_manager,
+            func,
+            description,
+            manager_ip,
+            instance,
+            timeout,
+            deadline
+        ))
+        for manager_ip in managers
+    )
+
+    results = {}
+    errors = {}
+    for manager_ip, future in futures.items():
+        future.description = '{0} [{1}]'.format(description, manager_ip)
+        try:
+            # Give the timed out commands (with the CLI backend) time to be
+            # killed, so that their own timeout errors are reported
+            results[manager_ip] = future.result(
+                max(deadline - time.time(), 0) + 2 * KILL_GRACE_PERIOD
+            )
+        except Exception as e:
+            # A failure of one manager shouldn't affect the others
+            errors[manager_ip] = e
+
+    for manager_ip, error in errors.items():
+        ctx.logger.warning(
+            '`{0}` failed on manager {1}: {2}'.format(
+                description, manager_ip, error
+            )
+        )
+    return results, errors
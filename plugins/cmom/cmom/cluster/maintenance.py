@@ -1,5 +1,7 @@
 import os
-from time import sleep
+import shutil
+import tempfile
+from time import sleep, time
 from datetime import datetime
 
 from cloudify import ctx
@@ -8,55 +10,162 @@ from cloudify.state import ctx_parameters as inputs
 from cloudify.exceptions import NonRecoverableError, CommandExecutionException
 
 from .utils import execute_and_log
+from .backend import get_backend
+from .fanout import fan_out
 from .profile import profile, get_current_master
+from .download import PART_SUFFIX, STATE_SUFFIX, verify_archive
+from .snapshot_store import SnapshotStore, manifest_path, load_manifest
 
 SNAPSHOTS_FOLDER = 'snapshots'
 RESTORE_SNAP_ID = 'restored_snapshot'
+BACKUP_IN_PROGRESS = 'backup_in_progress'
 
+# The executions are polled with an exponential backoff, so that short
+# executions are noticed quickly, and long ones aren't polled needlessly
+MIN_POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 30
 
-def _snapshots_dir(deployment_id=None):
-    deployment_id = deployment_id or ctx.deployment.id
+# The snapshot timeouts are derived from the size of the snapshot: a fixed
+# minimum, plus SNAPSHOT_SECONDS_PER_MB for every MB of the snapshot
+MIN_CREATE_TIMEOUT = 300
+MIN_RESTORE_TIMEOUT = 1000
+SNAPSHOT_SECONDS_PER_MB = 1
+
+
+def _base_snapshots_dir():
     base_snapshots_dir = os.path.expanduser('~/{0}'.format(SNAPSHOTS_FOLDER))
     if not os.path.isdir(base_snapshots_dir):
         os.mkdir(base_snapshots_dir)
-    dep_snapshots_dir = os.path.join(base_snapshots_dir, deployment_id)
+    return base_snapshots_dir
+
+
+def _snapshots_dir(deployment_id=None):
+    deployment_id = deployment_id or ctx.deployment.id
+    dep_snapshots_dir = os.path.join(_base_snapshots_dir(), deployment_id)
     if not os.path.isdir(dep_snapshots_dir):
         os.mkdir(dep_snapshots_dir)
     return dep_snapshots_dir
 
 
-def _is_snapshot_created(snapshot_id):
-    snapshots = execute_and_log(['cfy', 'snapshots', 'list'], is_json=True)
-    for snapshot in snapshots:
-        if snapshot['id'] == snapshot_id and snapshot['status'] == 'created':
-            return True
-    return False
+def _snapshot_timeout(min_timeout, snapshot_size):
+    return min_timeout + \
+        SNAPSHOT_SECONDS_PER_MB * snapshot_size // (1024 * 1024)
 
 
-def _create_snapshot(snapshot_id, create_snap_params):
-    execute_and_log(
-        ['cfy', 'snapshots', 'create', snapshot_id] + create_snap_params,
-    )
-    ctx.logger.info('Waiting for the snapshot to be created...')
-    snapshot_created = False
-    for retry in range(1, 101):
-        ctx.logger.info(
-            'Waiting for the snapshot to be created [retry {0}/100]'.format(
-                retry
+def _snapshots():
+    """
+    Return a list of (creation time, size, path) tuples of the snapshots
+    downloaded for this deployment, latest first
+    """
+    snapshots_dir = _snapshots_dir()
+    snapshots = []
+    for name in os.listdir(snapshots_dir):
+        path = os.path.join(snapshots_dir, name)
+        if name.endswith('.zip'):
+            snapshots.append(
+                (os.path.getmtime(path), os.path.getsize(path), path)
             )
-        )
+        elif name.endswith('.json'):
+            manifest = load_manifest(path)
+            snapshots.append((manifest['created_at'], manifest['size'], path))
+    return sorted(snapshots, reverse=True)
+
+
+def _last_snapshot_size():
+    """
+    Return the size of the latest snapshot downloaded for this deployment,
+    as an estimate of the size of the next one
+    """
+    snapshots = _snapshots()
+    if not snapshots:
+        return 0
+    return snapshots[0][1]
+
+
+def _base_snapshot():
+    """
+    Return the latest snapshot in the store, to download the next one
+    incrementally against, or None if there isn't one
+    """
+    for _, _, path in _snapshots():
+        if path.endswith('.json'):
+            return SnapshotStore(_base_snapshots_dir()).open_snapshot(path)
+    return None
+
+
+def _fresh_snapshot(max_age):
+    """
+    Return the path of the latest snapshot if it was downloaded less than
+    `max_age` seconds ago, or None otherwise
+    """
+    snapshots = _snapshots()
+    if max_age and snapshots and time() - snapshots[0][0] < max_age:
+        return snapshots[0][2]
+    return None
+
+
+def _wait_for_execution(backend, execution_id, timeout, description):
+    """
+    Wait for an execution on the Tier 1 manager to end, by getting it by
+    its ID with an exponential backoff. Raise an error if the execution
+    failed, or did not end within `timeout` seconds
+    """
+    deadline = time() + timeout
+    interval = MIN_POLL_INTERVAL
+    while True:
+        try:
+            execution = backend.get_execution(execution_id)
+        except CommandExecutionException as e:
+            # The manager might be unavailable for a while (e.g. while
+            # restarting its services during a restore)
+            ctx.logger.debug(
+                'Failed getting execution {0}: {1}'.format(execution_id, e)
+            )
+            status = 'unknown'
+        else:
+            status = execution['status']
+            if status == 'terminated':
+                return
+            elif status in ('failed', 'cancelled'):
+                raise NonRecoverableError(
+                    'Failed {0}. Error:\n{1}'.format(
+                        description, execution.get('error')
+                    )
+                )
 
-        snapshot_created = _is_snapshot_created(snapshot_id)
-        if snapshot_created:
-            ctx.logger.info(
-                'Snapshot {0} created successfully'.format(snapshot_id)
+        remaining = deadline - time()
+        if remaining <= 0:
+            raise NonRecoverableError(
+                'Timed out {0} after {1} seconds'.format(description, timeout)
+            )
+        ctx.logger.info(
+            'Waiting for the execution {0} to end [status: {1}]'.format(
+                execution_id, status
             )
-            break
-        sleep(3)
-    if not snapshot_created:
-        raise NonRecoverableError(
-            'Could not create snapshot {0}'.format(snapshot_id)
         )
+        sleep(min(interval, remaining))
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+
+def _create_snapshot(backend, snapshot_id, create_snap_params):
+    """
+    Create the snapshot, or wait for the snapshot creation a previous
+    attempt of the backup started to end
+    """
+    timeout = _snapshot_timeout(MIN_CREATE_TIMEOUT, _last_snapshot_size())
+    execution_id = _backup_in_progress().get('execution_id')
+    if not execution_id:
+        execution_id = backend.create_snapshot(snapshot_id, create_snap_params)
+        _set_backup_in_progress(snapshot_id, execution_id)
+
+    ctx.logger.info('Waiting for the snapshot to be created...')
+    _wait_for_execution(
+        backend,
+        execution_id,
+        timeout,
+        'creating snapshot {0}'.format(snapshot_id)
+    )
+    ctx.logger.info('Snapshot {0} created successfully'.format(snapshot_id))
 
 
 class UpgradeConfig(object):
@@ -122,12 +231,43 @@ def _upload_snapshot(config):
     ])
 
 
-def _download_snapshot(snapshot_id, output_path):
-    execute_and_log([
-        'cfy', 'snapshots',
-        'download', snapshot_id,
-        '-o', output_path
-    ])
+def _download_snapshot(backend, snapshot_id, part_path, base=None):
+    """
+    Download the snapshot into a partial file, and add it to the snapshots
+    store once its content was verified
+    :param base: A `StoredSnapshot` to download the snapshot incrementally
+        against
+    """
+    rate_limit = inputs.get('download_rate_limit')
+    backend.download_snapshot(
+        snapshot_id,
+        part_path,
+        max_rate=int(rate_limit * 1024 * 1024) if rate_limit else None,
+        concurrency=inputs.get('download_concurrency', 1),
+        base=base
+    )
+
+    try:
+        checksum = verify_archive(part_path)
+    except NonRecoverableError as e:
+        os.remove(part_path)
+        if not base:
+            raise
+        ctx.logger.warning(
+            'Incremental download of snapshot {0} failed verification, '
+            'downloading all of it: {1}'.format(snapshot_id, e)
+        )
+        return _download_snapshot(backend, snapshot_id, part_path)
+    ctx.logger.info(
+        'Snapshot {0} downloaded [sha256: {1}]'.format(snapshot_id, checksum)
+    )
+
+    output_path = manifest_path(_snapshots_dir(), snapshot_id)
+    SnapshotStore(_base_snapshots_dir()).add(
+        part_path, output_path, snapshot_id, checksum
+    )
+    os.remove(part_path)
+    return output_path
 
 
 def _transfer_agents(config):
@@ -168,32 +308,126 @@ def _get_backup_params():
     return backup_params
 
 
-@operation
-def backup(**_):
+def _backup_in_progress():
     """
-    Create a snapshot on a Tier 1 cluster, and download it to a dedicated
-    folder on the Tier 2 manager
+    Return the snapshot ID (and the ID of the execution creating it) of the
+    backup that is in progress, so that retrying the backup (or running it
+    again) resumes it, instead of starting another one
+    """
+    return ctx.instance.runtime_properties.get(BACKUP_IN_PROGRESS) or {}
+
+
+def _set_backup_in_progress(snapshot_id, execution_id=None):
+    if snapshot_id:
+        ctx.instance.runtime_properties[BACKUP_IN_PROGRESS] = {
+            'snapshot_id': snapshot_id,
+            'execution_id': execution_id
+        }
+    else:
+        ctx.instance.runtime_properties.pop(BACKUP_IN_PROGRESS, None)
+    ctx.instance.update()
+
+
+def _remove_stale_downloads(snapshots_dir, part_path):
+    """
+    Remove the partial files (and download states) of all the downloads in
+    `snapshots_dir` other than the one into `part_path`, as they will never
+    be resumed
+    """
+    part_name = os.path.basename(part_path)
+    for name in os.listdir(snapshots_dir):
+        if '.zip' + PART_SUFFIX not in name or name == part_name or \
+                name.startswith(part_name + STATE_SUFFIX):
+            continue
+        ctx.logger.info('Removing stale partial download {0}'.format(name))
+        os.remove(os.path.join(snapshots_dir, name))
+
+
+def _snapshot_id_in_progress():
+    """
+    Return the ID of the snapshot of a backup that did not finish (e.g. its
+    download was cut off), unless this backup is for another snapshot
     """
-    backup_params = _get_backup_params()
+    snapshot_id = inputs.get('snapshot_id')
+    in_progress_id = _backup_in_progress().get('snapshot_id')
+    if in_progress_id and snapshot_id in (None, '', in_progress_id):
+        ctx.logger.info(
+            'Resuming the backup of snapshot {0}'.format(in_progress_id)
+        )
+        return in_progress_id
+    return None
+
+
+def _new_snapshot_id(snapshots_dir):
     snapshot_id = inputs.get('snapshot_id')
     if not snapshot_id:
         now = datetime.now()
         snapshot_id = 'snap_{0}'.format(now.strftime('%Y_%m_%d_%H_%M_%S'))
 
-    output_path = os.path.join(
-        _snapshots_dir(),
-        '{0}.zip'.format(snapshot_id)
-    )
-    if os.path.exists(output_path):
+    zip_path = os.path.join(snapshots_dir, '{0}.zip'.format(snapshot_id))
+    if os.path.exists(zip_path) or \
+            os.path.exists(manifest_path(snapshots_dir, snapshot_id)):
         raise NonRecoverableError(
             'Snapshot with ID {0} already exists. Try a different name, '
             'or leave the `snapshot_id` parameter empty in order to create '
-            'a snapshot ID based on the current date and time'
+            'a snapshot ID based on the current date and time'.format(
+                snapshot_id
+            )
         )
+    _set_backup_in_progress(snapshot_id)
+    return snapshot_id
+
 
-    with profile(get_current_master()):
-        _create_snapshot(snapshot_id, backup_params)
-        _download_snapshot(snapshot_id, output_path)
+@operation
+def backup(**_):
+    """
+    Create a snapshot on a Tier 1 cluster, and download it to a dedicated
+    folder on the Tier 2 manager
+    """
+    backup_params = _get_backup_params()
+    snapshots_dir = _snapshots_dir()
+    snapshot_id = _snapshot_id_in_progress()
+    if not snapshot_id:
+        if not inputs.get('snapshot_id'):
+            fresh_snapshot = _fresh_snapshot(inputs.get('max_age', 0))
+            if fresh_snapshot:
+                ctx.logger.info(
+                    'Snapshot {0} is recent enough, not creating a new '
+                    'one'.format(fresh_snapshot)
+                )
+                return fresh_snapshot
+        snapshot_id = _new_snapshot_id(snapshots_dir)
+
+    output_path = manifest_path(snapshots_dir, snapshot_id)
+    part_path = os.path.join(
+        snapshots_dir, '{0}.zip{1}'.format(snapshot_id, PART_SUFFIX)
+    )
+    _remove_stale_downloads(snapshots_dir, part_path)
+    # The snapshot might have been stored by an attempt that failed later on
+    if not os.path.exists(output_path):
+        backend = get_backend(get_current_master())
+        try:
+            if os.path.exists(part_path):
+                ctx.logger.info(
+                    'Snapshot {0} was already created, resuming its '
+                    'download'.format(snapshot_id)
+                )
+            else:
+                _create_snapshot(backend, snapshot_id, backup_params)
+            base = _base_snapshot() if inputs.get('incremental', True) \
+                else None
+            _download_snapshot(backend, snapshot_id, part_path, base)
+        except NonRecoverableError:
+            # The snapshot failed, so the next backup starts a new one
+            _set_backup_in_progress(None)
+            raise
+
+    SnapshotStore(_base_snapshots_dir()).apply_retention(
+        snapshots_dir,
+        keep_daily=inputs.get('keep_daily', 0),
+        keep_weekly=inputs.get('keep_weekly', 0)
+    )
+    _set_backup_in_progress(None)
     return output_path
 
 
@@ -202,86 +436,98 @@ def restore(master_ip, config):
     Restore a snapshot on a Tier 1 cluster, and (optionally) upgrade the agents
     """
     # If the old deployment and snapshot ID were provided, calculate the
-    # path of snapshot from those variables
-    if not config.snapshot_path:
-        config.snapshot_path = os.path.join(
-            _snapshots_dir(config.old_deployment_id),
-            '{0}.zip'.format(config.snapshot_id)
-        )
-
-    with profile(master_ip):
-        _upload_snapshot(config)
-        _restore_snapshot(RESTORE_SNAP_ID, config.restore_params)
-        _transfer_agents(config)
+    # path of snapshot from those variables. Snapshots in the snapshots
+    # store are reassembled into a temporary folder, outside of the
+    # snapshots folders, so that it is never mistaken for a snapshot
+    temp_dir = None
+    try:
+        if not config.snapshot_path:
+            snapshots_dir = _snapshots_dir(config.old_deployment_id)
+            config.snapshot_path = os.path.join(
+                snapshots_dir,
+                '{0}.zip'.format(config.snapshot_id)
+            )
+            manifest = manifest_path(snapshots_dir, config.snapshot_id)
+            if not os.path.exists(config.snapshot_path) and \
+                    os.path.exists(manifest):
+                temp_dir = tempfile.mkdtemp(prefix='restore-')
+                config.snapshot_path = os.path.join(
+                    temp_dir, '{0}.zip'.format(config.snapshot_id)
+                )
+                SnapshotStore(_base_snapshots_dir()).extract(
+                    manifest, config.snapshot_path
+                )
 
+        with profile(master_ip):
+            _upload_snapshot(config)
+            _restore_snapshot(
+                get_backend(master_ip),
+                RESTORE_SNAP_ID,
+                config.restore_params,
+                os.path.getsize(config.snapshot_path)
+            )
+            _transfer_agents(config)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
-def _is_snapshot_restored(execution_id):
-    execution = execute_and_log(
-        ['cfy', 'executions', 'get', execution_id],
-        is_json=True, ignore_errors=True
-    )
-    if not execution:
-        return False
-    if execution['status'] == 'completed':
-        return True
-    elif execution['status'] == 'failed':
-        raise NonRecoverableError(
-            'Failed restoring snapshot. Error:\n{0}'.format(execution['error'])
-        )
-    return False
 
+def _restore_snapshot(backend, snapshot_id, restore_params, snapshot_size):
+    timeout = _snapshot_timeout(MIN_RESTORE_TIMEOUT, snapshot_size)
+    execution_id = backend.restore_snapshot(snapshot_id, restore_params)
 
-def _restore_snapshot(snapshot_id, restore_params):
-    output = execute_and_log(
-        ['cfy', 'snapshots', 'restore', snapshot_id] + restore_params
+    ctx.logger.info('Waiting for the snapshot to be restored...')
+    _wait_for_execution(
+        backend,
+        execution_id,
+        timeout,
+        'restoring snapshot {0}'.format(snapshot_id)
     )
-    execution_id = output.split("The execution's id is")[1].strip().split()[0]
+    ctx.logger.info('Snapshot {0} restored successfully'.format(snapshot_id))
 
-    ctx.logger.info('Waiting for the snapshot to be restored...')
-    snapshot_restored = False
-    for retry in range(1, 101):
-        ctx.logger.info(
-            'Waiting for the snapshot to be restored [retry {0}/100]'.format(
-                retry
-            )
-        )
 
-        snapshot_restored = _is_snapshot_restored(execution_id)
-        if snapshot_restored:
-            ctx.logger.info(
-                'Snapshot {0} created successfully'.format(snapshot_id)
-            )
-            break
-        sleep(10)
-    if not snapshot_restored:
-        raise NonRecoverableError(
-            'Could not restore snapshot {0}'.format(snapshot_id)
-        )
+def _managers_status():
+    """
+    Return the status of the services of every Tier 1 manager (standbys
+    included), or the error the status could not be retrieved with
+    """
+    results, errors = fan_out(
+        lambda backend, timeout: backend.manager_status(timeout=timeout),
+        'status'
+    )
+    managers_status = {}
+    for manager_ip, services in results.items():
+        for service in services:
+            service['service'] = service['service'].strip()
+        managers_status[manager_ip] = {'services': services, 'error': ''}
+    for manager_ip, error in errors.items():
+        managers_status[manager_ip] = {'services': [], 'error': str(error)}
+    return managers_status
 
 
 @operation
 def get_status(**_):
     error = ''
     try:
-        with profile(get_current_master()):
-            cluster_status = execute_and_log(
-                ['cfy', 'cluster', 'nodes', 'list'],
-                is_json=True
-            )
-            leader_status = execute_and_log(['cfy', 'status'], is_json=True)
-
-            # This is to fix a quirk in how the statuses are returned
-            # (with an alignment of 30 spaces)
-            for service in leader_status:
-                service['service'] = service['service'].strip()
+        backend = get_backend(get_current_master())
+        cluster_status = backend.cluster_nodes()
+        leader_status = backend.manager_status()
+
+        # This is to fix a quirk in how the statuses are returned by the CLI
+        # (with an alignment of 30 spaces)
+        for service in leader_status:
+            service['service'] = service['service'].strip()
+        managers_status = _managers_status()
     except NonRecoverableError as e:
         cluster_status = []
         leader_status = {}
+        managers_status = {}
         error = str(e)
 
     current_status = {
         'cluster_status': cluster_status,
         'leader_status': leader_status,
+        'managers_status': managers_status,
         'error': error
     }
     ctx.instance.runtime_properties['status'] = current_status
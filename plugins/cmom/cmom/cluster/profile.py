@@ -1,61 +1,115 @@
-from uuid import uuid4
+import os
+import re
+import time
+import Queue
+import fcntl
+import shutil
 from contextlib import contextmanager
 
 from cloudify import ctx
-from cloudify.exceptions import (
-    CommandExecutionException,
-    NonRecoverableError,
-    RecoverableError
+from cloudify.exceptions import CommandExecutionException, RecoverableError
+
+from .backend import get_backend
+from .standby import get_standbys
+from .utils import (
+    execute_and_log,
+    profile_workdir,
+    get_config,
+    cluster_property,
+    credentials_fingerprint,
+    get_cached_master,
+    cache_master,
+    invalidate_cached_master
 )
+from ..common import DEFAULT_TENANT, workdir, start_thread
 
-from .utils import execute_and_log
-from ..common import DEFAULT_TENANT
+# The pooled profiles themselves are kept in the CLI folder of the deployment
+# workdir. Each of them also gets its own CLI workdir under PROFILES_POOL,
+# in which it is the active profile, and which links back to the shared
+# profiles folder (so that commands like `cfy cluster join` can still refer
+# to other profiles by name)
+CLI_DIR = '.cloudify'
+PROFILES_POOL = 'profiles_pool'
+ACTIVE_PROFILE = 'active.profile'
+# The CLI reports REST errors as `An error occurred on the server: <error>`,
+# and the REST client prefixes the error with its HTTP status code
+AUTH_ERROR_PATTERN = re.compile(
+    r'^An error occurred on the server: 401: ', re.MULTILINE
+)
+FINGERPRINT_PATTERN = re.compile(r'^[0-9a-f]{12}$')
+DEFAULT_PROBE_TIMEOUT = 30
 
 
 def get_current_master(instance=None):
+    """
+    Return the IP of the current cluster leader. The leader is cached in the
+    deployment workdir for `leader_cache_ttl` seconds, and the cache is
+    invalidated whenever a command against the cached leader fails
+    """
+    cached_master = get_cached_master()
+    if cached_master:
+        ctx.logger.debug(
+            'Using the cached cluster leader: {0}'.format(cached_master)
+        )
+        return cached_master
+
     instance = instance or ctx.instance
     runtime_props = instance.runtime_properties
-    managers, ca_cert = get_config(runtime_props)
+    managers, _ = get_config(runtime_props)
 
-    cluster_profile = _get_cluster_profile(managers, instance)
-    with profile(cluster_profile, instance):
-        new_master = _get_cluster_master()
+    # Standby managers aren't part of the cluster
+    standbys = get_standbys(instance)
+    cluster_managers = [
+        manager_ip for manager_ip in managers if manager_ip not in standbys
+    ]
+    cluster_profile = _get_cluster_profile(cluster_managers, instance)
+    new_master = _get_cluster_master(cluster_profile, instance)
 
     _update_new_master(new_master, instance, managers)
+    cache_master(new_master)
     return new_master
 
 
 @contextmanager
-def profile(manager_ip=None, instance=None):
+def profile(manager_ip=None, instance=None, tenant=DEFAULT_TENANT):
+    """
+    Run the `cfy` commands in this block against `manager_ip` (the current
+    master by default), in the scope of `tenant`
+    """
     manager_ip = manager_ip or get_current_master(instance)
     instance = instance or ctx.instance
-    managers, _ = get_config(instance.runtime_properties)
-    temp_profile_name = None
+    profile_name = _create_profile(
+        manager_ip, instance.runtime_properties, tenant
+    )
     try:
-        temp_profile_name = _create_profile(
-            manager_ip,
-            instance.runtime_properties
-        )
-        yield temp_profile_name
-    finally:
-        if temp_profile_name:
-            execute_and_log(
-                ['cfy', 'profiles', 'delete', temp_profile_name],
-                ignore_errors=True,
-                no_log=True
-            )
+        with profile_workdir(_profile_workdir(profile_name)):
+            yield profile_name
+    except CommandExecutionException as e:
+        invalidate_cached_master(manager_ip)
+        # Pooled profiles are not validated when they are reused, so a
+        # failed login is the first sign that a profile has gone stale
+        if _is_auth_error(e.error):
+            with _pool_lock(manager_ip):
+                _evict_profiles(manager_ip, tenant)
+        raise
+
+
+def _is_auth_error(error):
+    return bool(AUTH_ERROR_PATTERN.search(error or ''))
 
 
 def _update_new_master(new_master, instance, managers):
     master = None
     slaves = []
+    standbys = get_standbys(instance)
     for manager, manager_config in managers.items():
         if manager == new_master:
             manager_config['is_master'] = True
             master = manager
         else:
             manager_config['is_master'] = False
-            slaves.append(manager)
+            if manager not in standbys:
+                slaves.append(manager)
 
     runtime_props = instance.runtime_properties
 
@@ -65,17 +119,18 @@ def _update_new_master(new_master, instance, managers):
 
         runtime_props['outputs'] = {
             'Master': master,
-            'Slaves': slaves
+            'Slaves': slaves,
+            'Standby': standbys
         }
         instance.update()
 
 
-def _get_cluster_master():
+def _get_cluster_master(manager_ip, instance=None):
     """
-    Return the IP of the current cluster leader. This is relevant after a
-    failover, when the master has changed
+    Return the IP of the current cluster leader, as seen by `manager_ip`.
+    This is relevant after a failover, when the master has changed
     """
-    hosts = execute_and_log(['cfy', 'cluster', 'nodes', 'list'], is_json=True)
+    hosts = get_backend(manager_ip, instance).cluster_nodes()
     for host in hosts:
         if host['state'] == 'leader':
             leader_ip = host['name']
@@ -89,65 +144,192 @@ def _get_cluster_master():
     )
 
 
-def get_config(runtime_props):
+def _pool_dir():
+    pool_dir = os.path.join(workdir(), PROFILES_POOL)
+    if not os.path.isdir(pool_dir):
+        os.mkdir(pool_dir)
+    return pool_dir
+
+
+def _profiles_store():
+    return os.path.join(workdir(), CLI_DIR, 'profiles')
+
+
+def _profile_workdir(profile_name):
+    return os.path.join(_pool_dir(), profile_name)
+
+
+@contextmanager
+def _pool_lock(manager_ip):
+    """
+    Serialize changes to the pooled profiles of a single manager between
+    operations that might run concurrently on the same deployment (e.g.
+    several `join_cluster`s)
+    """
+    lock_path = os.path.join(_pool_dir(), '.{0}.lock'.format(manager_ip))
+    with open(lock_path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _profile_exists(profile_name):
+    context_path = os.path.join(_profiles_store(), profile_name, 'context')
+    active_path = os.path.join(
+        _profile_workdir(profile_name), CLI_DIR, ACTIVE_PROFILE
+    )
+    return os.path.isfile(context_path) and os.path.isfile(active_path)
+
+
+def _profile_prefix(manager_ip, tenant):
+    return '{0}-{1}-'.format(manager_ip, tenant)
+
+
+def _evict_profiles(manager_ip, tenant, keep=None):
     """
-    Return a tuple with the `managers` config and CA cert path.
-    Raise an exception if either of those does not appear in the runtime props
-    :param runtime_props: The runtime properties dict from which to get the
-    values
+    Remove all the pooled profiles of `manager_ip` in `tenant` (except for
+    `keep`)
+    """
+    prefix = _profile_prefix(manager_ip, tenant)
+    for base_dir in (_profiles_store(), _pool_dir()):
+        if not os.path.isdir(base_dir):
+            continue
+        for profile_name in os.listdir(base_dir):
+            if not profile_name.startswith(prefix) or profile_name == keep:
+                continue
+            # Make sure this isn't the profile of a tenant whose name
+            # merely starts with the same prefix
+            if FINGERPRINT_PATTERN.match(profile_name[len(prefix):]):
+                ctx.logger.debug(
+                    'Evicting CLI profile {0}'.format(profile_name)
+                )
+                shutil.rmtree(
+                    os.path.join(base_dir, profile_name),
+                    ignore_errors=True
+                )
+
+
+def _add_profile_workdir(profile_name):
+    cli_dir = os.path.join(_profile_workdir(profile_name), CLI_DIR)
+    if not os.path.isdir(cli_dir):
+        os.makedirs(cli_dir)
+
+    profiles_link = os.path.join(cli_dir, 'profiles')
+    if not os.path.islink(profiles_link):
+        os.symlink(_profiles_store(), profiles_link)
+
+    with open(os.path.join(cli_dir, ACTIVE_PROFILE), 'w') as f:
+        f.write(profile_name)
+
+
+def _create_profile(manager_ip, runtime_props, tenant=DEFAULT_TENANT):
+    """
+    Return the name of a pooled CLI profile for `manager_ip` and `tenant`.
+    The profile is only created if it is not in the pool yet, or if the
+    credentials or the CA cert it was created with have changed since
     """
-    managers = runtime_props.get('managers')
-    ca_cert = runtime_props.get('ca_cert')
-    missing_value = None
-    if not managers:
-        missing_value = 'managers'
-    elif not ca_cert:
-        missing_value = 'ca_cert'
-    if missing_value:
-        raise NonRecoverableError(
-            'Could not load `{0}` config from the runtime '
-            'properties. This probably means that the blueprint '
-            'was not installed correctly.'.format(missing_value))
-    return managers, ca_cert
-
-
-def _create_profile(manager_ip, runtime_props):
     managers, ca_cert = get_config(runtime_props)
     config = managers[manager_ip]
-    profile_name = str(uuid4())
-
-    execute_and_log([
-        'cfy', 'profiles', 'use', config['public_ip'],
-        '-u', config['admin_username'],
-        '-p', config['admin_password'],
-        '-t', DEFAULT_TENANT,
-        '-c', ca_cert,
-        '--ssl',
-        '--profile-name', profile_name
-    ], no_log=True)
+    profile_name = '{0}{1}'.format(
+        _profile_prefix(manager_ip, tenant),
+        credentials_fingerprint(config, ca_cert)
+    )
+
+    with _pool_lock(manager_ip):
+        if _profile_exists(profile_name):
+            return profile_name
+
+        _evict_profiles(manager_ip, tenant, keep=profile_name)
+        ctx.logger.debug('Creating CLI profile {0}'.format(profile_name))
+
+        # The profile is always created in the deployment workdir, and not
+        # in the workdir of any profile that might currently be in use
+        with profile_workdir(workdir()):
+            execute_and_log([
+                'cfy', 'profiles', 'use', config['public_ip'],
+                '-u', config['admin_username'],
+                '-p', config['admin_password'],
+                '-t', tenant,
+                '-c', ca_cert,
+                '--ssl',
+                '--profile-name', profile_name
+            ], no_log=True)
+        _add_profile_workdir(profile_name)
     return profile_name
 
 
+def _probe_manager(manager_ip, instance, deadline, results):
+    ctx.logger.info('Trying: {0}'.format(manager_ip))
+    try:
+        # The probe gives up by the deadline, so it doesn't outlive the
+        # search for the cluster profile
+        get_backend(manager_ip, instance).cluster_status(
+            timeout=max(deadline - time.time(), 1)
+        )
+    except Exception as e:
+        # Any error is reported, or the manager would only be given up on
+        # once the probe timeout expires
+        results.put((manager_ip, e))
+    else:
+        results.put((manager_ip, None))
+
+
 def _get_cluster_profile(managers, instance=None):
     """
-    Try to use all of the available profiles, until you find one which has
-    the cluster configured on, and return it
+    Probe all of the available managers concurrently, and return the first
+    one which has the cluster configured on it. Managers that do not answer
+    within `probe_timeout` seconds are given up on
     """
-    for manager_ip, manager_config in managers.items():
-        ctx.logger.info('Trying: {0}'.format(manager_ip))
+    instance = instance or ctx.instance
+    timeout = cluster_property('probe_timeout', DEFAULT_PROBE_TIMEOUT)
+    deadline = time.time() + timeout
+    results = Queue.Queue()
+    errors = {}
+
+    # The probes still running once a manager is found are left to time out
+    # in the background, and their results are ignored
+    for manager_ip in managers:
+        start_thread(_probe_manager, manager_ip, instance, deadline, results)
+
+    for _ in managers:
         try:
-            with profile(manager_ip, instance=instance):
-                execute_and_log(
-                    ['cfy', 'cluster', 'status'],
-                    no_log=True
-                )
-                ctx.logger.info('Found cluster profile: '
-                                '{0}'.format(manager_ip))
+            manager_ip, error = results.get(
+                timeout=max(deadline - time.time(), 0)
+            )
+        except Queue.Empty:
+            ctx.logger.debug(
+                'No manager answered within {0} seconds'.format(timeout)
+            )
+            break
 
-                return manager_ip
-        except CommandExecutionException:
-            pass
+        if error:
+            errors[manager_ip] = error
+            if isinstance(error, CommandExecutionException):
+                log = ctx.logger.debug
+            else:
+                log = ctx.logger.warning
+            log('Manager {0} is not available: {1}'.format(
+                manager_ip, error
+            ))
+            continue
 
+        ctx.logger.info('Found cluster profile: {0}'.format(manager_ip))
+        return manager_ip
+
+    unexpected_errors = [
+        '{0}: {1}'.format(manager_ip, error)
+        for manager_ip, error in sorted(errors.items())
+        if not isinstance(error, CommandExecutionException)
+    ]
+    if unexpected_errors:
+        raise RecoverableError(
+            'Could not find a profile with a cluster configured, '
+            'probing the managers failed: {0}'.format(
+                ', '.join(unexpected_errors)
+            )
+        )
     raise RecoverableError(
         'Could not find a profile with a cluster configured. This '
         'might mean that the whole network is unreachable.'
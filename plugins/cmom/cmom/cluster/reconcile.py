@@ -0,0 +1,218 @@
+import os
+import json
+import hashlib
+import threading
+
+from cloudify import ctx
+from cloudify.exceptions import CommandExecutionException
+
+from ..common import DEFAULT_TENANT, workdir
+from .backend import get_backend
+
+RESOURCES_STATE = 'resources_state.json'
+
+CREATE = 'create'
+UPDATE = 'update'
+SKIP = 'skip'
+
+RESOURCE_KINDS = ('tenants', 'plugins', 'secrets', 'blueprints', 'deployments')
+
+
+def plugin_id(package_name, package_version):
+    """
+    Return an ID by which a plugin can be identified both from its wagon
+    filename and from its listing on the manager (Wagon replaces dashes
+    in the package name with underscores)
+    """
+    return '{0}=={1}'.format(
+        package_name.replace('-', '_').lower(), package_version
+    )
+
+
+def _resource_id(kind, resource):
+    if kind == 'tenants':
+        return resource['name']
+    elif kind == 'secrets':
+        return resource['key']
+    elif kind == 'plugins':
+        return plugin_id(
+            resource['package_name'], resource['package_version']
+        )
+    return resource['id']
+
+
+def content_hash(*values):
+    """
+    Return a hash of the content of the given values. Values that are paths
+    of local files or folders are hashed by their content, anything else
+    (e.g. URLs) by its string value
+    """
+    digest = hashlib.sha256()
+    for value in values:
+        if isinstance(value, basestring) and os.path.isfile(value):
+            _hash_file(digest, value)
+        elif isinstance(value, basestring) and os.path.isdir(value):
+            for root, dirs, files in os.walk(value):
+                dirs.sort()
+                for file_name in sorted(files):
+                    file_path = os.path.join(root, file_name)
+                    digest.update(
+                        os.path.relpath(file_path, value).encode('utf-8')
+                    )
+                    _hash_file(digest, file_path)
+        else:
+            digest.update(json.dumps(value, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _hash_file(digest, path):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+
+def _state_path():
+    return os.path.join(workdir(), RESOURCES_STATE)
+
+
+class ResourcePlan(object):
+    """
+    Decide what needs to be done with each of the requested resources.
+
+    Without `reconcile`, every resource is created (and any errors, e.g. for
+    resources that already exist, are reported by the caller). With it, the
+    existing resources are listed once per tenant, and each resource is
+    either created, updated (if its content changed since it was last
+    applied) or skipped.
+    """
+    def __init__(self, master_ip, reconcile=False):
+        self.master_ip = master_ip
+        self.reconcile = reconcile
+        self.counts = dict(
+            (kind, {CREATE: 0, UPDATE: 0, SKIP: 0})
+            for kind in RESOURCE_KINDS
+        )
+        self._existing = {}
+        self._state = {}
+        self._lock = threading.Lock()
+
+        if reconcile and os.path.isfile(_state_path()):
+            with open(_state_path()) as f:
+                self._state = json.load(f)
+
+    def _existing_resources(self, kind, tenant):
+        key = (kind, tenant)
+        if key not in self._existing:
+            try:
+                resources = get_backend(
+                    self.master_ip, tenant=tenant
+                ).list_resources(kind)
+            except CommandExecutionException as e:
+                # E.g. the tenant itself doesn't exist (yet)
+                ctx.logger.debug(
+                    'Could not list {0} in tenant {1}: {2}'.format(
+                        kind, tenant, e
+                    )
+                )
+                resources = []
+            self._existing[key] = dict(
+                (_resource_id(kind, resource), resource)
+                for resource in resources
+            )
+        return self._existing[key]
+
+    def _action(self, kind, tenant, resource_id, resource_hash, adopt):
+        existing = self._existing_resources(kind, tenant)
+        state_key = '/'.join([kind, tenant, resource_id])
+        if resource_id not in existing:
+            return CREATE, None
+        if resource_hash is None:
+            return SKIP, existing[resource_id]
+
+        applied_hash = self._state.get(state_key)
+        if applied_hash == resource_hash:
+            return SKIP, existing[resource_id]
+        if applied_hash is None and adopt:
+            # The resource was created before reconciling was used, so
+            # assume it matches the inputs
+            self._state[state_key] = resource_hash
+            return SKIP, existing[resource_id]
+        return UPDATE, existing[resource_id]
+
+    def apply(self,
+              kind,
+              resource_id,
+              create,
+              tenant=DEFAULT_TENANT,
+              resource_hash=None,
+              update=None,
+              delete=None,
+              adopt=True):
+        """
+        Create/update/skip a single resource, and return True if it was
+        created/updated successfully, False if that failed, or None if it
+        was skipped
+        :param kind: One of RESOURCE_KINDS
+        :param resource_id: The ID of the resource on the manager
+        :param create: A function creating the resource. Returns True on
+        success
+        :param tenant: The tenant the resource belongs to
+        :param resource_hash: A hash of the resource's content, or a function
+        returning it (so that it's only computed when reconciling). Resources
+        without a hash are never updated
+        :param update: A function updating an existing resource in place
+        :param delete: A function deleting an existing resource (receives
+        the resource as listed on the manager), so that it can be created
+        anew, if it can't be updated in place
+        :param adopt: Whether existing resources that were never applied by
+        the plan should be assumed to be up to date
+        """
+        if not self.reconcile:
+            return create()
+
+        if callable(resource_hash):
+            resource_hash = resource_hash()
+        with self._lock:
+            action, existing = self._action(
+                kind, tenant, resource_id, resource_hash, adopt
+            )
+            self.counts[kind][action] += 1
+
+        if action == SKIP:
+            ctx.logger.debug('Skipping {0} {1}'.format(kind, resource_id))
+            return None
+        elif action == UPDATE:
+            ctx.logger.info('Updating {0} {1}'.format(kind, resource_id))
+            if update:
+                succeeded = update()
+            else:
+                succeeded = (not delete or delete(existing)) and create()
+        else:
+            succeeded = create()
+
+        if succeeded and resource_hash is not None:
+            with self._lock:
+                self._state['/'.join([kind, tenant, resource_id])] = \
+                    resource_hash
+        return succeeded
+
+    def save(self):
+        if not self.reconcile:
+            return
+        temp_path = '{0}.{1}'.format(_state_path(), os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(self._state, f)
+        os.rename(temp_path, _state_path())
+
+    def log_summary(self):
+        if not self.reconcile:
+            return
+        for kind in RESOURCE_KINDS:
+            ctx.logger.info(
+                '{0}: {1} to create, {2} to update, {3} unchanged'.format(
+                    kind.capitalize(),
+                    self.counts[kind][CREATE],
+                    self.counts[kind][UPDATE],
+                    self.counts[kind][SKIP]
+                )
+            )
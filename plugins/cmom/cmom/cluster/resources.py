@@ -1,4 +1,9 @@
+import os
 import json
+import tarfile
+import zipfile
+from functools import partial
+from contextlib import closing
 
 from cloudify import ctx
 from cloudify.decorators import operation
@@ -6,8 +11,13 @@ from cloudify.state import ctx_parameters as inputs
 from cloudify.exceptions import CommandExecutionException
 
 from ..common import DEFAULT_TENANT
-from .utils import execute_and_log
+from .utils import execute_and_log, run_concurrently
+from .backend import get_backend
 from .profile import profile, get_current_master
+from .reconcile import ResourcePlan, plugin_id, content_hash
+
+DEFAULT_UPLOAD_CONCURRENCY = 5
+DEFAULT_BLUEPRINT_FILENAME = 'blueprint.yaml'
 
 
 def _add_tenant_and_visibility(cmd, resource):
@@ -21,27 +31,86 @@ def _add_tenant_and_visibility(cmd, resource):
     return cmd
 
 
-def _try_running_command(cmd, warning_msg):
+def _try_running(func, warning_msg, *args):
     try:
-        execute_and_log(cmd)
+        func(*args)
     except CommandExecutionException as e:
         ctx.logger.warning(warning_msg)
         ctx.logger.warning('Error: {0}'.format(e.error))
+        return False
+    return True
 
 
-def _create_tenants():
-    tenants = inputs.get('tenants', [])
-    for tenant in tenants:
-        cmd = ['cfy', 'tenants', 'create', tenant]
-        _try_running_command(cmd, 'Could not create tenant {0}'.format(tenant))
+def _try_running_command(cmd, warning_msg):
+    return _try_running(execute_and_log, warning_msg, cmd)
+
+
+def _upload_concurrently(uploads):
+    """
+    Run the uploads on a bounded pool of workers, and return a summary of
+    the uploaded, failed and skipped resources
+    :param uploads: A list of (resource name, upload function) tuples. The
+    functions return True/False on success/failure, or None if skipped
+    """
+    concurrency = inputs.get(
+        'upload_concurrency', DEFAULT_UPLOAD_CONCURRENCY
+    )
+    results = run_concurrently(
+        lambda upload: upload[1](),
+        uploads,
+        concurrency
+    )
 
+    summary = {'uploaded': [], 'failed': [], 'skipped': []}
+    for (name, _), result in zip(uploads, results):
+        if result is None:
+            summary['skipped'].append(name)
+        else:
+            summary['uploaded' if result else 'failed'].append(name)
+    return summary
 
-def _switch_tenant(tenant):
-    execute_and_log(['cfy', 'profiles', 'set', '-t', tenant])
 
+def _create_tenants(backend, plan):
+    tenants = inputs.get('tenants', [])
+    for tenant in tenants:
+        plan.apply('tenants', tenant, lambda: _try_running(
+            backend.create_tenant,
+            'Could not create tenant {0}'.format(tenant),
+            tenant
+        ))
+
+
+def _plugin_id(plugin):
+    """
+    Wagon filenames are in the form of NAME-VERSION-PYTHON-ABI-PLATFORM.wgn
+    """
+    name_parts = os.path.basename(plugin['wagon']).split('-')
+    if len(name_parts) < 2:
+        return plugin['wagon']
+    return plugin_id(name_parts[0], name_parts[1])
+
+
+def _upload(plan, kind, resource, resource_id, resource_hash, cmd,
+            warning_msg, delete):
+    tenant = resource.get('tenant') or DEFAULT_TENANT
+
+    def _upload_resource():
+        return plan.apply(
+            kind,
+            resource_id,
+            lambda: _try_running_command(cmd, warning_msg),
+            tenant=tenant,
+            resource_hash=resource_hash,
+            delete=lambda existing: _try_running(
+                delete, warning_msg, existing['id']
+            )
+        )
+    return _upload_resource
 
-def _upload_plugins():
+
+def _upload_plugins(plan):
     plugins = inputs.get('plugins', [])
+    uploads = []
     for plugin in plugins:
         if 'wagon' not in plugin or 'yaml' not in plugin:
             ctx.logger.error("""
@@ -62,13 +131,22 @@ Both `wagon` and `yaml` are required fields
                plugin['wagon'], '-y', plugin['yaml']]
 
         cmd = _add_tenant_and_visibility(cmd, plugin)
-        _try_running_command(
+        tenant = plugin.get('tenant') or DEFAULT_TENANT
+        uploads.append((plugin['wagon'], _upload(
+            plan,
+            'plugins',
+            plugin,
+            _plugin_id(plugin),
+            partial(content_hash, plugin['wagon'], plugin['yaml']),
             cmd,
-            'Could not upload plugin {0}'.format(plugin['wagon'])
-        )
+            'Could not upload plugin {0}'.format(plugin['wagon']),
+            get_backend(plan.master_ip, tenant=tenant).delete_plugin
+        )))
+    return _upload_concurrently(uploads)
 
 
-def _create_secrets():
+def _group_secrets_by_tenant():
+    secrets_by_tenant = {}
     secrets = inputs.get('secrets', [])
     for secret in secrets:
         if ('key' not in secret) or \
@@ -88,39 +166,105 @@ Expected format is:
 """.format(secret))
             continue
 
-        # Create basic command
-        cmd = ['cfy', 'secrets', 'create', secret['key']]
+        tenant = secret.get('tenant') or DEFAULT_TENANT
+        secrets_by_tenant.setdefault(tenant, []).append(secret)
+    return secrets_by_tenant
 
-        # `visibility` and `--update-if-exists` are mutually exclusive
-        if not secret.get('visibility'):
-            cmd.append('--update-if-exists')
 
-        # Add string or file as the value of the secret
-        string = secret.get('string')
-        if string:
-            cmd += ['-s', string]
-        else:
-            cmd += ['-f', secret['file']]
-
-        # The secrets' CLI command doesn't have a `-t` flag, so we handle it
-        # separately here by actually switching to the tenant
-        tenant = secret.pop('tenant', None)
-        try:
-            if tenant:
-                _switch_tenant(tenant)
-
-            cmd = _add_tenant_and_visibility(cmd, secret)
-            _try_running_command(
-                cmd,
-                'Could not create secret {0}'.format(secret['key'])
+def _get_secret_value(secret):
+    string = secret.get('string')
+    if string:
+        return string
+    with open(secret['file']) as f:
+        return f.read()
+
+
+def _create_secrets(plan):
+    """
+    Create the secrets tenant by tenant, so that the scope of each tenant
+    is only set once, instead of switching tenants for every secret
+    """
+    for tenant, secrets in _group_secrets_by_tenant().items():
+        ctx.logger.info(
+            'Creating {0} secret(s) in tenant {1}'.format(len(secrets), tenant)
+        )
+        backend = get_backend(plan.master_ip, tenant=tenant)
+        for secret in secrets:
+            warning_msg = 'Could not create secret {0}'.format(secret['key'])
+            try:
+                value = _get_secret_value(secret)
+            except IOError as e:
+                ctx.logger.warning(warning_msg)
+                ctx.logger.warning('Error: {0}'.format(e))
+                continue
+
+            key = secret['key']
+            visibility = secret.get('visibility')
+            plan.apply(
+                'secrets',
+                key,
+                lambda: _try_running(
+                    backend.create_secret, warning_msg,
+                    key, value, visibility
+                ),
+                tenant=tenant,
+                resource_hash=content_hash(value, visibility),
+                update=lambda: _try_running(
+                    backend.update_secret, warning_msg, key, value
+                ),
+                # Secret values can't be compared with the existing ones
+                adopt=False
             )
-        finally:
-            if tenant:
-                _switch_tenant(DEFAULT_TENANT)
 
 
-def _upload_blueprints():
+def _archive_folder(path):
+    """
+    The top folder of a blueprint archive, which is where the CLI looks for
+    the blueprint file once the archive is extracted
+    """
+    if tarfile.is_tarfile(path):
+        with closing(tarfile.open(path)) as archive:
+            name = archive.getnames()[0]
+    else:
+        with closing(zipfile.ZipFile(path)) as archive:
+            name = archive.namelist()[0]
+    return [part for part in name.split('/') if part not in ('', '.')][0]
+
+
+def _blueprint_id(blueprint):
+    """
+    The ID the CLI assigns to a blueprint uploaded without one (as in
+    `cloudify_cli.blueprint.generate_id`): the name of the blueprint file's
+    folder (inside the archive, for archives), followed by the name of the
+    blueprint file if it isn't the default one, with dashes instead of
+    underscores
+    """
+    if blueprint.get('id'):
+        return blueprint['id']
+    path = blueprint['path']
+    filename = blueprint.get('filename') or DEFAULT_BLUEPRINT_FILENAME
+    if os.path.isfile(path) and \
+            (tarfile.is_tarfile(path) or zipfile.is_zipfile(path)):
+        path = os.path.join(_archive_folder(path), filename)
+    blueprint_id = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    if filename != DEFAULT_BLUEPRINT_FILENAME:
+        blueprint_id += '.' + os.path.splitext(os.path.basename(filename))[0]
+    return blueprint_id.replace('_', '-')
+
+
+def _blueprint_content(blueprint):
+    """
+    Blueprint YAML files are uploaded along with the rest of their folder
+    """
+    path = blueprint['path']
+    if path.endswith(('.yaml', '.yml')) and os.path.isfile(path):
+        return os.path.dirname(os.path.abspath(path))
+    return path
+
+
+def _upload_blueprints(plan):
     blueprints = inputs.get('blueprints', [])
+    uploads = []
     for blueprint in blueprints:
         if 'path' not in blueprint:
             ctx.logger.error("""
@@ -149,13 +293,25 @@ Expected format is:
             cmd += ['-n', blueprint_filename]
 
         cmd = _add_tenant_and_visibility(cmd, blueprint)
-        _try_running_command(
+        tenant = blueprint.get('tenant') or DEFAULT_TENANT
+        uploads.append((blueprint['path'], _upload(
+            plan,
+            'blueprints',
+            blueprint,
+            _blueprint_id(blueprint),
+            partial(
+                content_hash,
+                _blueprint_content(blueprint),
+                blueprint_filename
+            ),
             cmd,
-            'Could not upload blueprint {0}'.format(blueprint['path'])
-        )
+            'Could not upload blueprint {0}'.format(blueprint['path']),
+            get_backend(plan.master_ip, tenant=tenant).delete_blueprint
+        )))
+    return _upload_concurrently(uploads)
 
 
-def _create_deployments():
+def _create_deployments(plan):
     deployments = inputs.get('deployments', [])
     for deployment in deployments:
         if ('blueprint_id' not in deployment) or \
@@ -191,10 +347,14 @@ Expected format is:
             cmd += ['-i', dep_inputs]
 
         cmd = _add_tenant_and_visibility(cmd, deployment)
-        _try_running_command(
-            cmd,
-            'Could not create deployment {0} from '
-            'blueprint {1}'.format(deployment_id, blueprint_id)
+        warning_msg = 'Could not create deployment {0} from ' \
+                      'blueprint {1}'.format(deployment_id, blueprint_id)
+        # Existing deployments are never updated
+        plan.apply(
+            'deployments',
+            deployment_id,
+            lambda: _try_running_command(cmd, warning_msg),
+            tenant=deployment.get('tenant') or DEFAULT_TENANT
         )
 
 
@@ -233,44 +393,63 @@ def _execute_workflow():
 
 @operation
 def add_additional_resources(**_):
-    """ Upload/create additional resources on the managers of the cluster """
-
-    with profile(get_current_master()):
-        _create_tenants()
-        _upload_plugins()
-        _create_secrets()
-        _upload_blueprints()
-        _create_deployments()
+    """
+    Upload/create additional resources on the managers of the cluster.
+    If `reconcile` is set, only the resources that don't exist yet, or that
+    changed since they were last applied, are created/updated
+    """
+    master_ip = get_current_master()
+    plan = ResourcePlan(master_ip, inputs.get('reconcile', False))
+    try:
+        with profile(master_ip):
+            _create_tenants(get_backend(master_ip), plan)
+            plugins_summary = _upload_plugins(plan)
+            _create_secrets(plan)
+            blueprints_summary = _upload_blueprints(plan)
+            _create_deployments(plan)
+    finally:
+        plan.save()
+    plan.log_summary()
+
+    summary = {
+        'plugins': plugins_summary,
+        'blueprints': blueprints_summary
+    }
+    if plan.reconcile:
+        summary['plan'] = plan.counts
+    return summary
 
 
 @operation
 def upload_blueprints(**_):
-    with profile(get_current_master()):
-        _upload_blueprints()
+    master_ip = get_current_master()
+    with profile(master_ip):
+        return _upload_blueprints(ResourcePlan(master_ip))
 
 
 @operation
 def upload_plugins(**_):
-    with profile(get_current_master()):
-        _upload_plugins()
+    master_ip = get_current_master()
+    with profile(master_ip):
+        return _upload_plugins(ResourcePlan(master_ip))
 
 
 @operation
 def create_tenants(**_):
-    with profile(get_current_master()):
-        _create_tenants()
+    master_ip = get_current_master()
+    _create_tenants(get_backend(master_ip), ResourcePlan(master_ip))
 
 
 @operation
 def create_secrets(**_):
-    with profile(get_current_master()):
-        _create_secrets()
+    _create_secrets(ResourcePlan(get_current_master()))
 
 
 @operation
 def create_deployments(**_):
-    with profile(get_current_master()):
-        _create_deployments()
+    master_ip = get_current_master()
+    with profile(master_ip):
+        _create_deployments(ResourcePlan(master_ip))
 
 
 @operation
@@ -0,0 +1,339 @@
+"""
+A content-addressed store for the snapshots downloaded from Tier 1 clusters.
+
+Each snapshot archive is split into chunks, which are saved once in a store
+shared by all the deployments, under the SHA256 of their content. The
+snapshot itself is replaced by a small manifest listing its chunks, from
+which the original archive can be reassembled byte for byte.
+
+The archives are cut at the boundaries of their zip members (and every
+CHUNK_SIZE within large members), so the members that did not change
+between consecutive snapshots (blueprints, plugins, etc.) are only stored
+once. Chunks are reference counted by the manifests using them, and are
+deleted once no manifest references them anymore.
+"""
+
+import os
+import json
+import time
+import fcntl
+import bisect
+import struct
+import hashlib
+import zipfile
+from datetime import datetime
+from collections import Counter
+from contextlib import contextmanager
+
+from cloudify import ctx
+from cloudify.exceptions import NonRecoverableError
+
+STORE_FOLDER = '.store'
+CHUNKS_FOLDER = 'chunks'
+MANIFEST_SUFFIX = '.json'
+
+CHUNK_SIZE = 4 * 1024 * 1024
+BUFFER_SIZE = 1024 * 1024
+
+
+def manifest_path(snapshots_dir, snapshot_id):
+    return os.path.join(snapshots_dir, snapshot_id + MANIFEST_SUFFIX)
+
+
+def load_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _members(archive_path):
+    """
+    Yield a tuple of the info of every member of the archive, and the
+    offsets of the start and end of its (compressed) data
+    """
+    with zipfile.ZipFile(archive_path) as archive, \
+            open(archive_path, 'rb') as f:
+        for info in archive.infolist():
+            f.seek(info.header_offset)
+            header = struct.unpack(
+                zipfile.structFileHeader, f.read(zipfile.sizeFileHeader)
+            )
+            data_start = info.header_offset + zipfile.sizeFileHeader + \
+                header[zipfile._FH_FILENAME_LENGTH] + \
+                header[zipfile._FH_EXTRA_FIELD_LENGTH]
+            yield info, data_start, data_start + info.compress_size
+
+
+def member_key(info):
+    """
+    The attributes identifying the same member in different archives
+    """
+    return [info.CRC, info.compress_size, info.file_size,
+            list(info.date_time)]
+
+
+def _cut_points(archive_path):
+    """
+    Return the offsets at which the archive is split into chunks: the start
+    of every member's local header, the start and end of its data, and every
+    CHUNK_SIZE within the data
+    """
+    size = os.path.getsize(archive_path)
+    cuts = {0, size}
+    for info, data_start, data_end in _members(archive_path):
+        cuts.add(info.header_offset)
+        cuts.update(range(data_start, data_end, CHUNK_SIZE))
+        cuts.add(data_end)
+    return sorted(cut for cut in cuts if cut <= size)
+
+
+def _latest_per_period(manifests, count, period):
+    """
+    Return the paths of the latest manifest in each of the last `count`
+    periods (days/weeks)
+    :param manifests: A list of (creation time, path) tuples, latest first
+    :param period: A function returning the period of a datetime
+    """
+    periods = set()
+    paths = set()
+    for created_at, path in manifests:
+        key = period(datetime.fromtimestamp(created_at))
+        if key not in periods and len(periods) < count:
+            periods.add(key)
+            paths.add(path)
+    return paths
+
+
+class SnapshotStore(object):
+    def __init__(self, base_snapshots_dir):
+        self.base_dir = base_snapshots_dir
+        self.root = os.path.join(base_snapshots_dir, STORE_FOLDER)
+        self.chunks_dir = os.path.join(self.root, CHUNKS_FOLDER)
+        if not os.path.isdir(self.chunks_dir):
+            os.makedirs(self.chunks_dir)
+
+    @contextmanager
+    def _lock(self):
+        """
+        Serialize changes to the store between backups of different
+        deployments, so that chunks that are being added are never
+        garbage collected
+        """
+        with open(os.path.join(self.root, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _chunk_path(self, chunk_hash):
+        return os.path.join(self.chunks_dir, chunk_hash[:2], chunk_hash)
+
+    def _write_chunk(self, chunk_hash, data):
+        """
+        Write the chunk if it's not in the store yet, and return whether
+        it was written
+        """
+        chunk_path = self._chunk_path(chunk_hash)
+        if os.path.exists(chunk_path):
+            return False
+        chunk_dir = os.path.dirname(chunk_path)
+        if not os.path.isdir(chunk_dir):
+            os.mkdir(chunk_dir)
+        temp_path = '{0}.{1}'.format(chunk_path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, chunk_path)
+        return True
+
+    def add(self, archive_path, path, snapshot_id, checksum):
+        """
+        Split the archive into the store, and write its manifest to `path`
+        :param checksum: The SHA256 of the whole archive
+        """
+        cuts = _cut_points(archive_path)
+        # Where each member is in the archive, so that the next snapshots
+        # can be downloaded incrementally (see `StoredSnapshot`)
+        members = dict(
+            (info.filename, {
+                'key': member_key(info),
+                'start': info.header_offset,
+                'end': data_end
+            })
+            for info, _, data_end in _members(archive_path)
+        )
+        chunks = []
+        new_size = 0
+        with self._lock(), open(archive_path, 'rb') as f:
+            for start, end in zip(cuts, cuts[1:]):
+                data = f.read(end - start)
+                chunk_hash = hashlib.sha256(data).hexdigest()
+                if self._write_chunk(chunk_hash, data):
+                    new_size += len(data)
+                chunks.append(chunk_hash)
+
+            manifest = {
+                'snapshot_id': snapshot_id,
+                'created_at': time.time(),
+                'size': os.path.getsize(archive_path),
+                'sha256': checksum,
+                'chunks': chunks,
+                'members': members
+            }
+            temp_path = '{0}.{1}'.format(path, os.getpid())
+            with open(temp_path, 'w') as manifest_file:
+                json.dump(manifest, manifest_file)
+            os.rename(temp_path, path)
+
+        ctx.logger.info(
+            'Stored snapshot {0}: {1} MB out of {2} MB were new'.format(
+                snapshot_id,
+                new_size // (1024 * 1024),
+                manifest['size'] // (1024 * 1024)
+            )
+        )
+        return manifest
+
+    def extract(self, path, output_path):
+        """
+        Reassemble the archive described by the manifest in `path` into
+        `output_path`, and verify its checksum
+        """
+        manifest = load_manifest(path)
+        digest = hashlib.sha256()
+        with open(output_path, 'wb') as output_file:
+            for chunk_hash in manifest['chunks']:
+                chunk_path = self._chunk_path(chunk_hash)
+                if not os.path.exists(chunk_path):
+                    raise NonRecoverableError(
+                        'Chunk {0} of snapshot {1} is missing from the '
+                        'store'.format(chunk_hash, manifest['snapshot_id'])
+                    )
+                with open(chunk_path, 'rb') as chunk_file:
+                    for data in iter(lambda: chunk_file.read(BUFFER_SIZE),
+                                     b''):
+                        digest.update(data)
+                        output_file.write(data)
+
+        if digest.hexdigest() != manifest['sha256']:
+            os.remove(output_path)
+            raise NonRecoverableError(
+                'Snapshot {0} does not match its checksum'.format(
+                    manifest['snapshot_id']
+                )
+            )
+        return output_path
+
+    def open_snapshot(self, path):
+        return StoredSnapshot(self, load_manifest(path))
+
+    def apply_retention(self, snapshots_dir, keep_daily=0, keep_weekly=0):
+        """
+        Keep the latest snapshot of each of the last `keep_daily` days and
+        `keep_weekly` weeks (that have snapshots) in `snapshots_dir`, delete
+        the manifests of all the others and garbage collect their chunks.
+        If neither is set, all of the snapshots are kept
+        """
+        if not keep_daily and not keep_weekly:
+            return []
+
+        manifests = []
+        for name in os.listdir(snapshots_dir):
+            if name.endswith(MANIFEST_SUFFIX):
+                path = os.path.join(snapshots_dir, name)
+                manifests.append((load_manifest(path)['created_at'], path))
+        manifests.sort(reverse=True)
+
+        keep = _latest_per_period(
+            manifests, keep_daily, lambda date: date.date()
+        )
+        keep.update(_latest_per_period(
+            manifests, keep_weekly, lambda date: date.isocalendar()[:2]
+        ))
+
+        removed = []
+        with self._lock():
+            for _, path in manifests:
+                if path not in keep:
+                    os.remove(path)
+                    removed.append(
+                        os.path.basename(path)[:-len(MANIFEST_SUFFIX)]
+                    )
+            if removed:
+                ctx.logger.info(
+                    'Removed snapshots according to the retention policy: '
+                    '{0}'.format(', '.join(removed))
+                )
+                self._collect_garbage()
+        return removed
+
+    def _reference_counts(self):
+        counts = Counter()
+        for deployment_id in os.listdir(self.base_dir):
+            snapshots_dir = os.path.join(self.base_dir, deployment_id)
+            if deployment_id == STORE_FOLDER or \
+                    not os.path.isdir(snapshots_dir):
+                continue
+            for name in os.listdir(snapshots_dir):
+                if name.endswith(MANIFEST_SUFFIX):
+                    path = os.path.join(snapshots_dir, name)
+                    counts.update(load_manifest(path)['chunks'])
+        return counts
+
+    def _collect_garbage(self):
+        counts = self._reference_counts()
+        freed = 0
+        for root, _, files in os.walk(self.chunks_dir):
+            for chunk_hash in files:
+                if counts[chunk_hash] == 0:
+                    chunk_path = os.path.join(root, chunk_hash)
+                    freed += os.path.getsize(chunk_path)
+                    os.remove(chunk_path)
+        ctx.logger.info(
+            'Freed {0} MB from the snapshots store'.format(
+                freed // (1024 * 1024)
+            )
+        )
+
+
+class StoredSnapshot(object):
+    """
+    Random access to the archive of a stored snapshot, without reassembling
+    all of it
+    """
+    def __init__(self, store, manifest):
+        self.store = store
+        self.snapshot_id = manifest['snapshot_id']
+        self.chunks = manifest['chunks']
+        # Snapshots stored by older versions don't list their members
+        self.members = manifest.get('members', {})
+        self._offsets = None
+
+    def _chunk_offsets(self):
+        if self._offsets is None:
+            self._offsets = [0]
+            for chunk_hash in self.chunks:
+                self._offsets.append(self._offsets[-1] + os.path.getsize(
+                    self.store._chunk_path(chunk_hash)
+                ))
+        return self._offsets
+
+    def copy_range(self, start, end, output_file):
+        """
+        Write the bytes in [start, end) of the archive into `output_file`,
+        at its current position
+        """
+        offsets = self._chunk_offsets()
+        index = bisect.bisect_right(offsets, start) - 1
+        position = start
+        while position < end:
+            chunk_start, chunk_end = offsets[index], offsets[index + 1]
+            with open(self.store._chunk_path(self.chunks[index]),
+                      'rb') as chunk_file:
+                chunk_file.seek(position - chunk_start)
+                remaining = min(chunk_end, end) - position
+                while remaining > 0:
+                    data = chunk_file.read(min(remaining, BUFFER_SIZE))
+                    output_file.write(data)
+                    remaining -= len(data)
+            position = min(chunk_end, end)
+            index += 1
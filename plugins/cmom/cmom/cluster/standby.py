@@ -0,0 +1,84 @@
+"""
+A pool of warm standby Tier 1 managers.
+
+Standby managers are installed like all the other Tier 1 managers, but are
+not joined to the cluster. Like the resources of the `resource_pool` node,
+their IPs are kept in a runtime property (`standby_managers`, of the cluster
+node): a standby is popped from the pool when it replaces a failed manager
+in the cluster, and the failed manager is added to the pool once it has
+been rebuilt.
+
+The functions here only change the runtime properties of the cluster
+instance; it's up to the callers to update it.
+"""
+
+STANDBY_MANAGERS = 'standby_managers'
+
+# Failed managers that were replaced by a standby, and will become standbys
+# themselves once they are rebuilt
+REBUILDING_MANAGERS = 'rebuilding_managers'
+
+
+def get_standbys(instance):
+    return list(instance.runtime_properties.get(STANDBY_MANAGERS, []))
+
+
+def fill_pool(instance, candidates, size):
+    """
+    Move managers from `candidates` into the pool, until there are `size`
+    managers in it, and return the ones that were added
+    """
+    pool = get_standbys(instance)
+    added = candidates[:max(size - len(pool), 0)]
+    instance.runtime_properties[STANDBY_MANAGERS] = pool + added
+    return added
+
+
+def pop_standby(instance):
+    """
+    Take a standby out of the pool, or return None if it's empty
+    """
+    pool = get_standbys(instance)
+    if not pool:
+        return None
+    standby_ip = pool.pop(0)
+    instance.runtime_properties[STANDBY_MANAGERS] = pool
+    return standby_ip
+
+
+def add_standby(instance, manager_ip):
+    pool = get_standbys(instance)
+    if manager_ip not in pool:
+        pool.append(manager_ip)
+    instance.runtime_properties[STANDBY_MANAGERS] = pool
+
+
+def remove_standby(instance, manager_ip):
+    """
+    Remove a (failed) standby from the pool, and return whether it was there
+    """
+    pool = get_standbys(instance)
+    if manager_ip not in pool:
+        return False
+    pool.remove(manager_ip)
+    instance.runtime_properties[STANDBY_MANAGERS] = pool
+    return True
+
+
+def is_rebuilding(instance, manager_ip):
+    return manager_ip in instance.runtime_properties.get(
+        REBUILDING_MANAGERS, []
+    )
+
+
+def set_rebuilding(instance, manager_ip, rebuilding=True):
+    rebuilding_managers = set(
+        instance.runtime_properties.get(REBUILDING_MANAGERS, [])
+    )
+    if rebuilding:
+        rebuilding_managers.add(manager_ip)
+    else:
+        rebuilding_managers.discard(manager_ip)
+    instance.runtime_properties[REBUILDING_MANAGERS] = sorted(
+        rebuilding_managers
+    )
@@ -1,21 +1,178 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from cloudify import ctx
+from cloudify.constants import RELATIONSHIP_INSTANCE
+from cloudify.exceptions import NonRecoverableError
+
 from ..common import workdir
 from ..common import execute_and_log as _execute_and_log
+from ..common import run_concurrently as _run_concurrently
+
+LEADER_CACHE = 'leader.json'
+DEFAULT_LEADER_CACHE_TTL = 60
+
+_local = threading.local()
+
+
+def _profile_workdirs():
+    if not hasattr(_local, 'profile_workdirs'):
+        _local.profile_workdirs = []
+    return _local.profile_workdirs
+
+
+@contextmanager
+def profile_workdir(path):
+    """
+    Run all the `cfy` commands in this block (in the current thread) with
+    `path` as their CLI workdir, so that they use the profile active there
+    """
+    workdirs = _profile_workdirs()
+    workdirs.append(path)
+    try:
+        yield path
+    finally:
+        workdirs.pop()
+
+
+def run_concurrently(func, items, concurrency):
+    """
+    The same as `common.run_concurrently`, only all the calls run in the CLI
+    profile that is active in the calling thread
+    """
+    workdirs = list(_profile_workdirs())
+
+    def _func(item):
+        _local.profile_workdirs = list(workdirs)
+        return func(item)
+
+    return _run_concurrently(_func, items, concurrency)
 
 
 def execute_and_log(cmd,
                     deployment_id=None,
                     no_log=False,
                     ignore_errors=False,
-                    is_json=False):
+                    is_json=False,
+                    timeout=None):
     if is_json:
         cmd.append('--json')
         no_log = True
 
+    workdirs = _profile_workdirs()
+    deployment_workdir = workdirs[-1] if workdirs else workdir(deployment_id)
+
     return _execute_and_log(
         cmd,
         clean_env=True,
-        deployment_workdir=workdir(deployment_id),
+        deployment_workdir=deployment_workdir,
         no_log=no_log,
         ignore_errors=ignore_errors,
-        is_json=is_json
+        is_json=is_json,
+        timeout=timeout
     )
+
+
+def get_config(runtime_props):
+    """
+    Return a tuple with the `managers` config and CA cert path.
+    Raise an exception if either of those does not appear in the runtime props
+    :param runtime_props: The runtime properties dict from which to get the
+    values
+    """
+    managers = runtime_props.get('managers')
+    ca_cert = runtime_props.get('ca_cert')
+    missing_value = None
+    if not managers:
+        missing_value = 'managers'
+    elif not ca_cert:
+        missing_value = 'ca_cert'
+    if missing_value:
+        raise NonRecoverableError(
+            'Could not load `{0}` config from the runtime '
+            'properties. This probably means that the blueprint '
+            'was not installed correctly.'.format(missing_value))
+    return managers, ca_cert
+
+
+def credentials_fingerprint(config, ca_cert):
+    """
+    Return a short hash of everything that is used to connect to a manager,
+    so that a change in credentials or in the CA cert can be detected
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([
+        config['public_ip'],
+        config['admin_username'],
+        config['admin_password'],
+        ca_cert
+    ]).encode('utf-8'))
+    if os.path.isfile(ca_cert):
+        with open(ca_cert, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def cluster_property(name, default=None):
+    """
+    Return a property of the cluster node, both in the cluster node's own
+    operations and in relationship operations where it is the source
+    """
+    if ctx.type == RELATIONSHIP_INSTANCE:
+        node = ctx.source.node
+    else:
+        node = ctx.node
+    return node.properties.get(name, default)
+
+
+def _leader_cache_path(deployment_id=None):
+    return os.path.join(workdir(deployment_id), LEADER_CACHE)
+
+
+def get_cached_master():
+    """
+    Return the cached IP of the cluster leader, or None if it was never
+    cached, was invalidated or is older than `leader_cache_ttl` seconds
+    """
+    ttl = cluster_property('leader_cache_ttl', DEFAULT_LEADER_CACHE_TTL)
+    cache_path = _leader_cache_path()
+    if not ttl or not os.path.isfile(cache_path):
+        return None
+
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except ValueError:
+        return None
+
+    if time.time() - cache['timestamp'] > ttl:
+        return None
+    return cache['master']
+
+
+def cache_master(master_ip):
+    cache_path = _leader_cache_path()
+    temp_path = '{0}.{1}'.format(cache_path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump({'master': master_ip, 'timestamp': time.time()}, f)
+    os.rename(temp_path, cache_path)
+
+
+def invalidate_cached_master(manager_ip):
+    """
+    Drop the cached leader if it is `manager_ip`, so that the next
+    operation will look for the leader again (e.g. after a failover)
+    """
+    cache_path = _leader_cache_path()
+    if get_cached_master() == manager_ip:
+        ctx.logger.debug(
+            'Invalidating the cached cluster leader: {0}'.format(manager_ip)
+        )
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
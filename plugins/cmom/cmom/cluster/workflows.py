@@ -95,12 +95,20 @@ def _get_instances(ctx, host_instance_id):
 
 
 @workflow
-def heal_tier1_manager(ctx, node_instance_id, diagnose_value, **_):
+def heal_tier1_manager(ctx,
+                       node_instance_id,
+                       diagnose_value,
+                       backup_max_age=3600,
+                       **_):
     """
-    1. Validate that one of the CLI profiles is still operation.
-    2. Perform a backup.
-    3. Reinstall the host and the Cloudify Manager (heal workflow).
-    4. Rejoin the cluster.
+    1. Replace the failed manager with a standby manager, if there is one.
+       The cluster's redundancy is restored once this step ends, while the
+       failed manager is rebuilt by the next steps (as the next standby).
+    2. Validate that one of the CLI profiles is still operation.
+    3. Perform a backup, unless there's one from the last `backup_max_age`
+       seconds (downloading only what changed since the last backup).
+    4. Reinstall the host and the Cloudify Manager (heal workflow).
+    5. Rejoin the cluster (or become a standby manager, if replaced).
     """
 
     ctx.logger.info("Starting 'heal' workflow on {0}, Diagnosis: {1}"
@@ -112,7 +120,16 @@ def heal_tier1_manager(ctx, node_instance_id, diagnose_value, **_):
     graph = ctx.graph_mode()
     sequence = graph.sequence()
     sequence.add(
-        _get_task(ctx, 'maintenance_interface.backup'),
+        _get_task(
+            ctx,
+            'maintenance_interface.promote_standby',
+            failed_instance_id=manager_instance.id
+        ),
+        _get_task(
+            ctx,
+            'maintenance_interface.backup',
+            max_age=backup_max_age
+        ),
         uninstall_node_instance_subgraph(
             manager_instance, graph, ignore_failure=True
         ),
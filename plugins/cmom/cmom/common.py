@@ -1,23 +1,97 @@
 import os
 import json
+import time
+import Queue
+import signal
+import threading
 import subprocess
+from collections import deque
 
 from cloudify import ctx
-from cloudify.exceptions import CommandExecutionException
+from cloudify.state import current_ctx
+from cloudify.exceptions import CommandExecutionException, RecoverableError
 
 FILE_SERVER_BASE = '/opt/manager/resources'
 DEFAULT_TENANT = 'default_tenant'
 INSTALL_RPM = 'cloudify-manager-install.rpm'
+INSTALL_PACKAGE = 'cloudify-manager-install'
 CA_CERT = 'ca_cert.pem'
 CA_KEY = 'ca_key.pem'
 
+# The version of an RPM package, and the MD5 of its header and payload,
+# which identify the exact package installed from an RPM file
+RPM_QUERY_FORMAT = '{"version": "%{VERSION}-%{RELEASE}", "md5": "%{SIGMD5}"}'
+
+# Only the last OUTPUT_BUFFER_LINES lines of a command's output are kept
+# in memory (unless the whole output is needed, e.g. to parse it as JSON)
+OUTPUT_BUFFER_LINES = 1000
+
+# The output is logged in batches of up to LOG_BATCH_LINES lines or
+# LOG_BATCH_SIZE bytes, and at least once every LOG_BATCH_INTERVAL seconds
+LOG_BATCH_LINES = 100
+LOG_BATCH_SIZE = 64 * 1024
+LOG_BATCH_INTERVAL = 2
+
+# Default timeouts (in seconds) of commands, by their longest matching
+# prefix: status probes should fail fast (e.g. when a manager is down
+# during a failover), while installs can take a long time
+DEFAULT_COMMAND_TIMEOUT = 60 * 60
+COMMAND_TIMEOUTS = [
+    (['cfy', 'status'], 30),
+    (['cfy', 'cluster', 'status'], 30),
+    (['cfy', 'cluster', 'nodes', 'list'], 30),
+    (['cfy', 'executions', 'get'], 30),
+    (['cfy', 'profiles'], 60),
+    (['cfy', 'cluster', 'join'], 30 * 60),
+    (['cfy', 'snapshots', 'upload'], 2 * 60 * 60),
+    (['cfy', 'snapshots', 'download'], 2 * 60 * 60),
+    (['cfy', 'executions', 'start'], 4 * 60 * 60),
+    (['cfy', 'agents', 'install'], 4 * 60 * 60),
+    (['cfy_manager', 'install'], 2 * 60 * 60),
+]
+
+# How long to wait for a timed out command to exit after SIGTERM, before
+# sending it SIGKILL
+KILL_GRACE_PERIOD = 5
+
+
+class CommandTimeoutException(CommandExecutionException, RecoverableError):
+    """
+    Raised when a command was killed for not finishing within its timeout.
+    It is a `RecoverableError`, so the operation will be retried
+    """
+    def __init__(self, command, timeout, output):
+        CommandExecutionException.__init__(
+            self,
+            command,
+            error='Timed out after {0} seconds'.format(timeout),
+            output=output,
+            code=-1
+        )
+        self.timeout = timeout
+        self.retry_after = None
+        self.causes = []
+
+
+def command_timeout(cmd):
+    """
+    Return the default timeout of `cmd`, by the longest matching prefix in
+    COMMAND_TIMEOUTS
+    """
+    timeouts = [
+        (len(prefix), timeout) for prefix, timeout in COMMAND_TIMEOUTS
+        if cmd[:len(prefix)] == prefix
+    ]
+    return max(timeouts)[1] if timeouts else DEFAULT_COMMAND_TIMEOUT
+
 
 def execute_and_log(cmd,
                     clean_env=False,
                     deployment_workdir=None,
                     no_log=False,
                     ignore_errors=False,
-                    is_json=False):
+                    is_json=False,
+                    timeout=None):
     """
     Execute a command and log each line of its output as it is printed to
     stdout
@@ -34,6 +108,9 @@ def execute_and_log(cmd,
     :param ignore_errors: Don't raise an exception on errors if True
     :param is_json: If set to True, assume the output is a JSON and parse it
         as such
+    :param timeout: Kill the command (and any processes it started) if it
+        didn't finish after this many seconds, and raise a
+        `CommandTimeoutException`. Defaults to the command's default timeout
     """
     env = os.environ.copy()
     if clean_env:
@@ -55,7 +132,20 @@ def execute_and_log(cmd,
             return
         raise
 
-    output = _process_output(proc, not no_log)
+    timeout = timeout or command_timeout(cmd)
+    output, timed_out = _process_output(
+        proc, not no_log, keep_all=is_json, deadline=time.time() + timeout
+    )
+    if timed_out:
+        if ignore_errors:
+            ctx.logger.debug(
+                'Command `{0}` timed out after {1} seconds'.format(
+                    cmd, timeout
+                )
+            )
+            return
+        raise CommandTimeoutException(cmd, timeout, output)
+
     return_code = _return_code(proc)
     if return_code and not ignore_errors:
         raise CommandExecutionException(
@@ -77,6 +167,24 @@ def execute_and_log(cmd,
     return output
 
 
+def rpm_package_info(rpm_path=None):
+    """
+    Return the version and checksum of the Cloudify Manager install package
+    in the RPM file `rpm_path`, or of the installed one if no path is passed.
+    Return an empty dict if the package isn't installed (or can't be read)
+    """
+    if rpm_path:
+        query = ['rpm', '-q', '-p', rpm_path]
+    else:
+        query = ['rpm', '-q', INSTALL_PACKAGE]
+    return execute_and_log(
+        query + ['--queryformat', RPM_QUERY_FORMAT],
+        no_log=True,
+        ignore_errors=True,
+        is_json=True
+    ) or {}
+
+
 def workdir(deployment_id=None):
     """Return a workdir based on the current deployment"""
 
@@ -87,16 +195,214 @@ def workdir(deployment_id=None):
     return _workdir
 
 
-def _process_output(proc, should_log):
-    output_list = []
-    log_func = ctx.logger.info if should_log else ctx.logger.debug
-    for stdout_line in iter(proc.stdout.readline, ""):
-        if stdout_line:
-            output_list.append(stdout_line)
-            log_func(stdout_line)
+def start_thread(func, *args):
+    """
+    Run `func(*args)` in a daemon thread. The operation context is thread
+    local, so it is set in the new thread as well, in order for `ctx` (and
+    the operation's inputs) to be usable there
+    """
+    op_ctx = current_ctx.get_ctx()
+    op_inputs = current_ctx.get_parameters()
 
-    output = '\n'.join(output_list)
-    return output
+    def _run():
+        current_ctx.set(op_ctx, op_inputs)
+        try:
+            func(*args)
+        finally:
+            current_ctx.clear()
+
+    thread = threading.Thread(target=_run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class CommandFuture(object):
+    """
+    The pending result of a call started with `submit`
+    """
+    def __init__(self, description):
+        self.description = description
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def _set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def _set_error(self, error):
+        self._error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to end, and return its result (or raise its error)
+        :param timeout: Raise a `CommandTimeoutException` if the call didn't
+            end after this many seconds
+        """
+        if not self._done.wait(timeout):
+            raise CommandTimeoutException(self.description, timeout, '')
+        if self._error:
+            raise self._error
+        return self._result
+
+
+def submit(func, *args, **kwargs):
+    """
+    Call `func(*args, **kwargs)` in a daemon thread, and return a
+    `CommandFuture` of its result
+    """
+    future = CommandFuture(getattr(func, '__name__', repr(func)))
+
+    def _call():
+        try:
+            future._set_result(func(*args, **kwargs))
+        except Exception as e:
+            future._set_error(e)
+
+    start_thread(_call)
+    return future
+
+
+def run_concurrently(func, items, concurrency):
+    """
+    Call `func(item)` for each of `items`, with at most `concurrency` calls
+    running at the same time, and return the results in the same order as
+    `items`. If any of the calls raised an error, the first such error is
+    raised once all the calls have finished
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    pending = Queue.Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    def _worker():
+        while True:
+            try:
+                index, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as e:
+                errors.append(e)
+
+    workers = [
+        start_thread(_worker)
+        for _ in range(min(max(concurrency, 1), len(items)))
+    ]
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+def _read_lines(stream, lines):
+    for line in iter(stream.readline, ''):
+        lines.put(line)
+    lines.put(None)
+
+
+class _LogBatch(object):
+    def __init__(self, log_func):
+        self.log_func = log_func
+        self.lines = []
+        self.size = 0
+        self.started = None
+
+    def add(self, line):
+        if not self.lines:
+            self.started = time.time()
+        self.lines.append(line)
+        self.size += len(line)
+        if len(self.lines) >= LOG_BATCH_LINES or self.size >= LOG_BATCH_SIZE:
+            self.flush()
+
+    def time_left(self):
+        if not self.lines:
+            return None
+        return max(self.started + LOG_BATCH_INTERVAL - time.time(), 0)
+
+    def flush(self):
+        if self.lines:
+            self.log_func(''.join(self.lines).rstrip('\n'))
+        self.lines = []
+        self.size = 0
+
+
+def _process_output(proc, should_log, keep_all=False, deadline=None):
+    """
+    Read the output of the process (in a separate thread, so that the logs
+    can be flushed and the deadline checked while the process is quiet),
+    and return a tuple of the output and whether the process timed out
+    :param keep_all: Return the whole output, instead of its last
+        OUTPUT_BUFFER_LINES lines
+    :param deadline: The time at which the process is killed
+    """
+    output_lines = deque(maxlen=None if keep_all else OUTPUT_BUFFER_LINES)
+    dropped_lines = 0
+    log_batch = _LogBatch(ctx.logger.info if should_log else ctx.logger.debug)
+
+    lines = Queue.Queue()
+    reader = threading.Thread(target=_read_lines, args=(proc.stdout, lines))
+    reader.daemon = True
+    reader.start()
+
+    timed_out = False
+    while True:
+        if deadline and time.time() >= deadline:
+            _kill_process_group(proc)
+            timed_out = True
+            break
+
+        wait_times = [log_batch.time_left()]
+        if deadline:
+            wait_times.append(deadline - time.time())
+        wait_times = [max(wait, 0) for wait in wait_times if wait is not None]
+        try:
+            line = lines.get(timeout=min(wait_times) if wait_times else None)
+        except Queue.Empty:
+            log_batch.flush()
+            continue
+        if line is None:
+            break
+        if line:
+            if len(output_lines) == output_lines.maxlen:
+                dropped_lines += 1
+            output_lines.append(line)
+            log_batch.add(line)
+    log_batch.flush()
+
+    output = '\n'.join(output_lines)
+    if dropped_lines:
+        output = '[{0} lines truncated]\n{1}'.format(dropped_lines, output)
+    return output, timed_out
+
+
+def _kill_process_group(proc):
+    """
+    Terminate the process and all of its children (which are in the same
+    process group), and kill them if they don't exit in time
+    """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            # The process group doesn't exist anymore
+            break
+        grace_deadline = time.time() + KILL_GRACE_PERIOD
+        while proc.poll() is None and time.time() < grace_deadline:
+            time.sleep(0.1)
+        if proc.poll() is not None:
+            break
 
 
 def _run_process(cmd, env):
@@ -104,7 +410,10 @@ def _run_process(cmd, env):
         cmd,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        env=env
+        env=env,
+        # Start a new process group, so that the command can be killed along
+        # with any processes it started
+        preexec_fn=os.setsid
     )
 
 
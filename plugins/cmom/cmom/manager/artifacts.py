@@ -0,0 +1,168 @@
+"""
+A local cache of the artifacts a Tier 1 manager downloads from the Tier 2
+fileserver (the install RPM, the CA cert/key, scripts and files).
+
+The artifacts are downloaded concurrently in the background, and each of
+them can be waited for separately, so that e.g. the RPM can be installed
+while the rest are still being downloaded. Every artifact is verified
+against the SHA256 recorded for it in the deployment's fileserver manifest,
+and artifacts that are already in the cache with the right checksum (e.g.
+when healing a manager on the same host) are not downloaded again.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+from cloudify import ctx
+from cloudify.exceptions import RecoverableError
+from cloudify.manager import download_resource_from_manager
+
+from ..common import submit
+
+CACHE_FOLDER = 'artifacts'
+MANIFEST = '.manifest.json'
+
+# How many artifacts are downloaded at the same time
+DEFAULT_CONCURRENCY = 4
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _download(file_name, target=None):
+    """
+    Download a file that was put in the Tier 2 manager's file server,
+    under a DEP_ID folder
+    """
+    remote_path = os.path.join(ctx.deployment.id, file_name)
+    return download_resource_from_manager(
+        remote_path,
+        target_path=target,
+        logger=ctx.logger
+    )
+
+
+def _load_manifest(cache_dir):
+    """
+    Download the deployment's fileserver manifest, which maps the names of
+    the artifacts to their checksums. Return an empty manifest if it can't
+    be downloaded (e.g. if the fileserver was set up by an older version),
+    in which case nothing is verified or taken from the cache
+    """
+    manifest_path = os.path.join(cache_dir, MANIFEST)
+    try:
+        _download(MANIFEST, target=manifest_path)
+        with open(manifest_path) as f:
+            return json.load(f)
+    except Exception as e:
+        ctx.logger.warning(
+            'Could not download the fileserver manifest, the artifacts '
+            'will not be verified: {0}'.format(e)
+        )
+        return {}
+
+
+class ArtifactCache(object):
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        self.path = os.path.join(os.path.expanduser('~'), CACHE_FOLDER)
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+        self.manifest = _load_manifest(self.path)
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+
+    def checksum(self, file_name):
+        return self.manifest.get(file_name, {}).get('hash')
+
+    def package_info(self, file_name):
+        """
+        Return the version and checksum of the package in an RPM artifact
+        """
+        return self.manifest.get(file_name, {}).get('package') or {}
+
+    def _is_cached(self, cached_path, checksum):
+        return checksum and os.path.isfile(cached_path) and \
+            _file_hash(cached_path) == checksum
+
+    def _fetch(self, file_name):
+        cached_path = os.path.join(self.path, file_name)
+        checksum = self.checksum(file_name)
+        if self._is_cached(cached_path, checksum):
+            ctx.logger.debug('Using cached {0}'.format(file_name))
+            return cached_path
+
+        with self._semaphore:
+            ctx.logger.debug('Downloading {0}...'.format(file_name))
+            fd, temp_path = tempfile.mkstemp(dir=self.path)
+            os.close(fd)
+            try:
+                _download(file_name, target=temp_path)
+                if checksum and _file_hash(temp_path) != checksum:
+                    raise RecoverableError(
+                        'Downloaded {0} does not match its checksum'.format(
+                            file_name
+                        )
+                    )
+            except Exception:
+                os.remove(temp_path)
+                raise
+        os.rename(temp_path, cached_path)
+        return cached_path
+
+    def _future(self, file_name):
+        with self._lock:
+            future = self._futures.get(file_name)
+            # A failed download is started again when the artifact is needed
+            if not future or (future.done() and future._error):
+                future = submit(self._fetch, file_name)
+                future.description = 'Download of {0}'.format(file_name)
+                self._futures[file_name] = future
+            return self._futures[file_name]
+
+    def prefetch(self, paths, all_artifacts=False, exclude=()):
+        """
+        Start downloading the artifacts in `paths` (in this order) in the
+        background
+        :param all_artifacts: Then download all the other artifacts in the
+            manifest as well
+        :param exclude: Artifacts of the manifest not to download
+        """
+        file_names = [os.path.basename(path) for path in paths]
+        if all_artifacts:
+            file_names += sorted(
+                set(self.manifest) - set(file_names) - set(exclude)
+            )
+        for file_name in file_names:
+            self._future(file_name)
+
+    def get(self, path, timeout=None):
+        """
+        Return the local path of the artifact, waiting for its download
+        (which is started if it wasn't prefetched)
+        """
+        return self._future(os.path.basename(path)).result(timeout)
+
+    def wait(self):
+        """
+        Wait for all the prefetched artifacts, as the downloads would be
+        stopped when the operation ends. Failures are only logged, as the
+        download is started again when the artifact is actually needed
+        """
+        with self._lock:
+            futures = self._futures.items()
+        for file_name, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                ctx.logger.warning(
+                    'Failed prefetching {0}: {1}'.format(file_name, e)
+                )
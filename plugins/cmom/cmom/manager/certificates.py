@@ -0,0 +1,113 @@
+"""
+Issuing of the Tier 1 managers' external certificates, signed by the CA
+cert/key from the Tier 2 fileserver.
+
+The certificates are the same as the ones `cfy_manager create-external-certs`
+creates (a CN of the public IP, and both IPs as subject alternative names),
+only they are generated in-process.
+"""
+
+import os
+import datetime
+import tempfile
+import ipaddress
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+KEY_SIZE = 2048
+VALIDITY_DAYS = 3650
+
+
+def _load_ca(ca_cert_path, ca_key_path):
+    with open(ca_cert_path, 'rb') as f:
+        ca_cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+    with open(ca_key_path, 'rb') as f:
+        ca_key = serialization.load_pem_private_key(
+            f.read(), password=None, backend=default_backend()
+        )
+    return ca_cert, ca_key
+
+
+def _alt_names(addresses):
+    alt_names = []
+    for address in addresses:
+        address = unicode(address)
+        try:
+            alt_names.append(x509.IPAddress(ipaddress.ip_address(address)))
+        except ValueError:
+            # A hostname
+            pass
+        alt_names.append(x509.DNSName(address))
+    return alt_names
+
+
+def _write_atomically(path, data, mode=0o644):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.chmod(temp_path, mode)
+    os.rename(temp_path, path)
+
+
+def create_external_cert(cert_path,
+                         key_path,
+                         chain_path,
+                         ca_cert_path,
+                         ca_key_path,
+                         private_ip,
+                         public_ip):
+    """
+    Generate a key and a certificate for the manager's IPs, signed by the CA,
+    and write them to `key_path` and `cert_path`. A chain of the certificate
+    and the CA cert is written to `chain_path`
+    """
+    ca_cert, ca_key = _load_ca(ca_cert_path, ca_key_path)
+    key = rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=KEY_SIZE,
+        backend=default_backend()
+    )
+    addresses = [public_ip]
+    if private_ip != public_ip:
+        addresses.append(private_ip)
+
+    subject = x509.Name(
+        [x509.NameAttribute(NameOID.COMMON_NAME, unicode(public_ip))]
+    )
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(
+        subject
+    ).issuer_name(
+        ca_cert.subject
+    ).public_key(
+        key.public_key()
+    ).serial_number(
+        x509.random_serial_number()
+    ).not_valid_before(
+        now - datetime.timedelta(days=1)
+    ).not_valid_after(
+        now + datetime.timedelta(days=VALIDITY_DAYS)
+    ).add_extension(
+        x509.SubjectAlternativeName(_alt_names(addresses)),
+        critical=False
+    ).sign(ca_key, hashes.SHA256(), default_backend())
+
+    cert_pem = cert.public_bytes(serialization.Encoding.PEM)
+    _write_atomically(key_path, key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption()
+    ), mode=0o600)
+    _write_atomically(cert_path, cert_pem)
+    # We chain the external CA to the external cert, to avoid bootstrap errors
+    # when running `cfy profiles set -c`
+    _write_atomically(
+        chain_path,
+        cert_pem + os.linesep + ca_cert.public_bytes(
+            serialization.Encoding.PEM
+        )
+    )
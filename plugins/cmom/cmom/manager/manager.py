@@ -9,35 +9,70 @@ from cloudify import ctx
 from cloudify.decorators import operation
 from cloudify.state import ctx_parameters as inputs
 from cloudify.exceptions import CommandExecutionException
-from cloudify.manager import download_resource_from_manager
 
 from ..common import (
     execute_and_log,
+    rpm_package_info,
     INSTALL_RPM,
+    INSTALL_PACKAGE,
     CA_CERT,
     CA_KEY
 )
+from .artifacts import ArtifactCache
+
+try:
+    from .certificates import create_external_cert
+except ImportError:
+    # `cryptography` is optional (the `certificates` extra), as it needs to
+    # be compiled into the wagon. Without it, the certificates are created
+    # by `cfy_manager` instead
+    create_external_cert = None
 
-INSTALL_RPM_PATH = '/tmp/cloudify-manager-install.rpm'
 CONFIG_PATH = '/etc/cloudify/config.yaml'
-EXTERNAL_KEY_PATH = '/etc/cloudify/ssl/cloudify_external_key.pem'
-EXTERNAL_CERT_PATH = '/etc/cloudify/ssl/cloudify_external_cert.pem'
+SSL_DIR = '/etc/cloudify/ssl'
+EXTERNAL_KEY_PATH = os.path.join(SSL_DIR, 'cloudify_external_key.pem')
+EXTERNAL_CERT_PATH = os.path.join(SSL_DIR, 'cloudify_external_cert.pem')
 
 
-def _download_rpm():
+def _download_rpm(cache):
     ctx.logger.info('Downloading Cloudify Manager installation RPM...')
-    _download_file(INSTALL_RPM, target=INSTALL_RPM_PATH)
+    rpm_path = cache.get(INSTALL_RPM)
     ctx.logger.info('Install RPM downloaded successfully')
+    return rpm_path
 
 
-def _install_rpm():
+def _install_rpm(rpm_path, upgrade=False):
+    """
+    :param upgrade: Replace a different version of the package that is
+        already installed
+    """
     ctx.logger.info('Installing RPM...')
-    execute_and_log(['sudo', 'rpm', '-i', INSTALL_RPM_PATH])
-
-    os.remove(INSTALL_RPM_PATH)
+    if upgrade:
+        install_cmd = ['rpm', '-U', '--replacepkgs', '--oldpackage']
+    else:
+        install_cmd = ['rpm', '-i']
+    # The RPM is kept in the artifacts cache, for future heals
+    execute_and_log(['sudo'] + install_cmd + [rpm_path])
     ctx.logger.info('RPM installed successfully')
 
 
+def _is_rpm_preinstalled(cache, installed):
+    """
+    Check whether the exact package in the fileserver's install RPM is
+    already installed (e.g. when using a pre-baked image)
+    """
+    expected = cache.package_info(INSTALL_RPM)
+    if not installed or not expected:
+        return False
+    if installed != expected:
+        ctx.logger.info(
+            'Installed package {0} does not match the install RPM {1}, '
+            'it will be replaced'.format(installed, expected)
+        )
+        return False
+    return True
+
+
 def _dict_merge(dct, merge_dct):
     """ Recursive dict merge. Inspired by :meth:``dict.update()``, instead of
     updating only top-level keys, dict_merge recurses down into dicts nested
@@ -97,42 +132,77 @@ def _remove_manager():
 
 def _uninstall_rpm():
     ctx.logger.info('Removing RPM...')
-    execute_and_log(['yum', 'remove', '-y', 'cloudify-manager-install'])
+    execute_and_log(['yum', 'remove', '-y', INSTALL_PACKAGE])
 
 
 def _certs_dir():
     return os.path.join(os.path.expanduser('~'), 'certificates')
 
 
-def _download_ca_cert_and_key():
+def _download_ca_cert_and_key(cache):
     """
     Download CA cert and key from the Tier 2 fileserver
     """
     ctx.logger.info('Downloading certificates to a local path...')
     ca_cert = os.path.join(_certs_dir(), CA_CERT)
     ca_key = os.path.join(_certs_dir(), CA_KEY)
-    _download_file(CA_CERT, target=ca_cert)
-    _download_file(CA_KEY, target=ca_key)
+    shutil.copy(cache.get(CA_CERT), ca_cert)
+    shutil.copy(cache.get(CA_KEY), ca_key)
     return ca_cert, ca_key
 
 
-def _copy_external_cert_and_key(ca_cert, ca_key):
-    ctx.logger.info('Copying external cert and key...')
-
-    external_cert = os.path.join(_certs_dir(), 'external_cert.pem')
-    external_key = os.path.join(_certs_dir(), 'external_key.pem')
-    shutil.copy(EXTERNAL_CERT_PATH, external_cert)
-    shutil.copy(EXTERNAL_KEY_PATH, external_key)
+def _create_external_cert_with_cli(cert_path,
+                                   key_path,
+                                   chain_path,
+                                   ca_cert_path,
+                                   ca_key_path,
+                                   private_ip,
+                                   public_ip):
+    """
+    The same as `certificates.create_external_cert`, using `cfy_manager`
+    """
+    # Need to create the `ssl` folder; it's not generated by default
+    execute_and_log(['sudo', 'mkdir', '-p', SSL_DIR])
+    execute_and_log([
+        'cfy_manager', 'create-external-certs',
+        '--private-ip', private_ip,
+        '--public-ip', public_ip,
+        '--sign-cert', ca_cert_path,
+        '--sign-key', ca_key_path
+    ])
+    shutil.copy(EXTERNAL_CERT_PATH, cert_path)
+    shutil.copy(EXTERNAL_KEY_PATH, key_path)
 
     # We chain the external CA to the external cert, to avoid bootstrap errors
     # when running `cfy profiles set -c`
-    chain_cert = os.path.join(_certs_dir(), 'chained_external_cert.pem')
-    with open(chain_cert, 'w') as chain_cert_f:
-        with open(external_cert, 'r') as external_cert_f:
+    with open(chain_path, 'w') as chain_cert_f:
+        with open(cert_path, 'r') as external_cert_f:
             chain_cert_f.write(external_cert_f.read())
         chain_cert_f.write(os.linesep)
-        with open(ca_cert, 'r') as ca_cert_f:
+        with open(ca_cert_path, 'r') as ca_cert_f:
             chain_cert_f.write(ca_cert_f.read())
+    # Delete the ssl dir; it will be created by the installation
+    execute_and_log(['sudo', 'rm', '-rf', SSL_DIR])
+
+
+def _generate_external_cert_and_key(cache):
+    ca_cert, ca_key = _download_ca_cert_and_key(cache)
+
+    external_cert = os.path.join(_certs_dir(), 'external_cert.pem')
+    external_key = os.path.join(_certs_dir(), 'external_key.pem')
+    chain_cert = os.path.join(_certs_dir(), 'chained_external_cert.pem')
+
+    manager_conf = inputs['config']['manager']
+    ctx.logger.info('Generating new external certificate...')
+    (create_external_cert or _create_external_cert_with_cli)(
+        cert_path=external_cert,
+        key_path=external_key,
+        chain_path=chain_cert,
+        ca_cert_path=ca_cert,
+        ca_key_path=ca_key,
+        private_ip=manager_conf['private_ip'],
+        public_ip=manager_conf['public_ip']
+    )
 
     ssl_inputs = inputs['config'].setdefault('ssl_inputs', {})
 
@@ -143,27 +213,6 @@ def _copy_external_cert_and_key(ca_cert, ca_key):
     ssl_inputs['ca_key_path'] = ca_key
 
 
-def _generate_external_cert_and_key():
-    ca_cert, ca_key = _download_ca_cert_and_key()
-
-    # Need to create the `ssl` folder; it's not generated by default
-    ssl_dir = '/etc/cloudify/ssl'
-    execute_and_log(['sudo', 'mkdir', ssl_dir])
-
-    manager_conf = inputs['config']['manager']
-    ctx.logger.info('Generating new external certificate...')
-    execute_and_log([
-        'cfy_manager', 'create-external-certs',
-        '--private-ip', manager_conf['private_ip'],
-        '--public-ip', manager_conf['public_ip'],
-        '--sign-cert', ca_cert,
-        '--sign-key', ca_key
-    ])
-    _copy_external_cert_and_key(ca_cert, ca_key)
-    # Delete the ssl dir; it will be created by the installation
-    execute_and_log(['sudo', 'rm', '-rf', ssl_dir])
-
-
 def _set_ca_cert_in_cli_profile():
     """
     Set the CA cert in the CLI profile, instead of the external cert.
@@ -178,24 +227,10 @@ def _set_ca_cert_in_cli_profile():
     execute_and_log(['sudo', '-u', 'root'] + set_cmd, clean_env=True)
 
 
-def _download_file(path, target=None):
-    """
-    Download a file that was put in the Tier 2 manager's file server,
-    under a DEP_ID folder
-    """
-    file_name = os.path.basename(path)
-    remote_path = os.path.join(ctx.deployment.id, file_name)
-    return download_resource_from_manager(
-        remote_path,
-        target_path=target,
-        logger=ctx.logger
-    )
-
-
-def _execute_scripts():
+def _execute_scripts(cache):
     ctx.logger.info('Executing post-install scripts...')
     for script in inputs['scripts']:
-        script_path = _download_file(script)
+        script_path = cache.get(script)
         execute_and_log(['chmod', '+x', script_path])
 
         script_name = os.path.basename(script)
@@ -209,10 +244,10 @@ def _execute_scripts():
             ctx.logger.warning('Error: {0}'.format(e.error))
 
 
-def _download_files():
+def _download_files(cache):
     ctx.logger.info('Downloading files...')
     for item in inputs['files']:
-        _download_file(item['src'], target=item['dst'])
+        shutil.copy(cache.get(item['src']), item['dst'])
 
 
 @operation
@@ -221,22 +256,47 @@ def install_rpm(**_):
     Install the Cloudify Manager install RPM and set the runtime properties
     to include the entire manager config
     """
-    _download_rpm()
-    _install_rpm()
-
-    os.mkdir(_certs_dir())
-
-    _generate_external_cert_and_key()
+    # All the artifacts (including the scripts and files needed later by
+    # `install_manager`) are downloaded while the RPM is being installed
+    cache = ArtifactCache()
+    installed = rpm_package_info()
+    preinstalled = _is_rpm_preinstalled(cache, installed)
+    if preinstalled:
+        ctx.logger.info(
+            'Package {0} is already installed, skipping the download and '
+            'installation of the RPM'.format(installed['version'])
+        )
+        cache.prefetch(
+            [CA_CERT, CA_KEY], all_artifacts=True, exclude=[INSTALL_RPM]
+        )
+    else:
+        cache.prefetch([INSTALL_RPM, CA_CERT, CA_KEY], all_artifacts=True)
+        _install_rpm(_download_rpm(cache), upgrade=bool(installed))
+
+    ctx.instance.runtime_properties['rpm_preinstalled'] = preinstalled
+    if not preinstalled:
+        installed = rpm_package_info()
+    ctx.instance.runtime_properties['rpm_version'] = installed.get('version')
+
+    if not os.path.isdir(_certs_dir()):
+        os.mkdir(_certs_dir())
+
+    _generate_external_cert_and_key(cache)
     _update_runtime_properties()
+    cache.wait()
 
 
 @operation
 def install_manager(**_):
+    cache = ArtifactCache()
+    cache.prefetch(
+        [item['src'] for item in inputs['files']] + inputs['scripts']
+    )
     _dump_configuration()
     _install_manager()
     _set_ca_cert_in_cli_profile()
-    _download_files()
-    _execute_scripts()
+    _download_files(cache)
+    _execute_scripts(cache)
 
 
 @operation
@@ -1,51 +1,221 @@
 import os
+import json
+import stat
+import fcntl
 import shutil
+import hashlib
+from contextlib import contextmanager
 
 from cloudify import ctx
 from cloudify.decorators import operation
 from cloudify.state import ctx_parameters as inputs
 
-from ..common import CA_KEY, CA_CERT, INSTALL_RPM, execute_and_log
+from ..common import (
+    CA_KEY,
+    CA_CERT,
+    INSTALL_RPM,
+    execute_and_log,
+    rpm_package_info
+)
 
 FILE_SERVER_BASE = '/opt/manager/resources'
 DEP_DIR = None
 
+# The files of all the deployments are stored once, under their SHA256 (and
+# permissions), in BLOBS_DIR. The deployment folders only contain hard links
+# to them, so the number of links to each blob is the number of deployments
+# using it
+BLOBS_DIR = os.path.join(FILE_SERVER_BASE, '.blobs')
+MANIFEST = '.manifest.json'
 
-def _copy_install_rpm():
+COPIED = 'copied'
+LINKED = 'linked'
+SKIPPED = 'skipped'
+
+
+@contextmanager
+def _blobs_lock():
+    """
+    Serialize linking/unlinking blobs between deployments, so that a blob
+    isn't deleted while another deployment is linking to it
+    """
+    with open(os.path.join(BLOBS_DIR, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _blob_path(file_hash, mode):
+    # All the links to a blob share its permissions, so the same content is
+    # stored once for each of the permissions it's used with
+    return os.path.join(
+        BLOBS_DIR, file_hash[:2], '{0}.{1:o}'.format(file_hash, mode)
+    )
+
+
+def _load_manifest():
+    manifest_path = os.path.join(_dep_dir(), MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest):
+    manifest_path = os.path.join(_dep_dir(), MANIFEST)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def _link_blob(src_path, dst_path, file_hash, mode, manifest):
+    """
+    Store the content of `src_path` as a blob with `mode` permissions
+    (unless it's already stored), and link `dst_path` to it. Return COPIED
+    if the blob had to be stored, LINKED if it was only linked, or SKIPPED
+    if it was already linked
+    """
+    blob_path = _blob_path(file_hash, mode)
+    result = LINKED
+
+    with _blobs_lock():
+        if not os.path.exists(blob_path):
+            blob_dir = os.path.dirname(blob_path)
+            if not os.path.isdir(blob_dir):
+                os.mkdir(blob_dir)
+            temp_path = '{0}.{1}'.format(blob_path, os.getpid())
+            shutil.copy(src_path, temp_path)
+            os.chmod(temp_path, mode)
+            os.rename(temp_path, blob_path)
+            result = COPIED
+
+        if os.path.exists(dst_path) and os.path.samefile(dst_path, blob_path):
+            return SKIPPED
+        if os.path.lexists(dst_path):
+            _unlink(dst_path, manifest)
+        os.link(blob_path, dst_path)
+    return result
+
+
+def _unlink(path, manifest):
+    """
+    Remove a file of a deployment, and the blob it's linked to, if no other
+    deployment is using it (the blob itself is always one of its links)
+    """
+    file_stat = os.stat(path)
+    os.remove(path)
+    if file_stat.st_nlink != 2:
+        return
+    entry = manifest.get(os.path.basename(path)) or {}
+    if not entry.get('hash') or entry.get('mode') is None:
+        return
+    blob_path = _blob_path(entry['hash'], entry['mode'])
+    if os.path.exists(blob_path):
+        os.remove(blob_path)
+
+
+class _FileServerSync(object):
+    """
+    Sync files into the deployment's folder on the fileserver. The source
+    path, size, mtime and hash of every file are kept in the folder's
+    manifest, so files whose source didn't change since the last sync (e.g.
+    on a heal or a re-install) are skipped without even being read
+    """
+    def __init__(self):
+        self.manifest = _load_manifest()
+        self.stats = {COPIED: 0, LINKED: 0, SKIPPED: 0}
+
+    def _is_unchanged(self, src_path, src_stat, dst_path, mode):
+        entry = self.manifest.get(os.path.basename(dst_path)) or {}
+        return entry.get('src') == src_path and \
+            entry.get('size') == src_stat.st_size and \
+            entry.get('mtime') == src_stat.st_mtime and \
+            entry.get('mode') == mode and \
+            os.path.exists(dst_path)
+
+    def copy(self, src_path, dst_path, mode=None):
+        """
+        :param mode: The permissions of the file (defaults to the source's)
+        """
+        src_stat = os.stat(src_path)
+        if mode is None:
+            mode = stat.S_IMODE(src_stat.st_mode)
+        if self._is_unchanged(src_path, src_stat, dst_path, mode):
+            result = SKIPPED
+        else:
+            file_hash = _file_hash(src_path)
+            result = _link_blob(
+                src_path, dst_path, file_hash, mode, self.manifest
+            )
+            self.manifest[os.path.basename(dst_path)] = {
+                'src': src_path,
+                'size': src_stat.st_size,
+                'mtime': src_stat.st_mtime,
+                'hash': file_hash,
+                'mode': mode
+            }
+        self.stats[result] += src_stat.st_size
+
+    def save(self):
+        _save_manifest(self.manifest)
+        ctx.logger.info(
+            'Fileserver sync: {0} bytes copied, {1} bytes linked to existing '
+            'files, {2} bytes skipped as unchanged'.format(
+                self.stats[COPIED], self.stats[LINKED], self.stats[SKIPPED]
+            )
+        )
+        return self.stats
+
+
+def _copy_install_rpm(sync):
     """
     Copy the installation RPM over to the fileserver, so that the
     Tier 1 managers will be able to use `ctx` to download it
     """
     ctx.logger.info('Copying the installation RPM to the fileserver...')
     install_rpm_path = os.path.join(_dep_dir(), INSTALL_RPM)
-    shutil.copy(inputs['install_rpm_path'], install_rpm_path)
+    sync.copy(inputs['install_rpm_path'], install_rpm_path)
+
+    # The package's version and checksum let the Tier 1 managers skip the
+    # RPM if they already have the same package installed (e.g. in an image)
+    entry = sync.manifest[INSTALL_RPM]
+    if not entry.get('package'):
+        entry['package'] = rpm_package_info(install_rpm_path)
 
 
-def _copy_ca_cert_and_key():
+def _copy_ca_cert_and_key(sync):
     ctx.logger.info('Copying the CA cert/key to the fileserver...')
     ca_cert_path = os.path.join(_dep_dir(), CA_CERT)
     ca_key_path = os.path.join(_dep_dir(), CA_KEY)
-    shutil.copy(inputs['ca_cert'], ca_cert_path)
-    shutil.copy(inputs['ca_key'], ca_key_path)
+    sync.copy(inputs['ca_cert'], ca_cert_path)
+    sync.copy(inputs['ca_key'], ca_key_path)
 
 
-def _copy_list(paths):
+def _copy_list(sync, paths):
     for src_path in paths:
         file_name = os.path.basename(src_path)
         dst_path = os.path.join(_dep_dir(), file_name)
-        shutil.copy(src_path, dst_path)
-        execute_and_log(['chmod', '644', dst_path])
+        sync.copy(src_path, dst_path, mode=0o644)
 
 
-def _copy_scripts():
+def _copy_scripts(sync):
     ctx.logger.info('Copying scripts to the fileserver...')
-    _copy_list(inputs['scripts'])
+    _copy_list(sync, inputs['scripts'])
 
 
-def _copy_files():
+def _copy_files(sync):
     ctx.logger.info('Copying files to the fileserver...')
     # Only getting the Tier 2 paths of the files
-    _copy_list([f['src'] for f in inputs['files']])
+    _copy_list(sync, [f['src'] for f in inputs['files']])
 
 
 def _dep_dir():
@@ -62,16 +232,31 @@ def setup_fileserver(**_):
     """
     if not os.path.exists(_dep_dir()):
         os.mkdir(_dep_dir())
-    _copy_install_rpm()
-    _copy_ca_cert_and_key()
-    _copy_scripts()
-    _copy_files()
+    if not os.path.exists(BLOBS_DIR):
+        os.mkdir(BLOBS_DIR)
+    sync = _FileServerSync()
+    try:
+        _copy_install_rpm(sync)
+        _copy_ca_cert_and_key(sync)
+        _copy_scripts(sync)
+        _copy_files(sync)
+    finally:
+        stats = sync.save()
+    return stats
 
 
 @operation
 def cleanup_fileserver(**_):
     """
-    Delete the install RPM and CA cert/key from the fileserver
+    Delete the install RPM and CA cert/key from the fileserver, along with
+    the blobs that no other deployment uses
     """
     ctx.logger.info('Cleaning up fileserver...')
+    if os.path.isdir(BLOBS_DIR):
+        manifest = _load_manifest()
+        with _blobs_lock():
+            for file_name in manifest:
+                path = os.path.join(_dep_dir(), file_name)
+                if os.path.exists(path):
+                    _unlink(path, manifest)
     execute_and_log(['rm', '-rf', _dep_dir()], ignore_errors=True)
@@ -0,0 +1,27 @@
+import shutil
+import tempfile
+import unittest
+
+from cloudify.mocks import MockCloudifyContext
+from cloudify.state import current_ctx
+
+
+class CmomTestCase(unittest.TestCase):
+    """
+    Runs each test in the operation context of a node of the `dep`
+    deployment, with a temporary folder (`self.tempdir`) for its files
+    """
+    def setUp(self):
+        current_ctx.set(MockCloudifyContext(deployment_id='dep'))
+        self.addCleanup(current_ctx.clear)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def patch(self, obj, name, value):
+        """
+        Set the `name` attribute of `obj` (e.g. a module's constant) to
+        `value` until the end of the test
+        """
+        original = getattr(obj, name)
+        setattr(obj, name, value)
+        self.addCleanup(setattr, obj, name, original)
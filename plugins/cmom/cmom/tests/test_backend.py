@@ -0,0 +1,78 @@
+from contextlib import contextmanager
+
+from cloudify.exceptions import NonRecoverableError
+
+from cmom.cluster import backend
+from cmom.cluster.maintenance import _wait_for_execution
+
+from . import CmomTestCase
+
+
+class FakeExecutions(object):
+    def __init__(self, status):
+        self.status = status
+
+    def get(self, execution_id):
+        return {'id': execution_id, 'status': self.status, 'error': ''}
+
+
+class FakeRestClient(object):
+    def __init__(self, status):
+        self.executions = FakeExecutions(status)
+
+
+@contextmanager
+def _no_profile():
+    yield
+
+
+class GetExecutionTestCase(CmomTestCase):
+    def _wait(self, execution_backend):
+        _wait_for_execution(execution_backend, 'exec', 1, 'testing')
+
+
+class RestGetExecutionTest(GetExecutionTestCase):
+    def _backend(self, status):
+        self.patch(backend, '_get_client',
+                   lambda *_, **__: FakeRestClient(status))
+        return backend.RestBackend('1.1.1.1', None)
+
+    def test_terminated(self):
+        execution_backend = self._backend('terminated')
+        self.assertEqual(
+            execution_backend.get_execution('exec')['status'], 'terminated'
+        )
+        self._wait(execution_backend)
+
+    def test_failed(self):
+        self.assertRaises(NonRecoverableError,
+                          self._wait, self._backend('failed'))
+
+
+class CliGetExecutionTest(GetExecutionTestCase):
+    def _backend(self, status):
+        commands = []
+
+        def execute_and_log(cmd, **_):
+            commands.append(cmd)
+            return {'id': 'exec', 'status': status, 'error': ''}
+
+        self.patch(backend, 'execute_and_log', execute_and_log)
+        execution_backend = backend.CliBackend('1.1.1.1', None)
+        execution_backend._profile = _no_profile
+        return execution_backend, commands
+
+    def test_completed(self):
+        execution_backend, commands = self._backend('completed')
+        self.assertEqual(
+            execution_backend.get_execution('exec')['status'], 'terminated'
+        )
+        self.assertEqual(commands, [['cfy', 'executions', 'get', 'exec']])
+        self._wait(execution_backend)
+
+    def test_failed(self):
+        execution_backend, _ = self._backend('failed')
+        self.assertEqual(
+            execution_backend.get_execution('exec')['status'], 'failed'
+        )
+        self.assertRaises(NonRecoverableError, self._wait, execution_backend)
@@ -0,0 +1,39 @@
+import unittest
+
+from cmom.common import command_timeout, DEFAULT_COMMAND_TIMEOUT
+
+
+class CommandTimeoutTest(unittest.TestCase):
+    def test_exact_prefix(self):
+        self.assertEqual(command_timeout(['cfy', 'status']), 30)
+
+    def test_longest_prefix_wins(self):
+        # Both `cfy cluster status` and `cfy cluster join` are under
+        # `cfy cluster`, but have very different timeouts
+        self.assertEqual(
+            command_timeout(['cfy', 'cluster', 'status', '--json']), 30
+        )
+        self.assertEqual(
+            command_timeout(['cfy', 'cluster', 'join', 'master']), 30 * 60
+        )
+
+    def test_arguments_are_ignored(self):
+        self.assertEqual(
+            command_timeout(['cfy', 'snapshots', 'download', 'snap', '-o',
+                             '/tmp/snap.zip']),
+            2 * 60 * 60
+        )
+
+    def test_partial_word_does_not_match(self):
+        self.assertEqual(
+            command_timeout(['cfy', 'stat']), DEFAULT_COMMAND_TIMEOUT
+        )
+
+    def test_unknown_command(self):
+        self.assertEqual(
+            command_timeout(['sudo', 'rpm', '-i', 'x.rpm']),
+            DEFAULT_COMMAND_TIMEOUT
+        )
+
+    def test_shorter_command_than_prefix(self):
+        self.assertEqual(command_timeout(['cfy']), DEFAULT_COMMAND_TIMEOUT)
@@ -0,0 +1,240 @@
+import os
+import json
+
+import requests
+
+from cmom.cluster import download
+from cmom.cluster.snapshot_store import SnapshotStore, manifest_path
+
+from . import CmomTestCase
+from .test_snapshot_store import create_archive
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+class FakeResponse(object):
+    def __init__(self, data):
+        self.data = data
+
+    def bytes_stream(self, chunk_size):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeHTTPClient(object):
+    """
+    Serves range requests of `archive`. Requests for ranges starting at any
+    of the `failing` offsets fail
+    """
+    def __init__(self, archive, failing=()):
+        self.archive = archive
+        self.failing = set(failing)
+        self.requested = []
+
+    def get(self, uri, headers, expected_status_code, stream, timeout):
+        start, end = headers['Range'][len('bytes='):].split('-')
+        start, end = int(start), int(end) + 1
+        self.requested.append((start, end))
+        if start in self.failing:
+            raise requests.exceptions.ConnectionError('Connection reset')
+        return FakeResponse(self.archive[start:end])
+
+
+class FakeClient(object):
+    def __init__(self, archive, failing=()):
+        self._client = FakeHTTPClient(archive, failing)
+
+
+class DownloadTestCase(CmomTestCase):
+    def setUp(self):
+        super(DownloadTestCase, self).setUp()
+        self.patch(download, 'SEGMENT_SIZE', 1000)
+        self.patch(download, 'CHUNK_SIZE', 300)
+
+
+class RateLimiterTest(DownloadTestCase):
+    def setUp(self):
+        super(RateLimiterTest, self).setUp()
+        self.clock = FakeClock()
+        self.patch(download, 'time', self.clock)
+
+    def test_unlimited(self):
+        limiter = download.RateLimiter(None)
+        limiter.consume(10 ** 9)
+        self.assertEqual(self.clock.slept, 0)
+
+    def test_within_allowance(self):
+        limiter = download.RateLimiter(100)
+        limiter.consume(100)
+        self.assertEqual(self.clock.slept, 0)
+
+    def test_over_allowance(self):
+        limiter = download.RateLimiter(100)
+        limiter.consume(100)
+        limiter.consume(50)
+        self.assertAlmostEqual(self.clock.slept, 0.5)
+
+    def test_allowance_is_replenished(self):
+        limiter = download.RateLimiter(100)
+        limiter.consume(100)
+        self.clock.now += 1
+        limiter.consume(100)
+        self.assertEqual(self.clock.slept, 0)
+
+    def test_allowance_is_capped(self):
+        limiter = download.RateLimiter(100)
+        # Being idle doesn't allow bursts over the rate
+        self.clock.now += 10
+        limiter.consume(300)
+        self.assertAlmostEqual(self.clock.slept, 2)
+
+
+class SplitTest(DownloadTestCase):
+    def test_split(self):
+        self.assertEqual(
+            download._split([(0, 2500), (3000, 3200)]),
+            [(0, 1000), (1000, 2000), (2000, 2500), (3000, 3200)]
+        )
+
+    def test_gaps(self):
+        self.assertEqual(
+            download._gaps([(500, 600), (100, 200), (150, 300)], 700),
+            [(0, 100), (300, 500), (600, 700)]
+        )
+
+    def test_no_gaps(self):
+        self.assertEqual(download._gaps([(0, 500), (500, 700)], 700), [])
+
+    def test_only_gaps(self):
+        self.assertEqual(download._gaps([], 700), [(0, 700)])
+
+
+class SegmentedDownloadTest(DownloadTestCase):
+    def setUp(self):
+        super(SegmentedDownloadTest, self).setUp()
+        self.patch(download, 'SEGMENT_RETRIES', 1)
+        self.archive = os.urandom(4500)
+        self.part_path = os.path.join(self.tempdir, 'snap.zip.part')
+
+    def _download(self, client, concurrency=1):
+        download._Download(
+            client, '/archive', self.part_path, len(self.archive), None
+        ).run(concurrency)
+
+    def _content(self):
+        with open(self.part_path, 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        client = FakeClient(self.archive)
+        self._download(client, concurrency=3)
+        self.assertEqual(self._content(), self.archive)
+        self.assertEqual(sorted(client._client.requested), [
+            (0, 1000), (1000, 2000), (2000, 3000), (3000, 4000),
+            (4000, 4500)
+        ])
+        self.assertFalse(
+            os.path.exists(self.part_path + download.STATE_SUFFIX)
+        )
+
+    def test_resume(self):
+        self.assertRaises(
+            requests.exceptions.ConnectionError,
+            self._download,
+            FakeClient(self.archive, failing=[2000])
+        )
+        with open(self.part_path + download.STATE_SUFFIX) as f:
+            state = json.load(f)
+        self.assertEqual(state['done'], [0, 1000, 3000, 4000])
+
+        client = FakeClient(self.archive)
+        self._download(client)
+        self.assertEqual(client._client.requested, [(2000, 3000)])
+        self.assertEqual(self._content(), self.archive)
+
+    def test_state_of_another_archive_is_ignored(self):
+        self.assertRaises(
+            requests.exceptions.ConnectionError,
+            self._download,
+            FakeClient(self.archive, failing=[2000])
+        )
+        self.archive = os.urandom(3500)
+        client = FakeClient(self.archive)
+        self._download(client)
+        self.assertEqual(len(client._client.requested), 4)
+        self.assertEqual(self._content(), self.archive)
+
+
+class IncrementalDownloadTest(DownloadTestCase):
+    def setUp(self):
+        super(IncrementalDownloadTest, self).setUp()
+        self.patch(download, 'MIN_REUSE_SIZE', 1000)
+        # Only the central directory, not the whole (small) archive
+        self.patch(download, 'TAIL_SIZE', 200)
+        self.store = SnapshotStore(self.tempdir)
+        self.shared = os.urandom(3000)
+        self.part_path = os.path.join(self.tempdir, 'snap2.zip.part')
+
+    def _base(self, members):
+        archive_path = os.path.join(self.tempdir, 'snap1.zip')
+        create_archive(archive_path, members)
+        path = manifest_path(self.tempdir, 'snap1')
+        self.store.add(archive_path, path, 'snap1', 'checksum')
+        return self.store.open_snapshot(path)
+
+    def _archive(self, members):
+        archive_path = os.path.join(self.tempdir, 'snap2.zip')
+        create_archive(archive_path, members)
+        with open(archive_path, 'rb') as f:
+            return f.read()
+
+    def _download(self, base, archive):
+        client = FakeClient(archive)
+        ranges = download._reuse_members(
+            client, '/archive', self.part_path, len(archive), base
+        )
+        download._Download(
+            client, '/archive', self.part_path, len(archive), None,
+            ranges=ranges
+        ).run(1)
+        with open(self.part_path, 'rb') as f:
+            self.assertEqual(f.read(), archive)
+        download.verify_archive(self.part_path)
+        return sum(end - start for start, end in client._client.requested)
+
+    def test_unchanged_members_are_reused(self):
+        base = self._base([('large', self.shared),
+                           ('db', os.urandom(100)),
+                           ('log', os.urandom(300))])
+        # The unchanged member moved to another offset, and the tail of the
+        # archive (which is always downloaded) is in a changed member
+        archive = self._archive([('db', os.urandom(200)),
+                                 ('large', self.shared),
+                                 ('log', os.urandom(300))])
+        member = base.members['large']
+        self.assertEqual(self._download(base, archive),
+                         len(archive) - (member['end'] - member['start']))
+
+    def test_changed_members_are_downloaded(self):
+        base = self._base([('large', os.urandom(3000))])
+        archive = self._archive([('large', self.shared)])
+        self.assertEqual(self._download(base, archive), len(archive))
+
+    def test_small_members_are_downloaded(self):
+        base = self._base([('small', b'x' * 100)])
+        archive = self._archive([('small', b'x' * 100)])
+        self.assertEqual(self._download(base, archive), len(archive))
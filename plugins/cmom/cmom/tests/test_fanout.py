@@ -0,0 +1,62 @@
+from cloudify.mocks import MockCloudifyContext
+from cloudify.state import current_ctx
+from cloudify.exceptions import CommandExecutionException
+
+from cmom.cluster import fanout
+
+from . import CmomTestCase
+
+
+class FakeBackend(object):
+    def __init__(self, manager_ip):
+        self.manager_ip = manager_ip
+
+    def manager_status(self, timeout=None):
+        if self.manager_ip == '2.2.2.2':
+            raise CommandExecutionException(
+                command='status', error='Connection refused', output='',
+                code=-1
+            )
+        return [{'service': 'Cloudify Console', 'status': 'running'}], \
+            timeout
+
+
+class FanOutTest(CmomTestCase):
+    def setUp(self):
+        super(FanOutTest, self).setUp()
+        self.instance = MockCloudifyContext(runtime_properties={
+            'managers': {'1.1.1.1': {}, '2.2.2.2': {}},
+            'ca_cert': 'ca.crt'
+        }).instance
+        self.patch(fanout, 'get_backend',
+                   lambda manager_ip, _: FakeBackend(manager_ip))
+
+    def _fan_out(self, timeout=None):
+        return fanout.fan_out(
+            lambda backend, timeout: backend.manager_status(timeout=timeout),
+            'status',
+            instance=self.instance,
+            timeout=timeout
+        )
+
+    def test_fan_out(self):
+        results, errors = self._fan_out(timeout=5)
+        self.assertEqual(list(results), ['1.1.1.1'])
+        services, timeout = results['1.1.1.1']
+        self.assertEqual(services[0]['status'], 'running')
+        self.assertTrue(0 < timeout <= 5)
+        self.assertEqual(list(errors), ['2.2.2.2'])
+        self.assertIn('Connection refused', str(errors['2.2.2.2']))
+
+    def test_default_timeout(self):
+        results, _ = self._fan_out()
+        self.assertLessEqual(results['1.1.1.1'][1],
+                             fanout.DEFAULT_FAN_OUT_TIMEOUT)
+
+    def test_context_is_set_in_threads(self):
+        def func(backend, timeout):
+            return current_ctx.get_ctx().deployment.id
+
+        results, _ = fanout.fan_out(func, 'deployment',
+                                    instance=self.instance)
+        self.assertEqual(results, {'1.1.1.1': 'dep', '2.2.2.2': 'dep'})
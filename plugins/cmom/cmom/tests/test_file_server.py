@@ -0,0 +1,124 @@
+import os
+
+from cmom.misc import file_server
+
+from . import CmomTestCase
+
+
+class FileServerTestCase(CmomTestCase):
+    def setUp(self):
+        super(FileServerTestCase, self).setUp()
+        blobs_dir = os.path.join(self.tempdir, '.blobs')
+        os.mkdir(blobs_dir)
+        self.patch(file_server, 'BLOBS_DIR', blobs_dir)
+        self.src_path = self._create_file('src', b'content')
+        os.chmod(self.src_path, 0o644)
+        self.file_hash = file_server._file_hash(self.src_path)
+        self.blob_path = file_server._blob_path(self.file_hash, 0o644)
+
+    def _create_file(self, name, content):
+        path = os.path.join(self.tempdir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def _deployment_dir(self, deployment_id):
+        path = os.path.join(self.tempdir, deployment_id)
+        os.mkdir(path)
+        return path
+
+    def _link(self, deployment_id):
+        dst_path = os.path.join(self._deployment_dir(deployment_id), 'file')
+        manifest = {'file': {'hash': self.file_hash, 'mode': 0o644}}
+        result = file_server._link_blob(
+            self.src_path, dst_path, self.file_hash, 0o644, manifest
+        )
+        return result, dst_path, manifest
+
+
+class LinkBlobTest(FileServerTestCase):
+    def test_link_blob(self):
+        result, dst_path, _ = self._link('dep1')
+        self.assertEqual(result, file_server.COPIED)
+        self.assertTrue(os.path.samefile(dst_path, self.blob_path))
+
+        result, dst_path, _ = self._link('dep2')
+        self.assertEqual(result, file_server.LINKED)
+        self.assertEqual(os.stat(self.blob_path).st_nlink, 3)
+
+    def test_link_blob_again(self):
+        _, dst_path, manifest = self._link('dep1')
+        self.assertEqual(
+            file_server._link_blob(
+                self.src_path, dst_path, self.file_hash, 0o644, manifest
+            ),
+            file_server.SKIPPED
+        )
+        self.assertEqual(os.stat(self.blob_path).st_nlink, 2)
+
+    def test_unlink_shared_blob(self):
+        _, dst_path1, manifest1 = self._link('dep1')
+        _, dst_path2, manifest2 = self._link('dep2')
+
+        file_server._unlink(dst_path1, manifest1)
+        self.assertFalse(os.path.exists(dst_path1))
+        self.assertEqual(os.stat(self.blob_path).st_nlink, 2)
+
+        file_server._unlink(dst_path2, manifest2)
+        self.assertFalse(os.path.exists(dst_path2))
+        self.assertFalse(os.path.exists(self.blob_path))
+
+    def test_replace_linked_file(self):
+        _, dst_path, manifest = self._link('dep1')
+        new_src_path = self._create_file('new_src', b'new content')
+        new_hash = file_server._file_hash(new_src_path)
+
+        file_server._link_blob(
+            new_src_path, dst_path, new_hash, 0o644, manifest
+        )
+        self.assertTrue(
+            os.path.samefile(dst_path, file_server._blob_path(new_hash, 0o644))
+        )
+        # Nothing else was using the old blob
+        self.assertFalse(os.path.exists(self.blob_path))
+
+
+class FileServerSyncTest(FileServerTestCase):
+    def setUp(self):
+        super(FileServerSyncTest, self).setUp()
+        self.patch(file_server, 'DEP_DIR', self._deployment_dir('dep'))
+        self.dst_path = os.path.join(file_server.DEP_DIR, 'file')
+
+    def test_sync(self):
+        sync = file_server._FileServerSync()
+        sync.copy(self.src_path, self.dst_path, mode=0o644)
+        self.assertEqual(sync.save()[file_server.COPIED], len(b'content'))
+        self.assertEqual(os.stat(self.dst_path).st_mode & 0o777, 0o644)
+
+        sync = file_server._FileServerSync()
+        sync.copy(self.src_path, self.dst_path, mode=0o644)
+        self.assertEqual(sync.save()[file_server.SKIPPED], len(b'content'))
+
+    def test_changed_source(self):
+        sync = file_server._FileServerSync()
+        sync.copy(self.src_path, self.dst_path)
+        sync.save()
+        self._create_file('src', b'changed')
+        os.utime(self.src_path, (0, 0))
+
+        sync = file_server._FileServerSync()
+        sync.copy(self.src_path, self.dst_path)
+        self.assertEqual(sync.save()[file_server.COPIED], len(b'changed'))
+        with open(self.dst_path, 'rb') as f:
+            self.assertEqual(f.read(), b'changed')
+        self.assertFalse(os.path.exists(self.blob_path))
+
+    def test_permissions_are_not_shared(self):
+        sync = file_server._FileServerSync()
+        sync.copy(self.src_path, self.dst_path)
+        other_path = os.path.join(self._deployment_dir('other'), 'file')
+        sync.copy(self.src_path, other_path, mode=0o600)
+
+        self.assertEqual(os.stat(self.dst_path).st_mode & 0o777, 0o644)
+        self.assertEqual(os.stat(other_path).st_mode & 0o777, 0o600)
+        self.assertFalse(os.path.samefile(self.dst_path, other_path))
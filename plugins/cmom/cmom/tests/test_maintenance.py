@@ -0,0 +1,127 @@
+import os
+
+import requests
+
+from cloudify.state import current_ctx
+from cloudify.exceptions import NonRecoverableError
+
+from cmom.cluster import maintenance
+
+from . import CmomTestCase
+
+
+class FakeBackend(object):
+    def __init__(self):
+        self.created = []
+
+    def create_snapshot(self, snapshot_id, backup_params):
+        self.created.append(snapshot_id)
+        return 'exec-{0}'.format(len(self.created))
+
+
+class BackupTest(CmomTestCase):
+    def setUp(self):
+        super(BackupTest, self).setUp()
+        # The snapshots are kept in ~/snapshots
+        self.patch(os, 'environ', dict(os.environ, HOME=self.tempdir))
+        self.backend = FakeBackend()
+        self.downloads = []
+        self.download_error = None
+        self.waited = []
+        self.patch(maintenance, 'get_current_master', lambda: '1.1.1.1')
+        self.patch(maintenance, 'get_backend', lambda _: self.backend)
+        self.patch(maintenance, '_wait_for_execution',
+                   lambda _, execution_id, *__: self.waited.append(
+                       execution_id))
+        self.patch(maintenance, '_download_snapshot', self._download)
+        self.snapshots_dir = maintenance._snapshots_dir()
+
+    def _download(self, backend, snapshot_id, part_path, base=None):
+        self.downloads.append(part_path)
+        with open(part_path, 'w') as f:
+            f.write('partial')
+        if self.download_error:
+            raise self.download_error
+        os.remove(part_path)
+        output_path = maintenance.manifest_path(
+            self.snapshots_dir, snapshot_id
+        )
+        with open(output_path, 'w') as f:
+            f.write('{}')
+        return output_path
+
+    def _backup(self, **inputs):
+        current_ctx.set(current_ctx.get_ctx(), inputs)
+        return maintenance.backup()
+
+    def _in_progress(self):
+        return maintenance._backup_in_progress()
+
+    def test_backup(self):
+        output_path = self._backup(snapshot_id='snap')
+        self.assertEqual(
+            output_path, os.path.join(self.snapshots_dir, 'snap.json')
+        )
+        self.assertEqual(self.backend.created, ['snap'])
+        self.assertEqual(self._in_progress(), {})
+
+    def test_retry_resumes_download(self):
+        self.download_error = requests.exceptions.ConnectionError()
+        self.assertRaises(requests.exceptions.ConnectionError, self._backup)
+        snapshot_id = self._in_progress()['snapshot_id']
+        self.assertEqual(self._in_progress()['execution_id'], 'exec-1')
+
+        self.download_error = None
+        output_path = self._backup()
+        self.assertEqual(
+            output_path,
+            maintenance.manifest_path(self.snapshots_dir, snapshot_id)
+        )
+        # The snapshot was created once, and downloaded into the same path
+        self.assertEqual(self.backend.created, [snapshot_id])
+        self.assertEqual(self.downloads[0], self.downloads[1])
+        self.assertEqual(self._in_progress(), {})
+
+    def test_retry_waits_for_creation(self):
+        self.patch(maintenance, '_wait_for_execution',
+                   self._fail_waiting)
+        self.assertRaises(RuntimeError, self._backup, snapshot_id='snap')
+
+        self.patch(maintenance, '_wait_for_execution',
+                   lambda _, execution_id, *__: self.waited.append(
+                       execution_id))
+        self._backup(snapshot_id='snap')
+        self.assertEqual(self.backend.created, ['snap'])
+        self.assertEqual(self.waited, ['exec-1'])
+
+    def _fail_waiting(self, *_):
+        raise RuntimeError('Manager unavailable')
+
+    def test_failed_backup_is_not_resumed(self):
+        self.download_error = NonRecoverableError('Corrupted snapshot')
+        self.assertRaises(NonRecoverableError, self._backup,
+                          snapshot_id='snap1')
+        self.assertEqual(self._in_progress(), {})
+
+    def test_other_snapshot_id(self):
+        self.download_error = requests.exceptions.ConnectionError()
+        self.assertRaises(requests.exceptions.ConnectionError,
+                          self._backup, snapshot_id='snap1')
+
+        self.download_error = None
+        self._backup(snapshot_id='snap2')
+        self.assertEqual(self.backend.created, ['snap1', 'snap2'])
+        # The partial download of snap1 will never be resumed
+        self.assertEqual(os.listdir(self.snapshots_dir), ['snap2.json'])
+
+    def test_stale_downloads_are_removed(self):
+        for name in ('old.zip.part', 'old.zip.part.state',
+                     'old.zip.part.state.123', 'kept.zip', 'kept.json'):
+            with open(os.path.join(self.snapshots_dir, name), 'w') as f:
+                f.write('{}')
+        maintenance._remove_stale_downloads(
+            self.snapshots_dir,
+            os.path.join(self.snapshots_dir, 'new.zip.part')
+        )
+        self.assertEqual(sorted(os.listdir(self.snapshots_dir)),
+                         ['kept.json', 'kept.zip'])
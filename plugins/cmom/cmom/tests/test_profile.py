@@ -0,0 +1,89 @@
+import time
+import threading
+
+from cloudify.exceptions import CommandExecutionException, RecoverableError
+
+from cmom.cluster import profile
+
+from . import CmomTestCase
+
+
+class FakeBackend(object):
+    def __init__(self, manager_ip, managers):
+        self.manager_ip = manager_ip
+        self.managers = managers
+
+    def cluster_status(self, timeout=None):
+        self.managers.timeouts[self.manager_ip] = timeout
+        result = self.managers.results[self.manager_ip]
+        if result is self.managers.hanging:
+            result.wait(timeout)
+            raise CommandExecutionException(
+                command='cluster status', error='Timed out', output='',
+                code=-1
+            )
+        elif isinstance(result, Exception):
+            raise result
+
+
+class GetClusterProfileTest(CmomTestCase):
+    def setUp(self):
+        super(GetClusterProfileTest, self).setUp()
+        self.timeouts = {}
+        self.results = {}
+        self.patch(profile, 'get_backend',
+                   lambda manager_ip, _: FakeBackend(manager_ip, self))
+        self.patch(profile, 'cluster_property', lambda _, __: 2)
+        # A manager that never answers
+        self.hanging = threading.Event()
+        self.addCleanup(self.hanging.set)
+
+    def _unavailable(self):
+        return CommandExecutionException(
+            command='cluster status', error='Connection refused', output='',
+            code=-1
+        )
+
+    def test_first_answering_manager(self):
+        self.results = {'1.1.1.1': self._unavailable(),
+                        '2.2.2.2': None,
+                        '3.3.3.3': self.hanging}
+        self.assertEqual(
+            profile._get_cluster_profile(sorted(self.results), object()),
+            '2.2.2.2'
+        )
+
+    def test_probes_time_out_by_the_deadline(self):
+        self.results = {'1.1.1.1': self.hanging, '2.2.2.2': self.hanging}
+        start = time.time()
+        self.assertRaises(RecoverableError, profile._get_cluster_profile,
+                          sorted(self.results), object())
+        self.assertLess(time.time() - start, 3)
+        for timeout in self.timeouts.values():
+            self.assertLessEqual(timeout, 2)
+
+    def test_unexpected_errors_are_reported(self):
+        self.results = {'1.1.1.1': ValueError('Bad config')}
+        try:
+            profile._get_cluster_profile(['1.1.1.1'], object())
+        except RecoverableError as e:
+            self.assertIn('1.1.1.1: Bad config', str(e))
+        else:
+            self.fail('RecoverableError not raised')
+
+
+class AuthErrorTest(CmomTestCase):
+    def test_unauthorized(self):
+        self.assertTrue(profile._is_auth_error(
+            'Retrieving cluster status...\n'
+            'An error occurred on the server: 401: User unauthorized'
+        ))
+
+    def test_other_errors_mentioning_401(self):
+        for error in (
+                'Cannot connect to manager 10.0.0.401',
+                'Execution 401f7b2e-1c3a failed',
+                'An error occurred on the server: 404: Deployment 401 not '
+                'found',
+                None):
+            self.assertFalse(profile._is_auth_error(error))
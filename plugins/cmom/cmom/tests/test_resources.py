@@ -0,0 +1,56 @@
+import os
+import tarfile
+import zipfile
+
+from cmom.cluster.resources import _blueprint_id
+
+from . import CmomTestCase
+
+
+class BlueprintIdTest(CmomTestCase):
+    def setUp(self):
+        super(BlueprintIdTest, self).setUp()
+        self.folder = os.path.join(self.tempdir, 'my_app')
+        os.mkdir(self.folder)
+        self.blueprint_path = os.path.join(self.folder, 'blueprint.yaml')
+        with open(self.blueprint_path, 'w') as f:
+            f.write('tosca_definitions_version: cloudify_dsl_1_3\n')
+
+    def test_explicit_id(self):
+        self.assertEqual(
+            _blueprint_id({'path': self.blueprint_path, 'id': 'my_id'}),
+            'my_id'
+        )
+
+    def test_yaml(self):
+        self.assertEqual(_blueprint_id({'path': self.blueprint_path}),
+                         'my-app')
+
+    def test_yaml_with_filename(self):
+        self.assertEqual(
+            _blueprint_id({'path': self.blueprint_path,
+                           'filename': 'other_blueprint.yaml'}),
+            'my-app.other-blueprint'
+        )
+
+    def test_zip(self):
+        archive_path = os.path.join(self.tempdir, 'archive.zip')
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.write(self.blueprint_path, 'app_1/blueprint.yaml')
+        self.assertEqual(_blueprint_id({'path': archive_path}), 'app-1')
+
+    def test_tar_with_filename(self):
+        archive_path = os.path.join(self.tempdir, 'archive.tar.gz')
+        archive = tarfile.open(archive_path, 'w:gz')
+        archive.add(self.folder, './app')
+        archive.close()
+        self.assertEqual(
+            _blueprint_id({'path': archive_path, 'filename': 'aws.yaml'}),
+            'app.aws'
+        )
+
+    def test_url(self):
+        self.assertEqual(
+            _blueprint_id({'path': 'https://host/apps/app.tar.gz'}),
+            'apps'
+        )
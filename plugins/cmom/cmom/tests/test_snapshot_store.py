@@ -0,0 +1,231 @@
+import os
+import json
+import zipfile
+import hashlib
+import unittest
+from datetime import datetime
+
+from cloudify.exceptions import NonRecoverableError
+
+from cmom.cluster import snapshot_store
+from cmom.cluster.snapshot_store import SnapshotStore, manifest_path
+
+from . import CmomTestCase
+
+DATE_TIME = (2019, 1, 1, 0, 0, 0)
+
+
+def create_archive(path, members):
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name, data in members:
+            archive.writestr(zipfile.ZipInfo(name, DATE_TIME), data)
+
+
+def checksum(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def timestamp(*date):
+    return (datetime(*date) - datetime.fromtimestamp(0)).total_seconds()
+
+
+class SnapshotStoreTestCase(CmomTestCase):
+    def setUp(self):
+        super(SnapshotStoreTestCase, self).setUp()
+        self.base_dir = os.path.join(self.tempdir, 'snapshots')
+        self.snapshots_dir = os.path.join(self.base_dir, 'dep')
+        os.makedirs(self.snapshots_dir)
+        self.store = SnapshotStore(self.base_dir)
+        self.patch(snapshot_store, 'CHUNK_SIZE', 1000)
+        self.shared = os.urandom(2500)
+
+    def _add(self, snapshot_id, members, snapshots_dir=None):
+        archive_path = os.path.join(self.tempdir, snapshot_id + '.zip')
+        create_archive(archive_path, members)
+        path = manifest_path(snapshots_dir or self.snapshots_dir, snapshot_id)
+        self.store.add(archive_path, path, snapshot_id,
+                       checksum(archive_path))
+        return archive_path, path
+
+    def _chunks(self):
+        return set(
+            chunk_hash
+            for _, _, files in os.walk(self.store.chunks_dir)
+            for chunk_hash in files
+        )
+
+
+class CutPointsTest(SnapshotStoreTestCase):
+    def test_cut_points(self):
+        path = os.path.join(self.tempdir, 'archive.zip')
+        create_archive(path, [('small', b'x' * 10),
+                              ('large', self.shared)])
+        cuts = snapshot_store._cut_points(path)
+
+        members = list(snapshot_store._members(path))
+        (small, small_start, small_end), (large, large_start, large_end) = \
+            members
+        self.assertEqual(cuts, [
+            0, small_start, small_end, large_start,
+            large_start + 1000, large_start + 2000, large_end,
+            os.path.getsize(path)
+        ])
+        self.assertEqual(small.header_offset, 0)
+        # Members are contiguous, their local headers start where the data
+        # of the previous member ends
+        self.assertEqual(small_end, large.header_offset)
+
+
+class LatestPerPeriodTest(unittest.TestCase):
+    def _manifests(self, *dates):
+        return sorted(
+            ((timestamp(*date), '{0}-{1}-{2}.{3}'.format(*date)) for date in
+             dates),
+            reverse=True
+        )
+
+    def test_daily(self):
+        manifests = self._manifests(
+            (2019, 1, 1, 10), (2019, 1, 1, 20), (2019, 1, 2, 10),
+            (2019, 1, 3, 10), (2019, 1, 3, 20)
+        )
+        self.assertEqual(
+            snapshot_store._latest_per_period(
+                manifests, 2, lambda date: date.date()
+            ),
+            {'2019-1-3.20', '2019-1-2.10'}
+        )
+
+    def test_weekly(self):
+        manifests = self._manifests(
+            (2019, 1, 1, 10), (2019, 1, 4, 10), (2019, 1, 8, 10),
+        )
+        self.assertEqual(
+            snapshot_store._latest_per_period(
+                manifests, 5, lambda date: date.isocalendar()[:2]
+            ),
+            {'2019-1-8.10', '2019-1-4.10'}
+        )
+
+    def test_none(self):
+        manifests = self._manifests((2019, 1, 1, 10))
+        self.assertEqual(
+            snapshot_store._latest_per_period(
+                manifests, 0, lambda date: date.date()
+            ),
+            set()
+        )
+
+
+class StoreTest(SnapshotStoreTestCase):
+    def test_extract(self):
+        archive_path, path = self._add(
+            'snap', [('small', b'x' * 10), ('large', self.shared)]
+        )
+        output_path = os.path.join(self.tempdir, 'output.zip')
+        self.store.extract(path, output_path)
+        with open(archive_path, 'rb') as original, \
+                open(output_path, 'rb') as output:
+            self.assertEqual(original.read(), output.read())
+
+    def test_extract_bad_checksum(self):
+        _, path = self._add('snap', [('large', self.shared)])
+        manifest = snapshot_store.load_manifest(path)
+        manifest['sha256'] = 'bad'
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+        output_path = os.path.join(self.tempdir, 'output.zip')
+        self.assertRaises(NonRecoverableError,
+                          self.store.extract, path, output_path)
+        self.assertFalse(os.path.exists(output_path))
+
+    def test_unchanged_members_are_stored_once(self):
+        self._add('snap1', [('db', os.urandom(100)),
+                            ('large', self.shared)])
+        chunks = self._chunks()
+        self._add('snap2', [('db', os.urandom(200)),
+                            ('large', self.shared)])
+        new_chunks = self._chunks() - chunks
+        # The local headers and data of `db` and the central directory
+        self.assertEqual(len(new_chunks), 3)
+
+
+class RetentionTest(SnapshotStoreTestCase):
+    def _add_at(self, snapshot_id, created_at, members, snapshots_dir=None):
+        _, path = self._add(snapshot_id, members, snapshots_dir)
+        manifest = snapshot_store.load_manifest(path)
+        manifest['created_at'] = timestamp(*created_at)
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+        return path
+
+    def test_keep_all(self):
+        self._add_at('snap1', (2019, 1, 1, 10), [('db', os.urandom(10))])
+        self.assertEqual(
+            self.store.apply_retention(self.snapshots_dir), []
+        )
+
+    def test_retention(self):
+        self._add_at('snap1', (2019, 1, 1, 10), [('db', os.urandom(10))])
+        self._add_at('snap2', (2019, 1, 1, 20), [('db', os.urandom(10))])
+        chunks = self._chunks()
+        self._add_at('snap3', (2019, 1, 2, 10), [('db', os.urandom(10))])
+        snap3_chunks = self._chunks() - chunks
+
+        removed = self.store.apply_retention(self.snapshots_dir,
+                                             keep_daily=1, keep_weekly=1)
+        self.assertEqual(sorted(removed), ['snap1', 'snap2'])
+        self.assertEqual(os.listdir(self.snapshots_dir), ['snap3.json'])
+        self.assertEqual(self._chunks(), snap3_chunks)
+
+    def test_shared_chunks_are_kept(self):
+        other_dir = os.path.join(self.base_dir, 'other')
+        os.makedirs(other_dir)
+        self._add_at('snap1', (2019, 1, 1, 10),
+                     [('large', self.shared)])
+        self._add_at('snap2', (2019, 1, 2, 10),
+                     [('db', os.urandom(10))])
+        other = self._add_at('other', (2019, 1, 1, 10),
+                             [('large', self.shared)], other_dir)
+
+        self.assertEqual(
+            self.store.apply_retention(self.snapshots_dir, keep_daily=1),
+            ['snap1']
+        )
+        output_path = os.path.join(self.tempdir, 'output.zip')
+        self.store.extract(other, output_path)
+
+
+class StoredSnapshotTest(SnapshotStoreTestCase):
+    def setUp(self):
+        super(StoredSnapshotTest, self).setUp()
+        archive_path, path = self._add(
+            'snap', [('small', b'x' * 10), ('large', self.shared)]
+        )
+        with open(archive_path, 'rb') as f:
+            self.archive = f.read()
+        self.snapshot = self.store.open_snapshot(path)
+
+    def _copy_range(self, start, end):
+        output_path = os.path.join(self.tempdir, 'output')
+        with open(output_path, 'wb') as f:
+            f.write(b'-' * 5)
+            self.snapshot.copy_range(start, end, f)
+        with open(output_path, 'rb') as f:
+            self.assertEqual(f.read(), b'-' * 5 + self.archive[start:end])
+
+    def test_members(self):
+        member = self.snapshot.members['large']
+        self.assertEqual(self.archive[member['end'] - len(self.shared):
+                                      member['end']],
+                         self.shared)
+
+    def test_copy_within_chunk(self):
+        self._copy_range(100, 200)
+
+    def test_copy_across_chunks(self):
+        self._copy_range(20, 2600)
+
+    def test_copy_all(self):
+        self._copy_range(0, len(self.archive))
@@ -0,0 +1,66 @@
+import unittest
+
+from cmom.cluster import standby
+
+
+class FakeInstance(object):
+    def __init__(self, **runtime_properties):
+        self.runtime_properties = runtime_properties
+
+
+class StandbyPoolTest(unittest.TestCase):
+    def test_fill_pool(self):
+        instance = FakeInstance()
+        self.assertEqual(
+            standby.fill_pool(instance, ['1.1.1.1', '2.2.2.2', '3.3.3.3'], 2),
+            ['1.1.1.1', '2.2.2.2']
+        )
+        self.assertEqual(standby.get_standbys(instance),
+                         ['1.1.1.1', '2.2.2.2'])
+
+    def test_fill_full_pool(self):
+        instance = FakeInstance(standby_managers=['1.1.1.1', '2.2.2.2'])
+        self.assertEqual(standby.fill_pool(instance, ['3.3.3.3'], 1), [])
+        self.assertEqual(standby.get_standbys(instance),
+                         ['1.1.1.1', '2.2.2.2'])
+
+    def test_pop_standby(self):
+        instance = FakeInstance(standby_managers=['1.1.1.1', '2.2.2.2'])
+        self.assertEqual(standby.pop_standby(instance), '1.1.1.1')
+        self.assertEqual(standby.get_standbys(instance), ['2.2.2.2'])
+
+    def test_pop_empty_pool(self):
+        instance = FakeInstance()
+        self.assertIsNone(standby.pop_standby(instance))
+
+    def test_add_standby(self):
+        instance = FakeInstance(standby_managers=['1.1.1.1'])
+        standby.add_standby(instance, '2.2.2.2')
+        standby.add_standby(instance, '1.1.1.1')
+        self.assertEqual(standby.get_standbys(instance),
+                         ['1.1.1.1', '2.2.2.2'])
+
+    def test_remove_standby(self):
+        instance = FakeInstance(standby_managers=['1.1.1.1', '2.2.2.2'])
+        self.assertTrue(standby.remove_standby(instance, '1.1.1.1'))
+        self.assertFalse(standby.remove_standby(instance, '3.3.3.3'))
+        self.assertEqual(standby.get_standbys(instance), ['2.2.2.2'])
+
+    def test_pool_is_copied(self):
+        pool = ['1.1.1.1']
+        instance = FakeInstance(standby_managers=pool)
+        standby.pop_standby(instance)
+        # Runtime properties are only saved when they are reassigned
+        self.assertEqual(pool, ['1.1.1.1'])
+        self.assertEqual(standby.get_standbys(instance), [])
+
+    def test_rebuilding(self):
+        instance = FakeInstance()
+        self.assertFalse(standby.is_rebuilding(instance, '1.1.1.1'))
+        standby.set_rebuilding(instance, '1.1.1.1')
+        standby.set_rebuilding(instance, '1.1.1.1')
+        self.assertTrue(standby.is_rebuilding(instance, '1.1.1.1'))
+        self.assertEqual(instance.runtime_properties['rebuilding_managers'],
+                         ['1.1.1.1'])
+        standby.set_rebuilding(instance, '1.1.1.1', rebuilding=False)
+        self.assertFalse(standby.is_rebuilding(instance, '1.1.1.1'))
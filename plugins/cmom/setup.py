@@ -2,7 +2,7 @@ from setuptools import setup, find_packages
 
 setup(
     name='cloudify-manager-of-managers',
-    version='2.0.2',
+    version='2.1.0',
     author='Cloudify',
     author_email='hello@cloudify.co',
     packages=find_packages(include='cmom*'),
@@ -10,4 +10,9 @@ setup(
     install_requires=[
         'cloudify-common==4.5'
     ],
+    extras_require={
+        # Creates the external certificates of the Tier 1 managers
+        # in-process, instead of with `cfy_manager create-external-certs`
+        'certificates': ['cryptography>=2.1.4,<2.5']
+    },
 )
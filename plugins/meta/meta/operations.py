@@ -1,86 +1,329 @@
-from time import sleep
+import Queue
+import threading
+from time import sleep, time
 
 from cloudify import ctx as op_ctx
 from cloudify.decorators import operation
 from cloudify.manager import get_rest_client
-from cloudify.state import ctx_parameters as inputs
+from cloudify.state import current_ctx, ctx_parameters as inputs
 from cloudify.exceptions import NonRecoverableError
 
 from cloudify_rest_client.executions import Execution
+from cloudify_rest_client.exceptions import CloudifyClientError
 
+from .registry import Registry
 
-def _get_deps():
+DEFAULT_CONCURRENCY = 10
+DEFAULT_TIMEOUT = 600
+POLL_INTERVAL = 3
+
+# The states of the leader's services that are considered healthy
+HEALTHY_SERVICE_STATES = ('running', 'active')
+
+# How many executions are polled in a single list request (the IDs are
+# passed in the query string)
+EXECUTIONS_PAGE_SIZE = 100
+
+# Older versions kept the registered deployments in this runtime property
+LEGACY_DEPLOYMENTS = 'deployments'
+
+
+def _get_registry():
+    """
+    Return the registry of the deployments. Deployments registered by older
+    versions of the plugin, as a list in the `deployments` runtime property,
+    are moved into it
+    """
+    registry = Registry()
     runtime_props = op_ctx.instance.runtime_properties
-    return runtime_props.setdefault('deployments', [])
+    if runtime_props.get(LEGACY_DEPLOYMENTS):
+        registry.add(runtime_props[LEGACY_DEPLOYMENTS])
+    runtime_props.pop(LEGACY_DEPLOYMENTS, None)
+    return registry
+
+
+def _save_deployments_count(registry):
+    op_ctx.instance.runtime_properties['deployments_count'] = len(registry)
+    op_ctx.instance.update()
+
+
+def _get_deps():
+    return list(_get_registry())
+
+
+def _get_deployment_ids():
+    deployment_ids = list(inputs.get('deployment_ids') or [])
+    if inputs.get('deployment_id'):
+        deployment_ids.append(inputs['deployment_id'])
+    if not deployment_ids:
+        raise NonRecoverableError(
+            'Either `deployment_id` or `deployment_ids` need to be provided'
+        )
+    return deployment_ids
 
 
 @operation
 def add_deployment(**_):
-    deployment_id = inputs['deployment_id']
-    deps = _get_deps()
-    if deployment_id not in deps:
-        deps.append(deployment_id)
+    registry = _get_registry()
+    registry.add(_get_deployment_ids())
+    _save_deployments_count(registry)
 
-    op_ctx.instance.runtime_properties['deployments'] = deps
-    op_ctx.instance.update()
 
+@operation
+def remove_deployment(**_):
+    registry = _get_registry()
+    registry.remove(_get_deployment_ids())
+    _save_deployments_count(registry)
 
-def _start_get_status_executions(client):
-    started_executions = set()
-    for dep in _get_deps():
-        op_ctx.logger.info('Getting status for deployment `{0}`'.format(dep))
-        execution = client.executions.start(
-            deployment_id=dep,
-            workflow_id='get_status'
-        )
-        started_executions.add(execution.id)
 
-    return started_executions
+def _run_concurrently(func, items, concurrency):
+    """
+    Call `func(item)` for each of `items` on a pool of at most `concurrency`
+    threads, and return a dict of the items mapped to the results. The
+    operation context is thread local, so it is set in each of the threads.
+    If any of the calls raised an error, all of the errors are logged, and
+    the first one is raised once all the calls have finished
 
+    This mirrors `run_concurrently` of the cmom plugin, which can't be
+    imported here, as each plugin is installed in a virtualenv of its own
+    """
+    items = list(items)
+    results = {}
+    errors = []
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
 
-def _wait_for_executions_to_end(client, started_executions):
-    max_retries = 10
-    retries = 0
+    op_ctx_obj = current_ctx.get_ctx()
+    op_inputs = current_ctx.get_parameters()
 
-    while started_executions and retries < max_retries:
-        retries += 1
-        op_ctx.logger.info(
-            'Waiting for executions to finish... [{0}/{1}]'.format(
-                retries, max_retries
+    def _worker():
+        current_ctx.set(op_ctx_obj, op_inputs)
+        try:
+            while True:
+                try:
+                    item = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                # An error must not stop the worker, or the rest of the
+                # items it would have handled are silently skipped
+                try:
+                    results[item] = func(item)
+                except Exception as e:
+                    errors.append((item, e))
+        finally:
+            current_ctx.clear()
+
+    workers = [
+        threading.Thread(target=_worker)
+        for _ in range(min(max(concurrency, 1), len(items)))
+    ]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    for item, error in errors:
+        op_ctx.logger.error('Failed handling `{0}`: {1}'.format(item, error))
+    if errors:
+        raise errors[0][1]
+    return results
+
+
+def _start_get_status_executions(client, deployments, concurrency):
+    """
+    Start `get_status` on all the deployments, and return a dict of the
+    started execution IDs mapped to their deployments, and a dict of the
+    deployments that failed to start mapped to their errors
+    """
+    def _start(dep):
+        op_ctx.logger.info('Getting status for deployment `{0}`'.format(dep))
+        try:
+            return client.executions.start(
+                deployment_id=dep,
+                workflow_id='get_status'
+            ).id, None
+        except CloudifyClientError as e:
+            op_ctx.logger.warning(
+                'Could not start `get_status` on deployment `{0}`: '
+                '{1}'.format(dep, e)
             )
+            return None, str(e)
+
+    started_executions = {}
+    errors = {}
+    for dep, (execution_id, error) in _run_concurrently(
+            _start, deployments, concurrency).items():
+        if execution_id:
+            started_executions[execution_id] = dep
+        else:
+            errors[dep] = error
+    return started_executions, errors
+
+
+def _get_ended_executions(client, execution_ids):
+    """
+    Return the IDs of the ended executions among `execution_ids`, with a
+    single filtered list request (per EXECUTIONS_PAGE_SIZE executions)
+    """
+    execution_ids = list(execution_ids)
+    ended_executions = set()
+    for i in range(0, len(execution_ids), EXECUTIONS_PAGE_SIZE):
+        executions = client.executions.list(
+            id=execution_ids[i:i + EXECUTIONS_PAGE_SIZE],
+            _include=['id', 'status']
         )
+        ended_executions.update(
+            execution.id for execution in executions
+            if execution.status in Execution.END_STATES
+        )
+    return ended_executions
+
 
-        finished_executions = set()
-        for execution_id in started_executions:
-            op_ctx.logger.debug(
-                'Checking execution `{0}`'.format(execution_id)
+def _get_outputs(client, deployments, concurrency):
+    def _get(dep):
+        try:
+            return client.deployments.outputs.get(deployment_id=dep)
+        except CloudifyClientError as e:
+            op_ctx.logger.warning(
+                'Could not get the outputs of deployment `{0}`: '
+                '{1}'.format(dep, e)
             )
-            execution = client.executions.get(execution_id)
-            if execution.status in Execution.END_STATES:
-                finished_executions.add(execution_id)
+            return {'error': str(e)}
+
+    return _run_concurrently(_get, deployments, concurrency)
+
+
+def _update_status(new_status):
+    """
+    Merge the statuses of the deployments that were just gathered into the
+    `status` runtime property (along with the time they were gathered at),
+    and save it right away, so that the partial results are available while
+    the rest are still being gathered
+    """
+    runtime_props = op_ctx.instance.runtime_properties
+    status = runtime_props.get('status') or {}
+    status.update(new_status)
+    runtime_props['status'] = status
+
+    refreshed_at = runtime_props.get('status_refreshed_at') or {}
+    now = time()
+    for dep in new_status:
+        refreshed_at[dep] = now
+    runtime_props['status_refreshed_at'] = refreshed_at
+    op_ctx.instance.update()
+
+
+def _is_healthy(dep_status):
+    """
+    Return False if getting the status of the deployment failed, or if it
+    reported any problems with the Tier 1 cluster
+    """
+    if not dep_status or dep_status.get('error'):
+        return False
+    cluster_status = (dep_status.get('outputs') or {}).get('cluster_status')
+    if not cluster_status or cluster_status.get('error'):
+        return False
+    for node in cluster_status.get('cluster_status') or []:
+        if node.get('online') is False:
+            return False
+    for service in cluster_status.get('leader_status') or []:
+        if str(service.get('status')).lower() not in HEALTHY_SERVICE_STATES:
+            return False
+    return True
+
 
-        started_executions = started_executions - finished_executions
-        sleep(3)
+def _deployments_to_refresh(deployments, max_age):
+    """
+    Return the deployments whose status is older than `max_age` seconds,
+    was never gathered, or was unhealthy the last time it was gathered
+    """
+    runtime_props = op_ctx.instance.runtime_properties
+    status = runtime_props.get('status') or {}
+    refreshed_at = runtime_props.get('status_refreshed_at') or {}
+    now = time()
+    return [
+        dep for dep in deployments
+        if not max_age or
+        now - refreshed_at.get(dep, 0) > max_age or
+        not _is_healthy(status.get(dep))
+    ]
+
+
+def _wait_for_executions_to_end(client, started_executions, timeout,
+                                concurrency):
+    """
+    Poll the started executions until they all end, and as they do,
+    collect the outputs of their deployments
+    """
+    deadline = time() + timeout
+    pending = dict(started_executions)
+
+    while pending and time() < deadline:
+        op_ctx.logger.info(
+            'Waiting for {0} executions to finish...'.format(len(pending))
+        )
+        ended_executions = _get_ended_executions(client, pending.keys())
+        if ended_executions:
+            ended_deployments = [
+                pending.pop(execution_id) for execution_id in ended_executions
+            ]
+            _update_status(
+                _get_outputs(client, ended_deployments, concurrency)
+            )
+        if pending:
+            sleep(POLL_INTERVAL)
 
-    if retries >= max_retries:
+    if pending:
         raise NonRecoverableError(
             'Not all `get_status` executions have finished. '
             'They still might be running in the background. '
-            'The unfinished executions are: {0}'.format(started_executions)
+            'The unfinished executions are: {0}'.format(pending.keys())
         )
 
 
 @operation
 def get_status(**_):
+    """
+    Refresh the statuses of the registered deployments which are stale (see
+    `_deployments_to_refresh`), and return the statuses of all of them
+    """
     client = get_rest_client()
-    started_executions = _start_get_status_executions(client)
+    concurrency = inputs.get('concurrency', DEFAULT_CONCURRENCY)
+    deployments = _get_deps()
 
-    _wait_for_executions_to_end(client, started_executions)
+    # The previous statuses are kept until they are replaced by new ones,
+    # apart from those of deployments that are no longer registered
+    runtime_props = op_ctx.instance.runtime_properties
+    for prop in ('status', 'status_refreshed_at'):
+        runtime_props[prop] = dict(
+            (dep, value)
+            for dep, value in (runtime_props.get(prop) or {}).items()
+            if dep in deployments
+        )
 
-    op_ctx.logger.info('Getting status reports from deployment outputs...')
-    status = {
-        dep: client.deployments.outputs.get(deployment_id=dep)
-        for dep in _get_deps()
-    }
+    stale_deployments = _deployments_to_refresh(
+        deployments, inputs.get('max_age', 0)
+    )
+    op_ctx.logger.info(
+        'Refreshing the status of {0} out of {1} deployments'.format(
+            len(stale_deployments), len(deployments)
+        )
+    )
+    started_executions, errors = _start_get_status_executions(
+        client, stale_deployments, concurrency
+    )
+    if errors:
+        _update_status(
+            dict((dep, {'error': error}) for dep, error in errors.items())
+        )
 
-    op_ctx.instance.runtime_properties['status'] = status
+    op_ctx.logger.info('Getting status reports from deployment outputs...')
+    _wait_for_executions_to_end(
+        client,
+        started_executions,
+        inputs.get('timeout', DEFAULT_TIMEOUT),
+        concurrency
+    )
+    return runtime_props['status']
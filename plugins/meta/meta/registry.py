@@ -0,0 +1,146 @@
+"""
+The registry of the deployments managed by a meta deployment.
+
+The registry is a set of deployment IDs, sharded by their hash into
+SHARDS files in the meta deployment's workdir, so that registering
+deployments only reads and writes the shards they belong to.
+
+The registry is the only record of the registered deployments: they are
+not kept in the runtime properties of the meta node as well, as every
+operation on it would then load all of them. As the registry is kept in the
+workdir, it is not included in snapshots of the Tier 2 manager.
+
+Each shard has a version, and changes are applied optimistically: a shard
+is read and modified without holding any lock, and only written if its
+version did not change in the meantime. Otherwise, the change is applied
+again on top of the new content of the shard.
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+from cloudify import ctx
+from cloudify.exceptions import NonRecoverableError
+
+REGISTRY_FOLDER = 'registry'
+SHARDS = 16
+MAX_RETRIES = 10
+
+
+class _VersionConflict(Exception):
+    pass
+
+
+def _workdir(deployment_id=None):
+    deployment_id = deployment_id or ctx.deployment.id
+    _workdir = os.path.expanduser('~/{0}'.format(deployment_id))
+    if not os.path.isdir(_workdir):
+        os.mkdir(_workdir)
+    return _workdir
+
+
+def _shard(deployment_id):
+    digest = hashlib.sha1(deployment_id.encode('utf-8')).hexdigest()
+    return int(digest, 16) % SHARDS
+
+
+class Registry(object):
+    def __init__(self, deployment_id=None):
+        self.path = os.path.join(_workdir(deployment_id), REGISTRY_FOLDER)
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+
+    def _shard_path(self, shard):
+        return os.path.join(self.path, '{0:02d}.json'.format(shard))
+
+    @contextmanager
+    def _shard_lock(self, shard):
+        """
+        Only held while comparing a shard's version and replacing it
+        """
+        lock_path = os.path.join(self.path, '.{0:02d}.lock'.format(shard))
+        with open(lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self, shard):
+        """
+        Return a tuple of the shard's version and its deployments
+        """
+        shard_path = self._shard_path(shard)
+        if not os.path.isfile(shard_path):
+            return 0, set()
+        with open(shard_path) as f:
+            content = json.load(f)
+        return content['version'], set(content['deployments'])
+
+    def _write(self, shard, expected_version, deployments):
+        shard_path = self._shard_path(shard)
+        # Operations may run concurrently in the same process as well
+        fd, temp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'version': expected_version + 1,
+                'deployments': sorted(deployments)
+            }, f)
+        with self._shard_lock(shard):
+            if self._read(shard)[0] != expected_version:
+                os.remove(temp_path)
+                raise _VersionConflict()
+            os.rename(temp_path, shard_path)
+
+    def _modify(self, shard, change):
+        """
+        Apply `change` (a function receiving the shard's deployments and
+        returning the new ones) to the shard, retrying on conflicts
+        """
+        for _ in range(MAX_RETRIES):
+            version, deployments = self._read(shard)
+            new_deployments = change(set(deployments))
+            if new_deployments == deployments:
+                return
+            try:
+                self._write(shard, version, new_deployments)
+                return
+            except _VersionConflict:
+                ctx.logger.debug(
+                    'Registry shard {0} was modified concurrently, '
+                    'retrying'.format(shard)
+                )
+        raise NonRecoverableError(
+            'Could not update registry shard {0} after {1} attempts'.format(
+                shard, MAX_RETRIES
+            )
+        )
+
+    def _by_shard(self, deployment_ids):
+        shards = {}
+        for deployment_id in deployment_ids:
+            shards.setdefault(_shard(deployment_id), set()).add(deployment_id)
+        return shards
+
+    def add(self, deployment_ids):
+        for shard, shard_ids in self._by_shard(deployment_ids).items():
+            self._modify(shard, lambda deps: deps | shard_ids)
+
+    def remove(self, deployment_ids):
+        for shard, shard_ids in self._by_shard(deployment_ids).items():
+            self._modify(shard, lambda deps: deps - shard_ids)
+
+    def __contains__(self, deployment_id):
+        return deployment_id in self._read(_shard(deployment_id))[1]
+
+    def __iter__(self):
+        for shard in range(SHARDS):
+            for deployment_id in sorted(self._read(shard)[1]):
+                yield deployment_id
+
+    def __len__(self):
+        return sum(len(self._read(shard)[1]) for shard in range(SHARDS))
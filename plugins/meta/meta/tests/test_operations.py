@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cloudify.mocks import MockCloudifyContext
+from cloudify.state import current_ctx
+
+from meta import operations
+
+
+class RunConcurrentlyTest(unittest.TestCase):
+    def setUp(self):
+        current_ctx.set(MockCloudifyContext(deployment_id='meta'))
+        self.addCleanup(current_ctx.clear)
+
+    def test_results(self):
+        self.assertEqual(
+            operations._run_concurrently(lambda item: item * 2, range(20), 3),
+            dict((item, item * 2) for item in range(20))
+        )
+
+    def test_context_is_set_in_threads(self):
+        self.assertEqual(
+            operations._run_concurrently(
+                lambda item: operations.op_ctx.deployment.id, ['a', 'b'], 2
+            ),
+            {'a': 'meta', 'b': 'meta'}
+        )
+
+    def test_errors_do_not_skip_items(self):
+        called = []
+
+        def func(item):
+            called.append(item)
+            if item % 5 == 0:
+                raise ValueError(item)
+
+        self.assertRaises(ValueError,
+                          operations._run_concurrently, func, range(20), 2)
+        self.assertEqual(sorted(called), list(range(20)))
+
+    def test_no_items(self):
+        self.assertEqual(operations._run_concurrently(None, [], 3), {})
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.ctx = MockCloudifyContext(
+            deployment_id='meta',
+            runtime_properties={'deployments': ['dep1', 'dep2']}
+        )
+        current_ctx.set(self.ctx, {'deployment_ids': ['dep2', 'dep3']})
+        self.addCleanup(current_ctx.clear)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        # The registry is kept in ~/<deployment ID>
+        original_home = os.environ.get('HOME')
+        os.environ['HOME'] = self.tempdir
+        self.addCleanup(os.environ.__setitem__, 'HOME', original_home)
+
+    def test_legacy_deployments_are_moved(self):
+        operations.add_deployment()
+        runtime_props = self.ctx.instance.runtime_properties
+        self.assertEqual(runtime_props, {'deployments_count': 3})
+        self.assertEqual(sorted(operations._get_registry()),
+                         ['dep1', 'dep2', 'dep3'])
+
+    def test_remove_deployment(self):
+        operations.remove_deployment()
+        self.assertEqual(self.ctx.instance.runtime_properties,
+                         {'deployments_count': 1})
+        self.assertEqual(list(operations._get_registry()), ['dep1'])
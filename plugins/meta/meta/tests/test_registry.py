@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cloudify.mocks import MockCloudifyContext
+from cloudify.state import current_ctx
+from cloudify.exceptions import NonRecoverableError
+
+from meta import registry
+from meta.registry import Registry
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        current_ctx.set(MockCloudifyContext(deployment_id='meta'))
+        self.addCleanup(current_ctx.clear)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        # The registry is kept in ~/<deployment ID>
+        original_home = os.environ.get('HOME')
+        os.environ['HOME'] = self.tempdir
+        self.addCleanup(os.environ.__setitem__, 'HOME', original_home)
+        self.registry = Registry()
+
+    def test_add_and_remove(self):
+        self.registry.add(['dep{0}'.format(i) for i in range(40)])
+        self.registry.remove(['dep1', 'dep2', 'missing'])
+        self.assertEqual(len(self.registry), 38)
+        self.assertIn('dep3', self.registry)
+        self.assertNotIn('dep1', self.registry)
+        self.assertEqual(
+            sorted(self.registry),
+            sorted('dep{0}'.format(i) for i in range(40) if i not in (1, 2))
+        )
+
+    def test_sharded(self):
+        self.registry.add(['dep{0}'.format(i) for i in range(40)])
+        shards = [
+            name for name in os.listdir(self.registry.path)
+            if name.endswith('.json')
+        ]
+        self.assertGreater(len(shards), 1)
+
+    def test_unchanged_shard_is_not_written(self):
+        shard = registry._shard('dep')
+        self.registry.add(['dep'])
+        self.registry.add(['dep'])
+        self.assertEqual(self.registry._read(shard), (1, {'dep'}))
+
+    def test_write_stale_version(self):
+        shard = registry._shard('dep')
+        self.registry.add(['dep'])
+        self.assertRaises(registry._VersionConflict,
+                          self.registry._write, shard, 0, {'other'})
+        self.assertEqual(self.registry._read(shard), (1, {'dep'}))
+        self.assertEqual(
+            [name for name in os.listdir(self.registry.path)
+             if not name.endswith('.json') and not name.endswith('.lock')],
+            []
+        )
+
+    def test_modify_retries_on_conflict(self):
+        shard = registry._shard('dep1')
+        calls = []
+
+        def change(deployments):
+            if not calls:
+                # Another operation registers a deployment in the meantime
+                Registry().add(['dep1'])
+            calls.append(set(deployments))
+            return deployments | {'dep2'}
+
+        self.registry._modify(shard, change)
+        self.assertEqual(calls, [set(), {'dep1'}])
+        self.assertEqual(self.registry._read(shard), (2, {'dep1', 'dep2'}))
+
+    def test_modify_gives_up(self):
+        shard = registry._shard('dep')
+        calls = []
+
+        def change(deployments):
+            # The shard is always modified concurrently
+            other = Registry()
+            version, other_deployments = other._read(shard)
+            other._write(shard, version, other_deployments | {'dep'})
+            calls.append(set(deployments))
+            return deployments | {'other'}
+
+        self.assertRaises(NonRecoverableError,
+                          self.registry._modify, shard, change)
+        self.assertEqual(len(calls), registry.MAX_RETRIES)
+        self.assertNotIn('other', self.registry._read(shard)[1])
@@ -28,6 +28,12 @@ def add_deployment(ctx, **kwargs):
                   'runtime_interface.add_deployment', **kwargs)
 
 
+@workflow
+def remove_deployment(ctx, **kwargs):
+    _execute_task(ctx, 'meta_node',
+                  'runtime_interface.remove_deployment', **kwargs)
+
+
 @workflow
 def get_status(ctx, **kwargs):
     _execute_task(ctx, 'meta_node', 'runtime_interface.get_status', **kwargs)